@@ -0,0 +1,64 @@
+from hashlib import md5 as hash_md5
+from sys import argv
+from timeit import repeat
+
+from gfo.googlefonts.css import parse_stylesheet
+
+'''
+    Micro-benchmark of the stylesheet rewriting: the single-pass tokenizer
+    (gfo.googlefonts.css) against the previous split/replace approach, on
+    a synthetic css2 response shaped like Google's (one @font-face block
+    per family, weight and subset).
+
+    Usage: python benchmark_css.py [families] [repetitions]
+'''
+
+SUBSETS = ('cyrillic-ext', 'cyrillic', 'greek-ext', 'greek', 'vietnamese', 'latin-ext', 'latin')
+WEIGHTS = (100, 200, 300, 400, 500, 600, 700, 800, 900)
+
+def md5(s: str) -> str:
+    return hash_md5(s.encode('utf-8')).hexdigest()
+
+def build_css2_response(families: int) -> str:
+    blocks = []
+    for family in range(families):
+        for weight in WEIGHTS:
+            for subset in SUBSETS:
+                blocks.append(
+                    f'/* {subset} */\n'
+                    f'@font-face {{\n'
+                    f'  font-family: \'Family {family}\';\n'
+                    f'  font-style: normal;\n'
+                    f'  font-weight: {weight};\n'
+                    f'  font-display: swap;\n'
+                    f'  src: url(https://fonts.gstatic.com/s/family{family}/v30/{weight}-{subset}.woff2) format(\'woff2\');\n'
+                    f'  unicode-range: U+0000-00FF, U+0131, U+0152-0153;\n'
+                    f'}}\n'
+                )
+    return ''.join(blocks)
+
+def rewrite_with_split_and_replace(raw_css: str) -> str:
+    md5_to_font_urls = {}
+    for part in raw_css.split('url('):
+        if ')' in part:
+            font_url = part.split(')')[0]
+            md5_to_font_urls[md5(font_url)] = font_url
+    for md5url, font_url in md5_to_font_urls.items():
+        raw_css = raw_css.replace(font_url, f'/font/{md5url}')
+    return raw_css
+
+def rewrite_with_tokenizer(raw_css: str) -> str:
+    return parse_stylesheet(raw_css).rewrite_urls(lambda font_url: f'/font/{md5(font_url)}')
+
+if __name__ == '__main__':
+    families = int(argv[1]) if len(argv) > 1 else 20
+    repetitions = int(argv[2]) if len(argv) > 2 else 5
+    raw_css = build_css2_response(families)
+    assert rewrite_with_split_and_replace(raw_css) == rewrite_with_tokenizer(raw_css)
+    print(f'{families} families, {raw_css.count("@font-face")} @font-face blocks, {len(raw_css)} bytes')
+    for name, rewrite in (
+        ('split/replace', rewrite_with_split_and_replace),
+        ('tokenizer', rewrite_with_tokenizer)
+    ):
+        best = min(repeat(lambda: rewrite(raw_css), number=1, repeat=repetitions))
+        print(f'{name:>14}: {best * 1000:9.2f} ms')
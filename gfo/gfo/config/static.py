@@ -28,6 +28,22 @@ class HTTPErrors(object):
                f'request - please check your parameters.'
     )
 
+    BAD_ARCHIVE_FORMAT = HTTPException(
+        status_code=status_codes.HTTP_400_BAD_REQUEST,
+        detail=f'The requested archive format is not supported.'
+    )
+
+    BAD_FONT_FORMAT = HTTPException(
+        status_code=status_codes.HTTP_400_BAD_REQUEST,
+        detail=f'The requested font format is not supported.'
+    )
+
+    UNAUTHORIZED = HTTPException(
+        status_code=status_codes.HTTP_401_UNAUTHORIZED,
+        detail=f'The request lacks a valid bearer token.',
+        headers={'www-authenticate': 'Bearer'}
+    )
+
     NOT_FOUND = HTTPException(
         status_code=status_codes.HTTP_404_NOT_FOUND,
         detail=f'The requested resource was not found.'
@@ -45,8 +61,18 @@ class Internal(object):
         hook subscriptions etc.
     '''
 
+    ACCESS_STATISTICS_FLUSH_INTERVAL: int = 5
+    BUNDLE_CHUNK_SIZE: int = 64 * 1024
+    CACHE_CLEANUP_BATCH_SIZE: int = 500
+    CACHE_INDEX_READ_TIMEOUT: float = .5
+    CACHE_INDEX_WRITE_TIMEOUT: float = 10.0
+    CACHE_QUOTA_LOW_WATERMARK: float = .9
     EXCEPTION_HOOK_NAME: str = 'gfo_global_exceptions'
-    SERVICE_INTERVAL_CACHE_CLEANUP: int = 60
+    ON_THE_FLY_COMPRESSION_BROTLI_QUALITY: int = 4
+    ON_THE_FLY_COMPRESSION_GZIP_LEVEL: int = 6
+    PRECOMPRESSION_BROTLI_QUALITY: int = 11
+    PRECOMPRESSION_GZIP_LEVEL: int = 9
+    SERVICE_INTERVAL_CACHE_CLEANUP: int = 10
     SERVICE_INTERVAL_DEFAULT: int = 900
     WORKER_ROLE_LEADER: str = 'leader'
     WORKER_ROLE_FOLLOWER: str = 'follower'
@@ -8,6 +8,150 @@ from gfo.sanity import Sanitizers
 '''
 
 CONFIGURATION_STRUCTURE = dict(
+    admin=dict(
+        token=dict(
+            description='The bearer token authorizing requests to the admin endpoints (e.g. /admin/warmup), which are disabled while it is empty',
+            default='',
+            sanitizer=Sanitizers.str
+        )
+    ),
+    cache=dict(
+        backend=dict(
+            description='Where cache entries are shared with the other nodes of a deployment (filesystem: not at all, memory: per worker, redis: via cache.redis_url)',
+            default='filesystem',
+            sanitizer=Sanitizers.cache_backend
+        ),
+        backend_max_blob_bytes=dict(
+            description='The maximum size of stylesheets and font files shared via the cache backend',
+            default=512 * 1024,
+            sanitizer=Sanitizers.int
+        ),
+        backend_memory_max_bytes=dict(
+            description='The maximum amount of bytes kept per worker by the memory cache backend',
+            default=64 * 1024**2,
+            sanitizer=Sanitizers.int
+        ),
+        backend_memory_max_entries=dict(
+            description='The maximum amount of entries kept per worker by the memory cache backend',
+            default=4096,
+            sanitizer=Sanitizers.int
+        ),
+        client_css_max_age_seconds=dict(
+            description='The max-age of the Cache-Control header of the stylesheets served to clients',
+            default=86400,
+            sanitizer=Sanitizers.int
+        ),
+        client_font_max_age_seconds=dict(
+            description='The max-age of the (immutable) Cache-Control header of the font files served to clients',
+            default=31536000,
+            sanitizer=Sanitizers.int
+        ),
+        css_memory_cache_max_bytes=dict(
+            description='The maximum amount of bytes of rewritten stylesheets kept in memory per worker',
+            default=16 * 1024**2,
+            sanitizer=Sanitizers.int
+        ),
+        css_memory_cache_max_entries=dict(
+            description='The maximum amount of rewritten stylesheets kept in memory per worker',
+            default=1024,
+            sanitizer=Sanitizers.int
+        ),
+        eviction_policy=dict(
+            description='The policy deciding which entries to evict once the cache exceeds its quota (lru, lfu or gdsf)',
+            default='gdsf',
+            sanitizer=Sanitizers.eviction_policy
+        ),
+        honour_upstream_max_age=dict(
+            description='Whether cached entries expire according to Google\'s Cache-Control max-age instead of misc.cache_lifespan_seconds',
+            default=True,
+            sanitizer=Sanitizers.bool
+        ),
+        hot_fonts_max_bytes=dict(
+            description='The maximum amount of bytes of the most requested font files every worker serves from memory (0 = none)',
+            default=0,
+            sanitizer=Sanitizers.int
+        ),
+        hot_fonts_max_file_bytes=dict(
+            description='The maximum size of a single font file (with its precompressed variants) served from memory',
+            default=1024**2,
+            sanitizer=Sanitizers.int
+        ),
+        max_bytes=dict(
+            description='The maximum size of the font cache in bytes (0 = unlimited)',
+            default=2 * 1024**3,
+            sanitizer=Sanitizers.int
+        ),
+        max_entries=dict(
+            description='The maximum amount of files in the font cache (0 = unlimited)',
+            default=100000,
+            sanitizer=Sanitizers.int
+        ),
+        open_files_max=dict(
+            description='The maximum amount of font files every worker keeps open for serving them (0 = none)',
+            default=256,
+            sanitizer=Sanitizers.int
+        ),
+        persistent=dict(
+            description='Whether to keep (and validate) the font cache across restarts instead of wiping it',
+            default=False,
+            sanitizer=Sanitizers.bool
+        ),
+        precompression_min_bytes=dict(
+            description='The minimum size in bytes of stylesheets and font files that are stored precompressed (gzip, brotli)',
+            default=1024,
+            sanitizer=Sanitizers.int
+        ),
+        redis_url=dict(
+            description='The Redis server of the redis cache backend',
+            default='redis://localhost:6379/0',
+            sanitizer=Sanitizers.str
+        ),
+        stale_if_error_seconds=dict(
+            description='The amount of seconds an expired entry is still served when refreshing it from Google fails',
+            default=7 * 86400,
+            sanitizer=Sanitizers.int
+        ),
+        stale_while_revalidate_seconds=dict(
+            description='The amount of seconds an expired entry is still served while it is refreshed in the background',
+            default=86400,
+            sanitizer=Sanitizers.int
+        ),
+        subset_max_bytes=dict(
+            description='The maximum size in bytes of the locally subset fonts of text= requests, the least recently used are evicted beyond it (0 = unlimited)',
+            default=256 * 1024**2,
+            sanitizer=Sanitizers.int
+        ),
+        subset_max_entries=dict(
+            description='The maximum amount of locally subset fonts of text= requests, the least recently used are evicted beyond it (0 = unlimited)',
+            default=10000,
+            sanitizer=Sanitizers.int
+        ),
+        subset_text_locally=dict(
+            description='Whether to subset the cached fonts for text= requests locally instead of asking Google for every text (requires fontTools)',
+            default=False,
+            sanitizer=Sanitizers.bool
+        ),
+        subset_text_workers=dict(
+            description='The amount of processes per worker subsetting fonts for text= requests',
+            default=1,
+            sanitizer=Sanitizers.int
+        ),
+        transcode_woff2=dict(
+            description='Whether to transcode cached TTF fonts to WOFF2 locally in the background (requires fontTools)',
+            default=False,
+            sanitizer=Sanitizers.bool
+        ),
+        transcode_woff2_workers=dict(
+            description='The amount of processes per worker transcoding fonts to WOFF2',
+            default=1,
+            sanitizer=Sanitizers.int
+        ),
+        verify_checksums_on_startup=dict(
+            description='Whether to verify the checksum of every entry of a persistent cache at startup (reads all files)',
+            default=False,
+            sanitizer=Sanitizers.bool
+        )
+    ),
     cors=dict(
         allow_credentials=dict(
             description='Whether the CORS middleware allows cookies in cross origin requests',
@@ -102,4 +246,120 @@ CONFIGURATION_STRUCTURE = dict(
             sanitizer=Sanitizers.timezone
         )
     ),
+    peers=dict(
+        secret=dict(
+            description='The shared secret the nodes of peers.urls authenticate their internal requests with (peer fill is disabled while it is empty)',
+            default='',
+            sanitizer=Sanitizers.str
+        ),
+        self_url=dict(
+            description='The base URL of this node as listed in peers.urls',
+            default='',
+            sanitizer=Sanitizers.str
+        ),
+        timeout_seconds=dict(
+            description='The maximum amount of seconds to wait for a peer filling a cache entry before asking Google',
+            default=10.0,
+            sanitizer=Sanitizers.float
+        ),
+        urls=dict(
+            description='The base URLs of all nodes of the deployment (including this one) that fill cache misses from each other',
+            default=[],
+            sanitizer=Sanitizers.list
+        ),
+        virtual_nodes=dict(
+            description='The amount of points of every node on the consistent hash ring',
+            default=128,
+            sanitizer=Sanitizers.int
+        )
+    ),
+    upstream=dict(
+        connect_timeout_seconds=dict(
+            description='The amount of seconds to wait for a connection to Google\'s servers to be established',
+            default=5.0,
+            sanitizer=Sanitizers.float
+        ),
+        download_retries=dict(
+            description='How often failed font downloads of a single request are retried before the request fails',
+            default=2,
+            sanitizer=Sanitizers.int
+        ),
+        font_formats_by_user_agent=dict(
+            description='Whether to serve WOFF2/WOFF fonts to browsers that support them by asking Google with a matching user agent (TTF otherwise)',
+            default=True,
+            sanitizer=Sanitizers.bool
+        ),
+        http2=dict(
+            description='Whether to talk to Google\'s servers via HTTP/2 (HTTP/1.1 keep-alive otherwise)',
+            default=True,
+            sanitizer=Sanitizers.bool
+        ),
+        keepalive_expiry_seconds=dict(
+            description='The amount of seconds an idle upstream connection is kept open for reuse',
+            default=60.0,
+            sanitizer=Sanitizers.float
+        ),
+        max_concurrent_downloads=dict(
+            description='The maximum amount of concurrent upstream downloads per worker',
+            default=32,
+            sanitizer=Sanitizers.int
+        ),
+        max_concurrent_downloads_per_request=dict(
+            description='The maximum amount of font files downloaded concurrently for a single request',
+            default=8,
+            sanitizer=Sanitizers.int
+        ),
+        max_connections_per_host=dict(
+            description='The maximum amount of concurrent connections per upstream host and worker',
+            default=20,
+            sanitizer=Sanitizers.int
+        ),
+        max_keepalive_connections_per_host=dict(
+            description='The maximum amount of idle keep-alive connections per upstream host and worker',
+            default=10,
+            sanitizer=Sanitizers.int
+        ),
+        pool_timeout_seconds=dict(
+            description='The amount of seconds to wait for a free connection of the upstream connection pool',
+            default=10.0,
+            sanitizer=Sanitizers.float
+        ),
+        read_timeout_seconds=dict(
+            description='The amount of seconds to wait for data from Google\'s servers',
+            default=15.0,
+            sanitizer=Sanitizers.float
+        ),
+        single_flight_timeout_seconds=dict(
+            description='The maximum amount of seconds to wait for another worker filling the same cache entry',
+            default=30.0,
+            sanitizer=Sanitizers.float
+        )
+    ),
+    warmup=dict(
+        concurrency=dict(
+            description='The amount of stylesheets warmed up concurrently',
+            default=4,
+            sanitizer=Sanitizers.int
+        ),
+        crawl_pages=dict(
+            description='A list of site pages whose Google Fonts stylesheet links the warmup service warms up',
+            default=[],
+            sanitizer=Sanitizers.list
+        ),
+        font_formats=dict(
+            description='The font formats (ttf, woff, woff2) every stylesheet is warmed up in',
+            default=['ttf', 'woff', 'woff2'],
+            sanitizer=Sanitizers.font_formats
+        ),
+        interval_seconds=dict(
+            description='The amount of seconds between two runs of the warmup service (0 = only at startup)',
+            default=86400,
+            sanitizer=Sanitizers.int
+        ),
+        manifest_path=dict(
+            description='A file listing one stylesheet URL per line that the warmup service warms up',
+            default='',
+            sanitizer=Sanitizers.str
+        )
+    ),
 )
@@ -0,0 +1,52 @@
+from asyncio import get_running_loop
+from threading import Lock
+from time import time
+
+from gfo.config import Constants
+from gfo.exceptions import excstr
+from gfo.googlefonts.index import get_cache_index
+from gfo.logging import get_logger
+
+__GLOBAL_ACCESS_RECORDER = None
+
+class AccessRecorder(object):
+
+    '''
+        Collects cache hits of this worker in memory and writes them to
+        the cache index at most every ACCESS_STATISTICS_FLUSH_INTERVAL
+        seconds, so the eviction statistics don't cost a database write
+        per request. Within the event loop they are written by a thread,
+        so no request waits for the write.
+    '''
+
+    def __init__(self) -> None:
+        self.__accesses: dict[str, tuple[int, float]] = {}
+        self.__last_flush = time()
+        self.__lock = Lock()
+
+    def record(self, key: str) -> None:
+        now = time()
+        with self.__lock:
+            hits, _ = self.__accesses.get(key, (0, now))
+            self.__accesses[key] = (hits + 1, now)
+            if now - self.__last_flush < Constants.Internal.ACCESS_STATISTICS_FLUSH_INTERVAL:
+                return
+            accesses = self.__accesses
+            self.__accesses = {}
+            self.__last_flush = now
+        try:
+            get_running_loop().run_in_executor(None, self.__flush, accesses)
+        except RuntimeError: # not called from the event loop
+            self.__flush(accesses)
+
+    def __flush(self, accesses: dict[str, tuple[int, float]]) -> None:
+        try:
+            get_cache_index().record_accesses(accesses)
+        except Exception as exc:
+            get_logger().warn(f'Failed to record {len(accesses)} cache accesses. {excstr(exc)}')
+
+def get_access_recorder() -> AccessRecorder:
+    global __GLOBAL_ACCESS_RECORDER
+    if __GLOBAL_ACCESS_RECORDER is None:
+        __GLOBAL_ACCESS_RECORDER = AccessRecorder()
+    return __GLOBAL_ACCESS_RECORDER
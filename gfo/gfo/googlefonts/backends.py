@@ -0,0 +1,212 @@
+from asyncio import sleep
+from contextlib import asynccontextmanager
+from json import dumps as json_dumps, loads as json_loads
+from secrets import token_hex
+from time import monotonic, time
+from typing import AsyncIterator, Union
+
+from gfo.config import from_config
+from gfo.exceptions import excstr
+from gfo.googlefonts.index import CacheIndexEntry
+from gfo.googlefonts.memory_cache import LRUCache
+from gfo.logging import get_logger
+
+try:
+    from redis.asyncio import Redis
+    from redis.asyncio.retry import Retry
+    from redis.backoff import NoBackoff
+except ImportError: # redis is optional, only the redis cache backend needs it
+    Redis = None
+
+CACHE_BACKEND_FILESYSTEM = 'filesystem'
+CACHE_BACKEND_MEMORY = 'memory'
+CACHE_BACKEND_REDIS = 'redis'
+
+REDIS_KEY_PREFIX = 'gfo:'
+
+'''
+    Deletes a lock only if it still holds the token of its owner, so an
+    expired lock that was taken over meanwhile is not released
+'''
+REDIS_RELEASE_LOCK_SCRIPT = '''
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+'''
+
+__GLOBAL_CACHE_BACKEND = None
+
+def pack_entry(entry: CacheIndexEntry, content: bytes) -> bytes:
+    '''
+        The index entry as a JSON line, followed by the content
+    '''
+    header = json_dumps({column: getattr(entry, column) for column in CacheIndexEntry.COLUMNS})
+    return header.encode('utf-8') + b'\n' + content
+
+def unpack_entry(payload: bytes) -> tuple[CacheIndexEntry, bytes]:
+    header, _, content = payload.partition(b'\n')
+    return CacheIndexEntry(**json_loads(header)), content
+
+class CacheBackend(object):
+
+    '''
+        Shares cache entries (index entry and content) with the other
+        nodes of a deployment and coordinates their cache fills. Workers
+        look up a backend before asking Google and store what they
+        fetched in it. The node's own font cache directory stays the
+        tier requests are served from.
+    '''
+
+    name: str = None
+
+    async def get(self, key: str) -> Union[tuple[CacheIndexEntry, bytes], None]:
+        return None
+
+    async def put(self, entry: CacheIndexEntry, content: bytes) -> None:
+        pass
+
+    @asynccontextmanager
+    async def lock(self, key: str) -> AsyncIterator[None]:
+        '''
+            Serializes the fill of a key across nodes. Workers of the same
+            node are serialized by the single-flight lock files anyway.
+        '''
+        yield
+
+    async def close(self) -> None:
+        pass
+
+class FilesystemCacheBackend(CacheBackend):
+
+    '''
+        Shares nothing beyond the node's font cache directory
+    '''
+
+    name = CACHE_BACKEND_FILESYSTEM
+
+class MemoryCacheBackend(CacheBackend):
+
+    '''
+        Keeps the entries of this worker in an LRU cache bounded by
+        cache.backend_memory_max_bytes and cache.backend_memory_max_entries,
+        so entries lost from the font cache directory (e.g. by eviction)
+        are restored without asking Google
+    '''
+
+    name = CACHE_BACKEND_MEMORY
+
+    def __init__(self) -> None:
+        self.__entries = LRUCache(
+            max_bytes=from_config('cache', 'backend_memory_max_bytes'),
+            max_entries=from_config('cache', 'backend_memory_max_entries')
+        )
+
+    async def get(self, key: str) -> Union[tuple[CacheIndexEntry, bytes], None]:
+        return self.__entries.get(key)
+
+    async def put(self, entry: CacheIndexEntry, content: bytes) -> None:
+        self.__entries.set(key=entry.key, value=(entry, content), size=len(content), expires_at=entry.expires_at)
+
+class RedisCacheBackend(CacheBackend):
+
+    '''
+        Shares the entries with all nodes through Redis (cache.redis_url),
+        each expiring along with its entry. Fills are serialized across
+        nodes by a lock per key that expires after
+        upstream.single_flight_timeout_seconds, so a crashed node never
+        blocks the others for longer. Commands are retried once on a
+        dropped connection, so a lock is not left to expire because its
+        release hit one. Redis failures never fail a request: the worker
+        fills the entry on its own then.
+    '''
+
+    name = CACHE_BACKEND_REDIS
+
+    def __init__(self, url: str) -> None:
+        self.url = url
+        self.timeout: float = from_config('upstream', 'single_flight_timeout_seconds')
+        self.__redis = Redis.from_url(url, retry=Retry(NoBackoff(), 1))
+
+    async def get(self, key: str) -> Union[tuple[CacheIndexEntry, bytes], None]:
+        try:
+            payload = await self.__redis.get(f'{REDIS_KEY_PREFIX}entry:{key}')
+        except Exception as exc:
+            get_logger().warn(f'Failed to look up cache entry "{key}" in Redis. {excstr(exc)}')
+            return None
+        if payload is None:
+            return None
+        return unpack_entry(payload)
+
+    async def put(self, entry: CacheIndexEntry, content: bytes) -> None:
+        ttl = int(entry.expires_at - time())
+        if ttl < 1:
+            return
+        try:
+            await self.__redis.set(f'{REDIS_KEY_PREFIX}entry:{entry.key}', pack_entry(entry, content), ex=ttl)
+        except Exception as exc:
+            get_logger().warn(f'Failed to share cache entry "{entry.key}" via Redis. {excstr(exc)}')
+
+    @asynccontextmanager
+    async def lock(self, key: str) -> AsyncIterator[None]:
+        lock_key = f'{REDIS_KEY_PREFIX}lock:{key}'
+        token = token_hex(16)
+        locked = False
+        try:
+            deadline = monotonic() + self.timeout
+            delay = .005
+            while 1:
+                locked = await self.__redis.set(lock_key, token, nx=True, px=int(self.timeout * 1000))
+                if locked:
+                    break
+                if monotonic() > deadline:
+                    get_logger().warn(
+                        f'Waited more than {self.timeout}s for the Redis fill lock '
+                        f'of key "{key}" - filling without it'
+                    )
+                    break
+                await sleep(delay)
+                delay = min(delay * 2, .1)
+        except Exception as exc:
+            get_logger().warn(f'Failed to acquire the Redis fill lock of key "{key}" - filling without it. {excstr(exc)}')
+        try:
+            yield
+        finally:
+            if locked:
+                await self.__release(key=key, lock_key=lock_key, token=token)
+
+    async def __release(self, key: str, lock_key: str, token: str) -> None:
+        '''
+            Releases a lock atomically by a script. Servers without Lua
+            (e.g. with scripting disabled) release it by comparing and
+            deleting instead, which only races with the expiry of the lock,
+            so other nodes don't wait for that expiry.
+        '''
+        try:
+            await self.__redis.eval(REDIS_RELEASE_LOCK_SCRIPT, 1, lock_key, token)
+            return
+        except Exception as exc:
+            get_logger().debug(f'Failed to release the Redis fill lock of key "{key}" by script - releasing it without. {excstr(exc)}')
+        try:
+            if await self.__redis.get(lock_key) == token.encode('utf-8'):
+                await self.__redis.delete(lock_key)
+        except Exception as exc:
+            get_logger().warn(f'Failed to release the Redis fill lock of key "{key}". {excstr(exc)}')
+
+    async def close(self) -> None:
+        await self.__redis.aclose()
+
+def get_cache_backend() -> CacheBackend:
+    global __GLOBAL_CACHE_BACKEND
+    if __GLOBAL_CACHE_BACKEND is None:
+        backend = from_config('cache', 'backend')
+        if backend == CACHE_BACKEND_REDIS and Redis is None:
+            get_logger().warn('cache.backend is redis, but the redis package is not installed - using the filesystem backend')
+            backend = CACHE_BACKEND_FILESYSTEM
+        if backend == CACHE_BACKEND_REDIS:
+            __GLOBAL_CACHE_BACKEND = RedisCacheBackend(url=from_config('cache', 'redis_url'))
+        elif backend == CACHE_BACKEND_MEMORY:
+            __GLOBAL_CACHE_BACKEND = MemoryCacheBackend()
+        else:
+            __GLOBAL_CACHE_BACKEND = FilesystemCacheBackend()
+    return __GLOBAL_CACHE_BACKEND
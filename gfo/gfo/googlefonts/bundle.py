@@ -0,0 +1,126 @@
+from os import stat
+from tarfile import TarInfo, open as open_tar
+from time import localtime, time
+from typing import Iterator
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile, ZipInfo
+
+from gfo.config import Constants
+
+try:
+    from zstandard import ZstdCompressor
+except ImportError: # zstandard is optional, tar.zst bundles are unavailable without it
+    ZstdCompressor = None
+
+BUNDLE_FORMAT_TAR_GZ = 'tar.gz'
+BUNDLE_FORMAT_TAR_ZST = 'tar.zst'
+BUNDLE_FORMAT_ZIP = 'zip'
+
+'''
+    Font files that are compressed already and stored as they are
+'''
+COMPRESSED_FONT_SIGNATURES = (b'wOFF', b'wOF2')
+
+def get_bundle_formats() -> tuple[str, ...]:
+    if ZstdCompressor is None:
+        return (BUNDLE_FORMAT_TAR_GZ, BUNDLE_FORMAT_ZIP)
+    return (BUNDLE_FORMAT_TAR_GZ, BUNDLE_FORMAT_TAR_ZST, BUNDLE_FORMAT_ZIP)
+
+class ChunkSink(object):
+
+    '''
+        An unseekable, write-only file object collecting the output of
+        an archive writer until it is drained. zipfile falls back to data
+        descriptors and tarfile's stream mode never seeks, so archives
+        can be emitted chunk by chunk while they are written.
+    '''
+
+    def __init__(self) -> None:
+        self.__chunks: list[bytes] = []
+
+    def write(self, data: bytes) -> int:
+        if data:
+            self.__chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> Iterator[bytes]:
+        chunks, self.__chunks = self.__chunks, []
+        if chunks:
+            yield b''.join(chunks)
+
+class ChunkReader(object):
+
+    '''
+        Minimal readable file object over in-memory bytes for tarfile
+    '''
+
+    def __init__(self, data: bytes) -> None:
+        self.data = data
+        self.offset = 0
+
+    def read(self, size: int = -1) -> bytes:
+        end = len(self.data) if size < 0 else self.offset + size
+        chunk = self.data[self.offset:end]
+        self.offset += len(chunk)
+        return chunk
+
+def iter_zip_bundle(css: bytes, font_files: dict[str, str]) -> Iterator[bytes]:
+    sink = ChunkSink()
+    chunk_size = Constants.Internal.BUNDLE_CHUNK_SIZE
+    with ZipFile(sink, mode='w', compression=ZIP_DEFLATED) as archive:
+        info = ZipInfo('fonts.css', date_time=localtime(time())[:6])
+        info.compress_type = ZIP_DEFLATED
+        archive.writestr(info, css)
+        yield from sink.drain()
+        for name, path in font_files.items():
+            info = ZipInfo(name, date_time=localtime(stat(path).st_mtime)[:6])
+            with open(path, 'rb') as font_file:
+                chunk = font_file.read(chunk_size)
+                info.compress_type = ZIP_STORED if chunk[:4] in COMPRESSED_FONT_SIGNATURES else ZIP_DEFLATED
+                with archive.open(info, mode='w') as member:
+                    while chunk:
+                        member.write(chunk)
+                        yield from sink.drain()
+                        chunk = font_file.read(chunk_size)
+            yield from sink.drain()
+    yield from sink.drain()
+
+def iter_tar_bundle(css: bytes, font_files: dict[str, str], archive_format: str) -> Iterator[bytes]:
+    sink = ChunkSink()
+    target = sink
+    mode = 'w|gz'
+    if archive_format == BUNDLE_FORMAT_TAR_ZST:
+        target = ZstdCompressor().stream_writer(sink, closefd=False)
+        mode = 'w|'
+    with open_tar(fileobj=target, mode=mode) as archive:
+        info = TarInfo('fonts.css')
+        info.size = len(css)
+        info.mtime = int(time())
+        archive.addfile(info, ChunkReader(css))
+        yield from sink.drain()
+        for name, path in font_files.items():
+            with open(path, 'rb') as font_file:
+                info = archive.gettarinfo(fileobj=font_file, arcname=name)
+                info.uid = info.gid = 0
+                info.uname = info.gname = ''
+                archive.addfile(info, font_file)
+            yield from sink.drain()
+    if target is not sink:
+        target.close()
+    yield from sink.drain()
+
+def iter_bundle(css: bytes, font_files: dict[str, str], archive_format: str) -> Iterator[bytes]:
+
+    '''
+        Streams a bundle archive of a stylesheet (as fonts.css) and the
+        given font files (archive name -> cache path). Font files are read
+        straight from the cache in chunks of BUNDLE_CHUNK_SIZE, so memory
+        stays bounded by roughly one chunk (one font file for tar) and
+        the first bytes are available immediately.
+    '''
+
+    if archive_format == BUNDLE_FORMAT_ZIP:
+        return iter_zip_bundle(css=css, font_files=font_files)
+    return iter_tar_bundle(css=css, font_files=font_files, archive_format=archive_format)
@@ -0,0 +1,64 @@
+from asyncio import Semaphore
+from httpx import AsyncClient, Limits, Response as HTTPResponse, Timeout
+from typing import Union
+from urllib.parse import urlsplit
+
+from gfo.config import from_config
+
+__GLOBAL_UPSTREAM_CLIENT = None
+
+class UpstreamClient(object):
+
+    '''
+        Asynchronous HTTP client for Google's font servers. One
+        persistent keep-alive connection pool (HTTP/2 if enabled)
+        is kept per upstream host, so repeated cache misses reuse
+        the already established TCP+TLS connections instead of
+        performing a new handshake for every single download. The
+        amount of concurrent requests of this worker is bounded by
+        upstream.max_concurrent_downloads.
+    '''
+
+    def __init__(self) -> None:
+        self.http2: bool = from_config('upstream', 'http2')
+        self.limits = Limits(
+            max_connections=from_config('upstream', 'max_connections_per_host'),
+            max_keepalive_connections=from_config('upstream', 'max_keepalive_connections_per_host'),
+            keepalive_expiry=from_config('upstream', 'keepalive_expiry_seconds')
+        )
+        self.timeout = Timeout(
+            connect=from_config('upstream', 'connect_timeout_seconds'),
+            read=from_config('upstream', 'read_timeout_seconds'),
+            write=from_config('upstream', 'read_timeout_seconds'),
+            pool=from_config('upstream', 'pool_timeout_seconds')
+        )
+        self.download_slots = Semaphore(from_config('upstream', 'max_concurrent_downloads'))
+        self.__clients: dict[str, AsyncClient] = {}
+
+    def __get_client(self, host: str) -> AsyncClient:
+        client = self.__clients.get(host)
+        if client is None:
+            client = AsyncClient(
+                http2=self.http2,
+                limits=self.limits,
+                timeout=self.timeout,
+                follow_redirects=True
+            )
+            self.__clients[host] = client
+        return client
+
+    async def get(self, url: str, headers: Union[dict, None] = None) -> HTTPResponse:
+        async with self.download_slots:
+            return await self.__get_client(urlsplit(url).netloc).get(url, headers=headers)
+
+    async def close(self) -> None:
+        clients = list(self.__clients.values())
+        self.__clients.clear()
+        for client in clients:
+            await client.aclose()
+
+def get_upstream_client() -> UpstreamClient:
+    global __GLOBAL_UPSTREAM_CLIENT
+    if __GLOBAL_UPSTREAM_CLIENT is None:
+        __GLOBAL_UPSTREAM_CLIENT = UpstreamClient()
+    return __GLOBAL_UPSTREAM_CLIENT
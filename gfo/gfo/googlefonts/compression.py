@@ -0,0 +1,81 @@
+from gzip import compress as gzip_compress
+from os import remove
+from typing import Union
+
+from gfo.config import Constants, from_config
+
+try:
+    from brotli import compress as brotli_compress
+except ImportError: # brotli is optional, gzip is always available
+    brotli_compress = None
+
+'''
+    Content codings in order of preference and the suffixes of their
+    sidecar files next to the cached files
+'''
+ENCODINGS = ('br', 'gzip')
+SIDECAR_SUFFIXES = dict(br='.br', gzip='.gz')
+
+def precompress(content: bytes, cached: bool = True) -> dict[str, bytes]:
+
+    '''
+        Compresses the content once with every available coding. Nothing
+        is returned for content below cache.precompression_min_bytes or
+        content that gzip can't shrink (e.g. WOFF/WOFF2 fonts, which are
+        compressed already). Content that is not cached (cached=False)
+        is compressed for every response, so it gets cheap levels instead
+        of the best ones.
+    '''
+
+    if len(content) < from_config('cache', 'precompression_min_bytes'):
+        return {}
+    gzip_level, brotli_quality = (
+        (Constants.Internal.PRECOMPRESSION_GZIP_LEVEL, Constants.Internal.PRECOMPRESSION_BROTLI_QUALITY)
+        if cached else
+        (Constants.Internal.ON_THE_FLY_COMPRESSION_GZIP_LEVEL, Constants.Internal.ON_THE_FLY_COMPRESSION_BROTLI_QUALITY)
+    )
+    variants = dict(gzip=gzip_compress(content, compresslevel=gzip_level, mtime=0))
+    if len(variants['gzip']) >= len(content):
+        return {}
+    if brotli_compress is not None:
+        variants['br'] = brotli_compress(content, quality=brotli_quality)
+    return variants
+
+def negotiate_encodings(accept_encoding: Union[str, None], available: tuple[str, ...] = ENCODINGS) -> list[str]:
+
+    '''
+        The available codings the client accepts according to its
+        Accept-Encoding header, best first. Ties are broken by the order
+        of ENCODINGS.
+    '''
+
+    if not accept_encoding:
+        return []
+    qualities = {}
+    for coding in accept_encoding.split(','):
+        name, *params = coding.strip().split(';')
+        quality = 1.0
+        for param in params:
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[name.strip().lower()] = quality
+    wildcard = qualities.get('*', 0.0)
+    accepted = [
+        (qualities.get(encoding, wildcard), -ENCODINGS.index(encoding), encoding)
+        for encoding in available
+    ]
+    return [encoding for quality, _, encoding in sorted(accepted, reverse=True) if quality > 0]
+
+def sidecar_path(path: str, encoding: str) -> str:
+    return f'{path}{SIDECAR_SUFFIXES[encoding]}'
+
+def remove_sidecars(path: str) -> None:
+    for encoding in ENCODINGS:
+        try:
+            remove(sidecar_path(path, encoding))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,265 @@
+from re import DOTALL, IGNORECASE, VERBOSE, compile as re_compile
+from typing import Callable, Union
+
+'''
+    The tokens of a stylesheet that matter for rewriting it. Strings and
+    comments are matched as tokens of their own so that e.g. "url(" within
+    a comment is never mistaken for a font location. The lookahead lets
+    the scanner skip all other characters without trying every token.
+'''
+TOKENS = re_compile(
+    r'''
+        (?=[/uU"'@}])
+        (?:
+            (?P<comment>/\*.*?(?:\*/|$))
+          | (?P<url>(?i:url)\(\s*(?:"(?P<double_quoted>[^"]*)"|'(?P<single_quoted>[^']*)'|(?P<unquoted>[^)"'\s]*))\s*\))
+          | (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+          | (?P<font_face>(?i:@font-face)\s*\{)
+          | (?P<block_end>\})
+        )
+    ''',
+    VERBOSE | DOTALL
+)
+DECLARATION = re_compile(
+    r'''(?P<name>[-a-zA-Z]+)\s*:\s*(?P<value>(?:"[^"]*"|'[^']*'|url\([^)]*\)|[^;}"'])*)''',
+    DOTALL
+)
+SOURCE = re_compile(
+    r'''
+        url\(\s*(?:"(?P<url_double_quoted>[^"]*)"|'(?P<url_single_quoted>[^']*)'|(?P<url_unquoted>[^)"'\s]*))\s*\)
+        (?:\s*format\(\s*["']?(?P<format>[^"')]*?)["']?\s*\))?
+      | local\(\s*["']?(?P<local>[^"')]*?)["']?\s*\)
+    ''',
+    VERBOSE | IGNORECASE
+)
+
+def parse_unicode_range(value: str) -> list[tuple[int, int]]:
+    '''
+        The (first, last) code points of a unicode-range descriptor,
+        e.g. "U+0000-00FF, U+4??"
+    '''
+    ranges = []
+    for part in value.split(','):
+        part = part.strip().upper().removeprefix('U+')
+        first, _, last = part.partition('-')
+        try:
+            if '?' in first:
+                ranges.append((int(first.replace('?', '0'), 16), int(first.replace('?', 'F'), 16)))
+            else:
+                ranges.append((int(first, 16), int(last or first, 16)))
+        except ValueError:
+            continue
+    return ranges
+
+def unquote(value: str) -> str:
+    value = value.strip()
+    if len(value) > 1 and value[0] == value[-1] and value[0] in '"\'':
+        return value[1:-1]
+    return value
+
+class FontSource(object):
+
+    '''
+        A single entry of a src descriptor: either a font location with
+        an optional format hint or a local() font name
+    '''
+
+    def __init__(self, url: Union[str, None] = None, format: Union[str, None] = None, local: Union[str, None] = None) -> None:
+        self.url = url
+        self.format = format
+        self.local = local
+
+class FontFace(object):
+
+    '''
+        An @font-face block. start and end are its offsets in the
+        stylesheet, including the comment right before it (e.g. the
+        subset comment Google puts there). Its declarations are only
+        parsed when they are accessed, so plain URL rewrites don't pay
+        for them.
+    '''
+
+    def __init__(self, css: str, start: int, body_start: int, body_end: int, end: int) -> None:
+        self.css = css
+        self.start = start
+        self.body_start = body_start
+        self.body_end = body_end
+        self.end = end
+        self.__declarations: Union[dict[str, str], None] = None
+
+    @property
+    def declarations(self) -> dict[str, str]:
+        if self.__declarations is None:
+            self.__declarations = {
+                declaration.group('name').lower(): declaration.group('value').strip()
+                for declaration in DECLARATION.finditer(self.css, self.body_start, self.body_end)
+            }
+        return self.__declarations
+
+    @property
+    def family(self) -> str:
+        return unquote(self.declarations.get('font-family', ''))
+
+    @property
+    def style(self) -> str:
+        return self.declarations.get('font-style', 'normal')
+
+    @property
+    def weight(self) -> str:
+        return self.declarations.get('font-weight', '400')
+
+    @property
+    def unicode_range(self) -> Union[str, None]:
+        return self.declarations.get('unicode-range') or None
+
+    def covered(self, text: str) -> str:
+        '''
+            The characters of text the browser uses this block for (all
+            of them without unicode-range)
+        '''
+        if self.unicode_range is None:
+            return text
+        ranges = parse_unicode_range(self.unicode_range)
+        return ''.join(char for char in text if any(first <= ord(char) <= last for first, last in ranges))
+
+    @property
+    def sources(self) -> list[FontSource]:
+        return [
+            FontSource(
+                url=match.group('url_double_quoted') or match.group('url_single_quoted') or match.group('url_unquoted'),
+                format=match.group('format') or None
+            ) if match.group('local') is None else FontSource(local=match.group('local'))
+            for match in SOURCE.finditer(self.declarations.get('src', ''))
+        ]
+
+class Stylesheet(object):
+
+    '''
+        A stylesheet split into a template of literal segments and url()
+        slots between them, plus its @font-face blocks. Rewriting the
+        font locations is a single join over the template.
+    '''
+
+    def __init__(
+        self,
+        css: str,
+        segments: list[str],
+        urls: list[str],
+        quotes: list[str],
+        font_faces: list[FontFace]
+    ) -> None:
+        self.css = css
+        self.segments = segments
+        self.urls = urls
+        self.quotes = quotes
+        self.font_faces = font_faces
+
+    @property
+    def formats(self) -> dict[str, str]:
+        '''
+            The format hint of every font location that has one
+        '''
+        return {
+            source.url: source.format.lower()
+            for font_face in self.font_faces
+            for source in font_face.sources
+            if source.url is not None and source.format is not None
+        }
+
+    def render(self, replace: Callable[[str, str], str]) -> str:
+        '''
+            Joins the template, replacing every url() token (including
+            "url(" and ")") by replace(url, quote)
+        '''
+        parts = [self.segments[0]]
+        for url, quote, segment in zip(self.urls, self.quotes, self.segments[1:]):
+            parts.append(replace(url, quote))
+            parts.append(segment)
+        return ''.join(parts)
+
+    def rewrite_urls(self, url_for: Callable[[str], str]) -> str:
+        return self.render(lambda url, quote: f'url({quote}{url_for(url)}{quote})')
+
+    def select_font_faces(self, keep: Callable[[FontFace], bool]) -> str:
+        '''
+            The stylesheet without the @font-face blocks (and their
+            comments) that keep rejects
+        '''
+        parts = []
+        position = 0
+        for font_face in self.font_faces:
+            if keep(font_face):
+                continue
+            parts.append(self.css[position:font_face.start])
+            position = font_face.end
+            if self.css.startswith('\n', position):
+                position += 1
+        parts.append(self.css[position:])
+        return ''.join(parts)
+
+    def set_font_display(self, display: str) -> str:
+        '''
+            Sets the font-display descriptor of every @font-face block,
+            replacing the one it has or appending it to the block
+        '''
+        parts = []
+        position = 0
+        for font_face in self.font_faces:
+            for declaration in DECLARATION.finditer(self.css, font_face.body_start, font_face.body_end):
+                if declaration.group('name').lower() == 'font-display':
+                    parts.append(self.css[position:declaration.start('value')])
+                    parts.append(display)
+                    position = declaration.end('value')
+                    break
+            else:
+                body = self.css[font_face.body_start:font_face.body_end].rstrip()
+                body_end = font_face.body_start + len(body)
+                parts.append(self.css[position:body_end])
+                parts.append(f'{"" if body.endswith(";") or not body else ";"}\n  font-display: {display};\n')
+                position = font_face.body_end
+        parts.append(self.css[position:])
+        return ''.join(parts)
+
+def parse_stylesheet(css: str) -> Stylesheet:
+
+    '''
+        Tokenizes the stylesheet in a single pass
+    '''
+
+    segments = []
+    urls = []
+    quotes = []
+    font_faces = []
+    position = 0
+    comment = None
+    font_face_start = None
+    font_face_body_start = None
+    for token in TOKENS.finditer(css):
+        kind = token.lastgroup
+        if kind == 'url':
+            segments.append(css[position:token.start()])
+            position = token.end()
+            for group, quote in (('double_quoted', '"'), ('single_quoted', '\''), ('unquoted', '')):
+                if token.group(group) is not None:
+                    urls.append(token.group(group))
+                    quotes.append(quote)
+                    break
+        elif kind == 'font_face' and font_face_start is None:
+            font_face_start = token.start()
+            if comment is not None and css[comment.end():token.start()].strip() == '':
+                font_face_start = comment.start()
+            font_face_body_start = token.end()
+        elif kind == 'block_end' and font_face_start is not None:
+            font_faces.append(
+                FontFace(
+                    css=css,
+                    start=font_face_start,
+                    body_start=font_face_body_start,
+                    body_end=token.start(),
+                    end=token.end()
+                )
+            )
+            font_face_start = None
+        comment = token if kind == 'comment' else None
+    segments.append(css[position:])
+    return Stylesheet(css=css, segments=segments, urls=urls, quotes=quotes, font_faces=font_faces)
@@ -1,30 +1,153 @@
+from asyncio import Semaphore, Task, create_task, gather, to_thread
 from hashlib import md5 as hash_md5
-from io import BytesIO
+from httpx import Response as HTTPResponse
 from os import mkdir, remove
-from os.path import basename, getmtime, isdir, isfile, join as join_path
-from requests import get as http_get
-from shutil import copy as copy_file, make_archive, move
-from tempfile import NamedTemporaryFile, TemporaryDirectory
+from os.path import isdir, join as join_path
 from time import time
-from typing import Union
-from urllib.parse import urlencode, quote_plus
+from typing import Any, Awaitable, Callable, Iterable, Iterator, Union
+from urllib.parse import quote, quote_plus, unquote, urlencode
 
 from gfo.config import from_config
 from gfo.exceptions import excstr
 from gfo.exceptions.googlefonts import GGoogleFontsException, GGoogleFontsBadRequestException
+from gfo.googlefonts.access import get_access_recorder
+from gfo.googlefonts.backends import get_cache_backend
+from gfo.googlefonts.bundle import BUNDLE_FORMAT_ZIP, iter_bundle
+from gfo.googlefonts.client import get_upstream_client
+from gfo.googlefonts.compression import precompress
+from gfo.googlefonts.css import Stylesheet, parse_stylesheet
+from gfo.googlefonts.families import FONT_DISPLAY_VALUES, normalize_css2_families
+from gfo.googlefonts.formats import FONT_FORMAT_TTF, FONT_FORMAT_USER_AGENTS
+from gfo.googlefonts.index import CacheIndexEntry, ENTRY_KIND_BUNDLE, ENTRY_KIND_CSS, ENTRY_KIND_FONT, ENTRY_KIND_SUBSET, get_cache_index
+from gfo.googlefonts.memory_cache import get_css_memory_cache
+from gfo.googlefonts.open_files import OpenFile, get_open_file_cache
+from gfo.googlefonts.peers import get_peer_fill
+from gfo.googlefonts.singleflight import get_single_flight
+from gfo.googlefonts.storage import get_font_store
+from gfo.googlefonts.subsetting import get_font_subsetter
+from gfo.googlefonts.transcoding import WOFF2_SUFFIX, get_woff2_transcoder, transcoded_path
 from gfo.libaccelerate.helpers import get_id
 from gfo.logging import get_logger
 
 def md5(s: str) -> str:
     return hash_md5(s.encode('utf-8') if isinstance(s, str) else s).hexdigest()
 
+def remove_if_exists(path: str) -> None:
+    try:
+        remove(path)
+    except FileNotFoundError:
+        pass
+
+def extract_font_urls(stylesheet: Stylesheet) -> dict[str, str]:
+    return {md5(font_url): font_url for font_url in stylesheet.urls}
+
+def css_cache_key(url: str, font_format: str) -> str:
+
+    '''
+        Stylesheets are cached per font format, as Google serves different
+        stylesheets (and font files) depending on the user agent. TrueType
+        stylesheets keep the plain md5 of their URL as key.
+    '''
+
+    return md5(url) if font_format == FONT_FORMAT_TTF else md5(f'{font_format}:{url}')
+
+def rendition_cache_key(url: str, font_format: str, display: Union[str, None], text: Union[str, None]) -> str:
+
+    '''
+        The memory cache key of the stylesheet served for the stylesheet
+        at url with display and text applied locally
+    '''
+
+    return css_cache_key(url=f'{url}#{urlencode(dict(display=display or "", text=text or ""))}', font_format=font_format)
+
+def css2_url(families: Iterable[str], display: Union[str, None], text: Union[str, None]) -> str:
+    google_fonts_url_params = [('family', family) for family in families]
+    if display is not None:
+        google_fonts_url_params.append(('display', display))
+    if text is not None:
+        google_fonts_url_params.append(('text', text))
+    return 'https://fonts.googleapis.com/css2?' + urlencode(google_fonts_url_params, quote_via=quote_plus)
+
+def parse_max_age(cache_control: Union[str, None]) -> Union[int, None]:
+
+    '''
+        Extracts the lifespan in seconds from a Cache-Control header.
+        s-maxage takes precedence over max-age as this is a shared cache,
+        no-cache and no-store yield 0. Google marks its stylesheets
+        private because they depend on the user agent, which does not
+        apply here since they are fetched with our own user agent.
+    '''
+
+    if not cache_control:
+        return None
+    directives = {}
+    for directive in cache_control.split(','):
+        name, _, value = directive.strip().partition('=')
+        directives[name.strip().lower()] = value.strip().strip('"')
+    if 'no-cache' in directives or 'no-store' in directives:
+        return 0
+    for name in ('s-maxage', 'max-age'):
+        try:
+            return max(int(directives[name]), 0)
+        except (KeyError, ValueError):
+            continue
+    return None
+
+def get_lifespan(response: HTTPResponse) -> int:
+
+    '''
+        The amount of seconds a response may be cached - its upstream
+        max-age minus its age with cache.honour_upstream_max_age,
+        misc.cache_lifespan_seconds otherwise or without max-age
+    '''
+
+    if from_config('cache', 'honour_upstream_max_age'):
+        max_age = parse_max_age(response.headers.get('cache-control'))
+        if max_age is not None:
+            try:
+                age = int(response.headers.get('age', 0))
+            except ValueError:
+                age = 0
+            return max(max_age - age, 0)
+    return from_config('misc', 'cache_lifespan_seconds')
+
+'''
+    Upstream only answers requests carrying a validator with 304 Not
+    Modified, any other 304 is an error
+'''
+CONDITIONAL_REQUEST_HEADERS = ('If-None-Match', 'If-Modified-Since')
+
 __GLOBAL_GOOGLE_FONTS_DOWNLOADER = None
 
+class RewrittenStylesheet(object):
+
+    '''
+        A stylesheet whose font locations point to this server, encoded
+        and precompressed once and identified by a strong ETag of its
+        content. Stylesheets that are not kept in memory (cached=False)
+        are built for every response, so they are compressed cheaply.
+    '''
+
+    def __init__(self, css: str, cached: bool = True) -> None:
+        self.content = css.encode('utf-8')
+        self.checksum = md5(self.content)
+        self.etag = f'"{self.checksum}"'
+        self.variants = precompress(self.content, cached=cached)
+
+    @property
+    def css(self) -> str:
+        return self.content.decode('utf-8')
+
+    @property
+    def size(self) -> int:
+        return len(self.content) + sum(len(variant) for variant in self.variants.values())
+
 class GoogleFontsDownloader(object):
 
     def __init__(self) -> None:
         self.storage_path = from_config('misc', 'font_cache_dir')
-        self.storage_staging_path = join_path(self.storage_path, f'stage-{get_id(6)}')
+        self.__revalidating: set[str] = set()
+        self.__background_tasks: set[Task] = set()
         if not isdir(self.storage_path):
             try:
                 mkdir(self.storage_path)
@@ -32,21 +155,23 @@ class GoogleFontsDownloader(object):
                 raise GGoogleFontsException(
                     f'Failed to create font storage path "{self.storage_path}". {excstr(exc)}'
                 )
-        if not isdir(self.storage_staging_path):
-            try:
-                mkdir(self.storage_staging_path)
-            except Exception as exc:
-                raise GGoogleFontsException(
-                    f'Failed to create font storage path "{self.storage_staging_path}". {excstr(exc)}'
-                )
+        self.store = get_font_store()
+        try:
+            self.storage_staging_path = self.store.staging_path(get_id(6))
+        except Exception as exc:
+            raise GGoogleFontsException(
+                f'Failed to create font staging path in "{self.storage_path}". {excstr(exc)}'
+            )
 
-    def __download(self, from_url: str) -> str:
+    async def __download(self, from_url: str, headers: Union[dict, None] = None) -> HTTPResponse:
         try:
-            req = http_get(url=from_url)
+            req = await get_upstream_client().get(url=from_url, headers=headers)
         except Exception as exc:
             raise GGoogleFontsException(
                 f'Failed to download content from URL "{from_url}". {excstr(exc)}'
             )
+        if req.status_code == 304 and any(header in (headers or {}) for header in CONDITIONAL_REQUEST_HEADERS):
+            return req
         if req.status_code < 200 or req.status_code > 299:
             if req.status_code == 400:
                 raise GGoogleFontsBadRequestException(
@@ -57,177 +182,879 @@ class GoogleFontsDownloader(object):
                 f'The received status code of the font at URL "{from_url}" '
                 f'was not in range 200-299. Received code: {req.status_code}'
             )
-        return req.content
+        return req
+
+    def __conditional_headers(self, entry: Union[CacheIndexEntry, None]) -> dict:
+        '''
+            The validators to revalidate an expired entry with, as long as
+            its file is still there
+        '''
+        headers = {}
+        if not self.store.exists(entry):
+            return headers
+        if entry.etag:
+            headers['If-None-Match'] = entry.etag
+        if entry.last_modified:
+            headers['If-Modified-Since'] = entry.last_modified
+        return headers
+
+    def __extend(self, entry: CacheIndexEntry, response: HTTPResponse) -> CacheIndexEntry:
+        '''
+            Upstream confirmed the cached content (304), so only its
+            validators and expiry are updated (off the event loop, as it
+            writes to the cache index)
+        '''
+        fetched_at = time()
+        entry = CacheIndexEntry(
+            key=entry.key,
+            kind=entry.kind,
+            url=entry.url,
+            size=entry.size,
+            checksum=entry.checksum,
+            content_type=entry.content_type,
+            etag=response.headers.get('etag', entry.etag),
+            last_modified=response.headers.get('last-modified', entry.last_modified),
+            fetched_at=fetched_at,
+            expires_at=fetched_at + get_lifespan(response),
+            encodings=entry.encodings
+        )
+        get_cache_index().put(entry)
+        return entry
+
+    async def __store(
+        self,
+        key: str,
+        kind: str,
+        url: str,
+        response: HTTPResponse,
+        variants: Union[dict[str, bytes], None] = None
+    ) -> CacheIndexEntry:
+        content = response.content
+        fetched_at = time()
+        entry = CacheIndexEntry(
+            key=key,
+            kind=kind,
+            url=url,
+            size=len(content),
+            checksum=md5(content),
+            content_type=response.headers.get('content-type'),
+            etag=response.headers.get('etag'),
+            last_modified=response.headers.get('last-modified'),
+            fetched_at=fetched_at,
+            expires_at=fetched_at + get_lifespan(response)
+        )
+        return await to_thread(self.__commit, entry=entry, content=content, variants=variants)
+
+    def __commit(
+        self,
+        entry: CacheIndexEntry,
+        content: bytes,
+        variants: Union[dict[str, bytes], None] = None
+    ) -> CacheIndexEntry:
+        '''
+            Writes the content to this worker's staging directory first and
+            then commits it to the font store, so that no reader (in any
+            worker) ever sees a partially written file. Blocks on the blob
+            lock of the store, so it must not run on the event loop.
+        '''
+        staging_path = join_path(self.storage_staging_path, entry.key)
+        with open(staging_path, 'wb') as staging_file:
+            staging_file.write(content)
+        self.store.commit(entry=entry, staged_path=staging_path, variants=variants)
+        return entry
+
+    async def __take_over(
+        self,
+        key: str,
+        shared: Union[tuple[CacheIndexEntry, bytes], None],
+        source: str,
+        reqid: str
+    ) -> Union[bytes, None]:
+
+        '''
+            Stores a fresh entry another node handed over (via the cache
+            backend or as the owning peer) instead of asking Google for it
+
+            :returns: Its content (None if no usable entry was handed over)
+        '''
+
+        if shared is None:
+            return None
+        entry, content = shared
+        if entry.key != key or not entry.is_fresh or md5(content) != entry.checksum:
+            return None
+        get_logger().debug(f'Taking over cache entry "{entry.url}" from {source} [reqid={reqid}]')
+        await to_thread(
+            self.__commit,
+            entry=entry,
+            content=content,
+            variants=await to_thread(precompress, content) if entry.kind == ENTRY_KIND_FONT else None
+        )
+        return content
+
+    async def __take_over_from_other_nodes(
+        self,
+        key: str,
+        kind: str,
+        url: str,
+        font_format: Union[str, None],
+        ask_peers: bool,
+        reqid: str
+    ) -> Union[bytes, None]:
+        content = await self.__take_over(
+            key=key,
+            shared=await get_cache_backend().get(key),
+            source=f'the {get_cache_backend().name} cache backend',
+            reqid=reqid
+        )
+        if content is None and ask_peers:
+            content = await self.__take_over(
+                key=key,
+                shared=await get_peer_fill().fetch(key=key, kind=kind, url=url, font_format=font_format, reqid=reqid),
+                source=f'peer "{get_peer_fill().owner(key)}"',
+                reqid=reqid
+            )
+        return content
+
+    async def __share(self, entry: CacheIndexEntry, content: bytes) -> None:
+        if entry.size <= from_config('cache', 'backend_max_blob_bytes'):
+            await get_cache_backend().put(entry=entry, content=content)
+
+    def __read_css(self, css_key: str) -> str:
+        with open(self.store.css_path(css_key), 'rb') as css_file:
+            return css_file.read().decode('utf-8')
+
+    async def __fill_css(self, url: str, css_key: str, font_format: str, reqid: str, ask_peers: bool = True) -> str:
+        log = get_logger()
+        css_path = self.store.css_path(css_key)
+        entry = get_cache_index().get(css_key)
+        if entry is not None and entry.is_fresh:
+            log.debug(f'Font CSS file "{css_path}" was cached by another worker [reqid={reqid}]')
+            return self.__read_css(css_key)
+        shared_css = await self.__take_over_from_other_nodes(
+            key=css_key,
+            kind=ENTRY_KIND_CSS,
+            url=url,
+            font_format=font_format,
+            ask_peers=ask_peers,
+            reqid=reqid
+        )
+        if shared_css is not None:
+            raw_css = shared_css.decode('utf-8')
+            await to_thread(get_cache_index().set_edges, css_key=css_key, font_keys=extract_font_urls(parse_stylesheet(raw_css)).keys())
+            return raw_css
+        log.debug(f'Downloading {font_format} font CSS from "{url}" to "{css_path}" [reqid={reqid}]')
+        headers = self.__conditional_headers(entry)
+        if FONT_FORMAT_USER_AGENTS[font_format] is not None:
+            headers['User-Agent'] = FONT_FORMAT_USER_AGENTS[font_format]
+        response = await self.__download(from_url=url, headers=headers)
+        if response.status_code == 304:
+            log.debug(f'Font CSS from "{url}" is unchanged - extending its expiry [reqid={reqid}]')
+            await to_thread(self.__extend, entry, response)
+            return self.__read_css(css_key)
+        raw_css = response.content.decode('utf-8')
+        log.debug(f'Writing new font CSS to "{css_path}" [reqid={reqid}]')
+        entry = await self.__store(key=css_key, kind=ENTRY_KIND_CSS, url=url, response=response)
+        await self.__share(entry=entry, content=response.content)
+        await to_thread(get_cache_index().set_edges, css_key=css_key, font_keys=extract_font_urls(parse_stylesheet(raw_css)).keys())
+        return raw_css
+
+    async def __fill_font(self, font_url_md5: str, font_url: str, slots: Semaphore, reqid: str, ask_peers: bool = True) -> None:
+        log = get_logger()
+
+        async def fill() -> None:
+            entry = get_cache_index().get(font_url_md5)
+            if entry is not None and entry.is_fresh:
+                log.debug(f'Font file "{font_url}" was cached by another worker [reqid={reqid}]')
+                return
+            if await self.__take_over_from_other_nodes(
+                key=font_url_md5,
+                kind=ENTRY_KIND_FONT,
+                url=font_url,
+                font_format=None,
+                ask_peers=ask_peers,
+                reqid=reqid
+            ) is not None:
+                return
+            async with slots:
+                log.debug(f'Downloading font file "{font_url}" [reqid={reqid}]')
+                response = await self.__download(from_url=font_url, headers=self.__conditional_headers(entry))
+            if response.status_code == 304:
+                log.debug(f'Font file "{font_url}" is unchanged - extending its expiry [reqid={reqid}]')
+                await to_thread(self.__extend, entry, response)
+                return
+            entry = await self.__store(
+                key=font_url_md5,
+                kind=ENTRY_KIND_FONT,
+                url=font_url,
+                response=response,
+                variants=await to_thread(precompress, response.content)
+            )
+            await self.__share(entry=entry, content=response.content)
+
+        # fills for a peer (ask_peers=False) must not wait for the peer's backend lock
+        await get_single_flight().do(font_url_md5, fill, distributed=ask_peers)
+
+    async def __download_fonts(
+        self,
+        font_urls: dict[str, str],
+        reqid: str,
+        usable_on_error: Iterable[str] = (),
+        ask_peers: bool = True
+    ) -> None:
+
+        '''
+            Downloads the given fonts (md5 -> url) concurrently, bounded by
+            upstream.max_concurrent_downloads_per_request for this request and
+            by the upstream client's global download slots. Failed downloads
+            are retried; all fonts that succeeded are stored in the cache and
+            the remaining failures are reported as a single exception, except
+            for those in usable_on_error whose expired copy is served instead.
+        '''
+
+        log = get_logger()
+        slots = Semaphore(from_config('upstream', 'max_concurrent_downloads_per_request'))
+        retries = from_config('upstream', 'download_retries')
+        pending = dict(font_urls)
+        failed = {}
+        attempt = 0
+        while pending:
+            results = await gather(
+                *[
+                    self.__fill_font(font_url_md5=font_url_md5, font_url=font_url, slots=slots, reqid=reqid, ask_peers=ask_peers)
+                    for font_url_md5, font_url in pending.items()
+                ],
+                return_exceptions=True
+            )
+            for (font_url_md5, font_url), result in zip(pending.items(), results):
+                if isinstance(result, BaseException):
+                    failed[font_url_md5] = (font_url, result)
+                else:
+                    failed.pop(font_url_md5, None)
+            # fonts Google rejected (400) fail for good, only the others are retried
+            retryable = {
+                font_url_md5: font_url
+                for font_url_md5, font_url in pending.items()
+                if font_url_md5 in failed and not isinstance(failed[font_url_md5][1], GGoogleFontsBadRequestException)
+            }
+            if not retryable or attempt >= retries:
+                break
+            attempt += 1
+            log.warn(
+                f'Failed to download {len(retryable)} of {len(font_urls)} font files - '
+                f'retrying them (attempt {attempt}/{retries}) [reqid={reqid}]'
+            )
+            pending = retryable
+        usable_on_error = set(usable_on_error)
+        for font_url_md5 in [font_url_md5 for font_url_md5 in failed if font_url_md5 in usable_on_error]:
+            font_url, exc = failed.pop(font_url_md5)
+            log.warn(f'Failed to refresh font file "{font_url}" - serving the expired copy. {excstr(exc)} [reqid={reqid}]')
+        if failed:
+            failed_descriptions = '; '.join(f'{font_url} {excstr(exc)}' for font_url, exc in failed.values())
+            raise GGoogleFontsException(
+                f'Failed to download {len(failed)} of {len(font_urls)} font files. {failed_descriptions}'
+            )
+
+    def __rewrite_css(self, stylesheet: Stylesheet) -> tuple[str, bool]:
+
+        '''
+            Points every font location of the stylesheet to this server. If
+            WOFF2 transcoding is enabled, the locally transcoded WOFF2
+            variant of every TrueType font is listed first in its src
+            descriptor, with the TrueType font as fallback. Fonts without
+            WOFF2 variant yet are scheduled for transcoding and served as
+            TrueType meanwhile.
+
+            :returns: The stylesheet and whether WOFF2 variants are pending
+        '''
+
+        transcoder = get_woff2_transcoder()
+        formats = stylesheet.formats if transcoder.enabled else {}
+        font_entries = get_cache_index().get_many(
+            md5(font_url) for font_url, font_format in formats.items() if font_format == 'truetype'
+        )
+        pending = False
+
+        def rewrite(font_url: str, quote: str) -> str:
+            nonlocal pending
+            font_key = md5(font_url)
+            source = f'url({quote}/font/{font_key}{quote})'
+            if formats.get(font_url) != 'truetype' or font_key not in font_entries:
+                return source
+            font_path = self.store.path(font_entries[font_key])
+            if transcoder.is_available(font_path):
+                return f"url({quote}/font/{font_key}{WOFF2_SUFFIX}{quote}) format('woff2'), {source}"
+            transcoder.schedule(font_path)
+            pending = pending or not transcoder.is_settled(font_path)
+            return source
+
+        return stylesheet.render(rewrite), pending
+
+    async def __get_subset(self, font_entry: CacheIndexEntry, chars: str, reqid: str) -> Union[str, None]:
+
+        '''
+            Subset fonts are cached by the md5 of the font's checksum and
+            the characters, so their content never changes. Fonts that
+            fail to subset are served in full.
+
+            :returns: The key of the subset font (None if it failed)
+        '''
+
+        log = get_logger()
+        subset_key = md5(f'{font_entry.checksum}:{chars}')
+        get_access_recorder().record(subset_key)
+
+        async def fill() -> None:
+            if self.store.exists(get_cache_index().get(subset_key)):
+                log.debug(f'Subset font file "{subset_key}" was cached by another worker [reqid={reqid}]')
+                return
+            log.debug(f'Subsetting font file "{font_entry.url}" to "{subset_key}" [reqid={reqid}]')
+            staging_path = join_path(self.storage_staging_path, subset_key)
+            size, checksum = await get_font_subsetter().subset(
+                font_path=self.store.path(font_entry),
+                subset_path=staging_path,
+                text=chars
+            )
+            await to_thread(
+                self.store.commit,
+                entry=CacheIndexEntry(
+                    key=subset_key,
+                    kind=ENTRY_KIND_SUBSET,
+                    url=f'{font_entry.url}#text={quote(chars)}',
+                    size=size,
+                    checksum=checksum,
+                    content_type=font_entry.content_type
+                ),
+                staged_path=staging_path
+            )
+
+        if not self.store.exists(get_cache_index().get(subset_key)):
+            try:
+                await get_single_flight().do(subset_key, fill)
+            except Exception as exc:
+                log.warn(f'Failed to subset font file "{font_entry.url}" - serving the full font. {excstr(exc)} [reqid={reqid}]')
+                return None
+        return subset_key
+
+    async def __subset_css(self, stylesheet: Stylesheet, text: str, reqid: str) -> str:
+
+        '''
+            Rewrites the full (cached) stylesheet into the one Google would
+            serve for text: @font-face blocks whose unicode-range covers
+            none of its characters are dropped, the others point to local
+            subsets of their fonts with the characters they cover.
+        '''
+
+        text = ''.join(sorted(set(text)))
+        covered = {id(font_face): font_face.covered(text) for font_face in stylesheet.font_faces}
+        chars_by_font_url = {
+            source.url: covered[id(font_face)]
+            for font_face in stylesheet.font_faces
+            if covered[id(font_face)]
+            for source in font_face.sources
+            if source.url is not None
+        }
+        font_entries = get_cache_index().get_many(md5(font_url) for font_url in chars_by_font_url)
+        font_urls = [font_url for font_url in chars_by_font_url if md5(font_url) in font_entries]
+        subset_keys = dict(
+            zip(
+                font_urls,
+                await gather(
+                    *[
+                        self.__get_subset(font_entry=font_entries[md5(font_url)], chars=chars_by_font_url[font_url], reqid=reqid)
+                        for font_url in font_urls
+                    ]
+                )
+            )
+        )
+        return parse_stylesheet(
+            stylesheet.select_font_faces(lambda font_face: bool(covered[id(font_face)]))
+        ).rewrite_urls(lambda font_url: f'/font/{subset_keys.get(font_url) or md5(font_url)}')
+
+    def __revalidate_in_background(self, keys: Iterable[str], revalidate: Callable[[], Awaitable[Any]], reqid: str) -> None:
+
+        '''
+            Refreshes expired entries that are served stale without making
+            the request wait for it. Keys that are already being refreshed by
+            this worker are not scheduled again.
+        '''
+
+        keys = set(keys)
+        if keys <= self.__revalidating:
+            return
+        self.__revalidating.update(keys)
+        log = get_logger()
+
+        async def run() -> None:
+            try:
+                await revalidate()
+            except Exception as exc:
+                log.warn(f'Failed to refresh expired cache entries in the background. {excstr(exc)} [reqid={reqid}]')
+            finally:
+                self.__revalidating.difference_update(keys)
+
+        log.debug(f'Refreshing {len(keys)} expired cache entries in the background [reqid={reqid}]')
+        task = create_task(run())
+        self.__background_tasks.add(task)
+        task.add_done_callback(self.__background_tasks.discard)
 
     def convert_rewritten_css_sheet_to_archive(
         self,
         rewritten_css_sheet: str,
-        archive_format: str = 'zip'
-    ) -> BytesIO:
-        font_urls = []
-        font_face_split = rewritten_css_sheet.split('@font-face')
-        for font_face in font_face_split:
-            if 'src:' in font_face:
-                font_urls.append(font_face.split('url(')[1].split(')')[0])
-        for font_url in font_urls:
-            rewritten_css_sheet = rewritten_css_sheet.replace(font_url, f'./{font_url.split("/font/")[1]}')
-        with TemporaryDirectory() as tmpdir:
-            for font_url in font_urls:
-                font_file_basename = font_url.split('/font/')[1]
-                copy_file(join_path(self.storage_path, font_file_basename), tmpdir)
-            with open(join_path(tmpdir, 'fonts.css'), 'wb') as font_css:
-                font_css.write(rewritten_css_sheet.encode('utf-8'))
-            archive_file = NamedTemporaryFile(prefix='gfo-bundle-', delete=True)
-            archive_file_name = archive_file.name
-            archive_file.close()
-            make_archive(
-                base_name=archive_file_name,
-                format=archive_format,
-                root_dir=tmpdir
-            )
-        final_archive_path = f'{archive_file_name}.{archive_format}'
-        archive_bytes_io = BytesIO()
-        with open(final_archive_path, 'rb') as arc:
-            while 1:
-                data = arc.read(4096)
-                if not data:
-                    break
-                archive_bytes_io.write(data)
-        archive_bytes_io.seek(0)
-        remove(final_archive_path)
-        return archive_bytes_io
-
-    def download_via_css_api(
+        archive_format: str = BUNDLE_FORMAT_ZIP
+    ) -> Iterator[bytes]:
+
+        '''
+            Points the font locations of the stylesheet to the font files
+            next to it and returns the bundle archive as a stream. All font
+            files are looked up before streaming starts, so a missing file
+            fails the request instead of truncating the archive.
+        '''
+
+        stylesheet = parse_stylesheet(rewritten_css_sheet)
+        font_file_basenames = [font_url.split('/font/')[1] for font_url in stylesheet.urls]
+        font_entries = get_cache_index().get_many(
+            font_file_basename.removesuffix(WOFF2_SUFFIX) for font_file_basename in font_file_basenames
+        )
+        font_files = {}
+        for font_file_basename in font_file_basenames:
+            font_entry = font_entries.get(font_file_basename.removesuffix(WOFF2_SUFFIX))
+            if not self.store.exists(font_entry):
+                raise GGoogleFontsException(f'The font file "{font_file_basename}" of the bundle is not cached')
+            font_path = self.store.path(font_entry)
+            if font_file_basename.endswith(WOFF2_SUFFIX):
+                font_path = transcoded_path(font_path)
+            font_files[font_file_basename] = font_path
+        rewritten_css_sheet = stylesheet.rewrite_urls(lambda font_url: f'./{font_url.split("/font/")[1]}')
+        return iter_bundle(
+            css=rewritten_css_sheet.encode('utf-8'),
+            font_files=font_files,
+            archive_format=archive_format
+        )
+
+    def __stream_bundle(self, bundle_key: str, url: str, chunks: Iterator[bytes], reqid: str) -> Iterator[bytes]:
+
+        '''
+            Passes the chunks of a new bundle archive through to the client
+            while writing them to this worker's staging directory, and
+            commits the archive to the font store once it is complete. The
+            staging file of a client that disconnected is dropped.
+        '''
+
+        staging_path = join_path(self.storage_staging_path, f'{bundle_key}.{get_id(6)}')
+        checksum = hash_md5()
+        size = 0
+        try:
+            with open(staging_path, 'wb') as staging_file:
+                for chunk in chunks:
+                    staging_file.write(chunk)
+                    checksum.update(chunk)
+                    size += len(chunk)
+                    yield chunk
+        except BaseException:
+            remove_if_exists(staging_path)
+            raise
+        entry = CacheIndexEntry(
+            key=bundle_key,
+            kind=ENTRY_KIND_BUNDLE,
+            url=url,
+            size=size,
+            checksum=checksum.hexdigest(),
+            content_type='application/octet-stream'
+        )
+        try:
+            self.store.commit(entry=entry, staged_path=staging_path)
+        except Exception as exc:
+            remove_if_exists(staging_path)
+            get_logger().warn(f'Failed to cache bundle archive "{bundle_key}". {excstr(exc)} [reqid={reqid}]')
+
+    async def __get_bundle(
+        self,
+        url: str,
+        rewritten_css_sheet: RewrittenStylesheet,
+        archive_format: str,
+        reqid: str
+    ) -> Union[OpenFile, Iterator[bytes]]:
+
+        '''
+            Bundle archives are cached by the md5 of the rewritten stylesheet
+            and the archive format, so their content never changes. They
+            expire and get evicted like every other cache entry. Archives
+            that are not cached (or vanished meanwhile) are built again and
+            streamed to the client right away while they are cached.
+
+            :returns: The open file of the cached bundle archive (to be
+                      released once it is sent) or the chunks of the new one
+        '''
+
+        log = get_logger()
+        bundle_key = md5(f'{rewritten_css_sheet.checksum}:{archive_format}')
+        get_access_recorder().record(bundle_key)
+
+        bundle_entry = get_cache_index().get(bundle_key)
+        if bundle_entry is not None:
+            open_file = await get_open_file_cache().acquire(self.store.path(bundle_entry))
+            if open_file is not None:
+                log.debug(f'Bundle archive is available cached at "{open_file.path}" [reqid={reqid}]')
+                return open_file
+        log.debug(f'Streaming new {archive_format} bundle archive "{bundle_key}" [reqid={reqid}]')
+        chunks = await to_thread(
+            self.convert_rewritten_css_sheet_to_archive,
+            rewritten_css_sheet=rewritten_css_sheet.css,
+            archive_format=archive_format
+        )
+        return self.__stream_bundle(bundle_key=bundle_key, url=url, chunks=chunks, reqid=reqid)
+
+    async def download_via_css_api(
         self,
         families_as_string: str,
         display: Union[str, None],
         text: Union[str, None],
         subset: Union[str, None],
         reqid: str,
+        font_format: str = FONT_FORMAT_TTF,
         download_as_bundle: bool = False,
-        bundle_archive_format: str = 'zip'
-    ) -> Union[str, BytesIO]:
+        bundle_archive_format: str = BUNDLE_FORMAT_ZIP
+    ) -> Union[RewrittenStylesheet, OpenFile, Iterator[bytes]]:
         log = get_logger()
+        if display is not None and display not in FONT_DISPLAY_VALUES:
+            raise GGoogleFontsBadRequestException(
+                f'The display value "{display}" is not one of {", ".join(FONT_DISPLAY_VALUES)}'
+            )
+        upstream_text, local_text = (None, text) if get_font_subsetter().enabled else (text, None)
         google_fonts_url = 'https://fonts.googleapis.com/css?'
         google_fonts_url_params = [('family', families_as_string)]
-        if display is not None:
-            google_fonts_url_params.append(('display', display))
-        if text is not None:
-            google_fonts_url_params.append(('text', text))
+        if upstream_text is not None:
+            google_fonts_url_params.append(('text', upstream_text))
         if subset is not None:
             google_fonts_url_params.append(('subset', subset))
         url = google_fonts_url + urlencode(google_fonts_url_params, quote_via=quote_plus)
         log.debug(f'[css] Retrieving font stylesheet from "{url}" [reqid={reqid}]')
-        rewritten_css_sheet = self.store_locally_and_return_css(url=url, reqid=reqid)
+        rewritten_css_sheet = await self.store_locally_and_return_css(
+            url=url,
+            reqid=reqid,
+            font_format=font_format,
+            display=display,
+            text=local_text
+        )
 
         if download_as_bundle:
-            return self.convert_rewritten_css_sheet_to_archive(
+            return await self.__get_bundle(
+                url=url,
                 rewritten_css_sheet=rewritten_css_sheet,
-                archive_format=bundle_archive_format
+                archive_format=bundle_archive_format,
+                reqid=reqid
             )
 
         return rewritten_css_sheet
 
-    def download_via_css2_api(
+    async def download_via_css2_api(
         self,
         families: list[str],
         display: Union[str, None],
         text: Union[str, None],
         reqid: str,
+        font_format: str = FONT_FORMAT_TTF,
         download_as_bundle: bool = False,
-        bundle_archive_format: str = 'zip'
-    ) -> Union[str, BytesIO]:
+        bundle_archive_format: str = BUNDLE_FORMAT_ZIP
+    ) -> Union[RewrittenStylesheet, OpenFile, Iterator[bytes]]:
         log = get_logger()
-        google_fonts_url = 'https://fonts.googleapis.com/css2?'
-        google_fonts_url_params = [('family', family) for family in families]
-        if display is not None:
-            google_fonts_url_params.append(('display', display))
-        if text is not None:
-            google_fonts_url_params.append(('text', text))
-        url = google_fonts_url + urlencode(google_fonts_url_params, quote_via=quote_plus)
-        log.debug(f'[css2] Receiving font stylesheet from "{url}" [reqid={reqid}]')
-        rewritten_css_sheet = self.store_locally_and_return_css(url=url, reqid=reqid)
+        log.debug(f'[css2] Receiving font stylesheets of {len(families)} families [reqid={reqid}]')
+        url, rewritten_css_sheet = await self.store_locally_and_return_css2(
+            families=families,
+            display=display,
+            text=text,
+            reqid=reqid,
+            font_format=font_format
+        )
 
         if download_as_bundle:
-            return self.convert_rewritten_css_sheet_to_archive(
+            return await self.__get_bundle(
+                url=url,
                 rewritten_css_sheet=rewritten_css_sheet,
-                archive_format=bundle_archive_format
+                archive_format=bundle_archive_format,
+                reqid=reqid
             )
 
         return rewritten_css_sheet
 
-    def get_font_path_from_md5(self, font_md5: str) -> str:
-        return join_path(self.storage_path, font_md5)
+    async def fill_for_peer(self, kind: str, url: str, font_format: Union[str, None], reqid: str) -> tuple[CacheIndexEntry, bytes]:
+
+        '''
+            Fills the entry of url (a stylesheet in font_format or a font
+            file) on behalf of a peer, as this node owns it. Never asks
+            peers itself, so peer requests cannot loop, and never takes
+            the lock of the cache backend, which the peer holds while it
+            waits for the entry.
 
-    def store_locally_and_return_css(self, url: str, reqid: str) -> str:
+            :raises GGoogleFontsBadRequestException: if url is no Google
+                                                     Fonts stylesheet or font
+            :returns: The entry and its content
+        '''
+
+        if kind == ENTRY_KIND_CSS and url.startswith('https://fonts.googleapis.com/') and font_format in FONT_FORMAT_USER_AGENTS:
+            key = css_cache_key(url=url, font_format=font_format)
+            await get_single_flight().do(
+                key,
+                lambda: self.__fill_css(url=url, css_key=key, font_format=font_format, reqid=reqid, ask_peers=False),
+                distributed=False
+            )
+        elif kind == ENTRY_KIND_FONT and url.startswith('https://fonts.gstatic.com/'):
+            key = md5(url)
+            await self.__download_fonts(font_urls={key: url}, reqid=reqid, ask_peers=False)
+        else:
+            raise GGoogleFontsBadRequestException(f'"{url}" is no Google Fonts {kind} URL')
+        get_access_recorder().record(key)
+        entry = get_cache_index().get(key)
+        with open(self.store.path(entry), 'rb') as cache_file:
+            return entry, cache_file.read()
+
+    async def restore_evicted_font(self, font_url_md5: str, reqid: str) -> bool:
+
+        '''
+            Downloads a font file again that was evicted from the cache while
+            a (still cached) stylesheet references it. Evicted subset fonts
+            are subset again from their (restored) font.
+
+            :returns: Whether the font file is available again
+        '''
+
+        index = get_cache_index()
+        font_url = index.evicted_url(key=font_url_md5, kind=ENTRY_KIND_FONT)
+        if font_url is not None:
+            get_logger().debug(f'Restoring evicted font file "{font_url}" [reqid={reqid}]')
+            await self.__download_fonts(font_urls={font_url_md5: font_url}, reqid=reqid)
+            return True
+        subset_url = index.evicted_url(key=font_url_md5, kind=ENTRY_KIND_SUBSET)
+        if subset_url is None:
+            return False
+        get_logger().debug(f'Restoring evicted subset font file "{subset_url}" [reqid={reqid}]')
+        font_url, _, chars = subset_url.partition('#text=')
+        if not self.store.exists(index.get(md5(font_url))):
+            await self.__download_fonts(font_urls={md5(font_url): font_url}, reqid=reqid)
+        font_entry = index.get(md5(font_url))
+        if font_entry is None or await self.__get_subset(font_entry=font_entry, chars=unquote(chars), reqid=reqid) is None:
+            return False
+        return self.store.exists(index.get(font_url_md5))
+
+    async def __get_rewritten_css(
+        self,
+        url: str,
+        reqid: str,
+        font_format: str = FONT_FORMAT_TTF,
+        text: Union[str, None] = None
+    ) -> tuple[str, Union[float, None]]:
+
+        '''
+            Makes sure the stylesheet at url and all its font files are
+            cached and points its font locations to this server. With
+            text, they point to local subsets of the fonts instead.
+
+            :returns: The rewritten stylesheet and until when it may be
+                      kept in memory (None if it must not be kept)
+        '''
 
         log = get_logger()
 
-        css_path = join_path(self.storage_path, md5(url))
-
-        perform_download = True
-
-        if isfile(css_path):
-            log.debug(f'Font CSS path "{css_path}" exists [reqid={reqid}]')
-            if time() - getmtime(css_path) > from_config('misc', 'cache_lifespan_seconds'):
-                log.debug(f'Font CSS file "{css_path}" exceeded its cache lifespan - removing it [reqid={reqid}]')
-                remove(css_path)
-            else:
-                log.debug(f'Font CSS file is available cached at "{css_path}" [reqid={reqid}]')
-                with open(css_path, 'rb') as css_file:
-                    raw_css = css_file.read().decode('utf-8')
-                perform_download = False
-
-        if perform_download:
-            log.debug(f'Downloading font CSS from "{url}" to "{css_path}" [reqid={reqid}]')
-            raw_css = self.__download(from_url=url).decode('utf-8')
-            with open(css_path, 'wb') as css_file:
-                log.debug(f'Writing new font CSS to "{css_path}" [reqid={reqid}]')
-                css_file.write(raw_css.encode('utf-8'))
-
-        '''
-            Extract font urls from css
-        '''
-        md5_to_font_urls = {}
-        for part in raw_css.split('url('):
-            if ')' in part:
-                font_url = part.split(')')[0]
-                log.debug(f'Extracted font URL "{font_url}" from font CSS from "{css_path}" [reqid={reqid}]')
-                md5_to_font_urls[md5(font_url)] = font_url
-
-
-        '''
-            Download all font files that don't exist yet
-        '''
-        stage_files = []
-        for font_url_md5 in md5_to_font_urls:
-            url_font_path = join_path(self.storage_path, font_url_md5)
-            url_font_staging_path = join_path(self.storage_staging_path, font_url_md5)
-            if isfile(url_font_path):
-                log.debug(f'Font file "{url_font_path}" exists [reqid={reqid}]')
-                if time() - getmtime(url_font_path) > from_config('misc', 'cache_lifespan_seconds'):
-                    log.debug(f'Font file "{url_font_path}" exceeded the cache lifespan [reqid={reqid}]')
-                    remove(url_font_path)
-                    with open(url_font_staging_path, 'wb') as font_file:
-                        font_file.write(self.__download(md5_to_font_urls[font_url_md5]))
-                    stage_files.append(url_font_staging_path)
-            else:
-                log.debug(f'Downloading font file "{url_font_path}" to "{url_font_staging_path}" [reqid={reqid}]')
-                with open(url_font_staging_path, 'wb') as font_file:
-                    font_file.write(self.__download(md5_to_font_urls[font_url_md5]))
-                stage_files.append(url_font_staging_path)
-
-        for staging_file_path in stage_files:
-            log.debug(f'Moving font file "{staging_file_path}" to "{join_path(self.storage_path, basename(staging_file_path))}" [reqid={reqid}]')
-            move(
-                src=staging_file_path,
-                dst=join_path(self.storage_path, basename(staging_file_path))
-            )
-
-        for md5url, url in md5_to_font_urls.items():
-            raw_css = raw_css.replace(url, f'/font/{md5url}')
+        css_key = css_cache_key(url=url, font_format=font_format)
+        get_access_recorder().record(css_key)
 
-        return raw_css
+        index = get_cache_index()
+        css_path = self.store.css_path(css_key)
+        css_entry = index.get(css_key)
+        stale = False
+
+        if css_entry is not None and css_entry.is_fresh:
+            log.debug(f'Font CSS file is available cached at "{css_path}" [reqid={reqid}]')
+            raw_css = self.__read_css(css_key)
+        elif css_entry is not None and css_entry.is_revalidatable:
+            log.debug(f'Serving expired font CSS file "{css_path}" while refreshing it [reqid={reqid}]')
+            raw_css = self.__read_css(css_key)
+            stale = True
+            self.__revalidate_in_background(
+                keys=[css_key],
+                revalidate=lambda: get_single_flight().do(
+                    css_key,
+                    lambda: self.__fill_css(url=url, css_key=css_key, font_format=font_format, reqid=reqid)
+                ),
+                reqid=reqid
+            )
+        else:
+            try:
+                raw_css = await get_single_flight().do(
+                    css_key,
+                    lambda: self.__fill_css(url=url, css_key=css_key, font_format=font_format, reqid=reqid)
+                )
+            except GGoogleFontsBadRequestException:
+                raise
+            except GGoogleFontsException as exc:
+                if css_entry is None or not css_entry.is_usable_on_error:
+                    raise
+                log.warn(f'Failed to refresh font CSS from "{url}" - serving the expired copy. {excstr(exc)} [reqid={reqid}]')
+                raw_css = self.__read_css(css_key)
+                stale = True
+
+        stylesheet = parse_stylesheet(raw_css)
+        md5_to_font_urls = extract_font_urls(stylesheet)
+
+        '''
+            Download all font files that don't exist yet or expired too long
+            ago, refresh recently expired ones in the background
+        '''
+        font_entries = index.get_many(md5_to_font_urls.keys())
+        missing_font_urls = {}
+        stale_font_urls = {}
+        for font_url_md5, font_url in md5_to_font_urls.items():
+            font_entry = font_entries.get(font_url_md5)
+            if font_entry is None or not (font_entry.is_fresh or font_entry.is_revalidatable):
+                missing_font_urls[font_url_md5] = font_url
+            elif not font_entry.is_fresh:
+                stale_font_urls[font_url_md5] = font_url
+        if missing_font_urls:
+            await self.__download_fonts(
+                font_urls=missing_font_urls,
+                reqid=reqid,
+                usable_on_error=[
+                    font_url_md5 for font_url_md5 in missing_font_urls
+                    if font_url_md5 in font_entries and font_entries[font_url_md5].is_usable_on_error
+                ]
+            )
+            font_entries.update(index.get_many(missing_font_urls.keys()))
+        if stale_font_urls:
+            self.__revalidate_in_background(
+                keys=stale_font_urls.keys(),
+                revalidate=lambda: self.__download_fonts(font_urls=stale_font_urls, reqid=reqid),
+                reqid=reqid
+            )
+
+        if text is None:
+            raw_css, transcoding = self.__rewrite_css(stylesheet)
+        else:
+            raw_css, transcoding = await self.__subset_css(stylesheet=stylesheet, text=text, reqid=reqid), False
+
+        '''
+            The rewritten CSS may be kept in memory until its stylesheet or
+            any of its font files expires. Responses built from expired
+            entries or still lacking WOFF2 variants are not kept, so the
+            refreshed entries and the WOFF2 variants are picked up.
+        '''
+        css_entry = index.get(css_key)
+        if (
+            stale or
+            stale_font_urls or
+            transcoding or
+            css_entry is None or
+            not css_entry.is_fresh or
+            len(font_entries) != len(md5_to_font_urls) or
+            not all(entry.is_fresh for entry in font_entries.values())
+        ):
+            return raw_css, None
+        return raw_css, min([css_entry.expires_at] + [entry.expires_at for entry in font_entries.values()])
+
+    async def store_locally_and_return_css(
+        self,
+        url: str,
+        reqid: str,
+        font_format: str = FONT_FORMAT_TTF,
+        display: Union[str, None] = None,
+        text: Union[str, None] = None
+    ) -> RewrittenStylesheet:
+
+        '''
+            Serves the stylesheet at url with display (and, with
+            cache.subset_text_locally, text) applied locally, so all of
+            them share the cached stylesheet
+        '''
+
+        css_memory_key = rendition_cache_key(url=url, font_format=font_format, display=display, text=text)
+        css_memory_cache = get_css_memory_cache()
+        rewritten_css_sheet = css_memory_cache.get(css_memory_key)
+        if rewritten_css_sheet is not None:
+            get_access_recorder().record(css_cache_key(url=url, font_format=font_format))
+            get_logger().debug(f'Rewritten {font_format} font CSS for "{url}" is available in memory [reqid={reqid}]')
+            return rewritten_css_sheet
+
+        raw_css, expires_at = await self.__get_rewritten_css(url=url, reqid=reqid, font_format=font_format, text=text)
+        if display is not None:
+            raw_css = parse_stylesheet(raw_css).set_font_display(display)
+        rewritten_css_sheet = await to_thread(RewrittenStylesheet, css=raw_css, cached=expires_at is not None)
+        if expires_at is not None:
+            css_memory_cache.set(key=css_memory_key, value=rewritten_css_sheet, size=rewritten_css_sheet.size, expires_at=expires_at)
+        return rewritten_css_sheet
+
+    async def store_locally_and_return_css2(
+        self,
+        families: list[str],
+        display: Union[str, None],
+        text: Union[str, None],
+        reqid: str,
+        font_format: str = FONT_FORMAT_TTF
+    ) -> tuple[str, RewrittenStylesheet]:
+
+        '''
+            css2 stylesheets are cached per family: every (normalized)
+            family is requested from Google on its own, without display,
+            and the response is assembled from the cached per-family
+            stylesheets in a canonical order, with display (and, with
+            cache.subset_text_locally, text) applied locally. Requests for
+            the same families in any order or with any display share their
+            upstream requests and cache entries.
+
+            :returns: The canonical URL of the request and its stylesheet
+        '''
+
+        log = get_logger()
+        if display is not None and display not in FONT_DISPLAY_VALUES:
+            raise GGoogleFontsBadRequestException(
+                f'The display value "{display}" is not one of {", ".join(FONT_DISPLAY_VALUES)}'
+            )
+        families = normalize_css2_families(families)
+        upstream_text, local_text = (None, text) if get_font_subsetter().enabled else (text, None)
+        url = css2_url(families=families, display=display, text=text)
+
+        '''
+            Assembled stylesheets live in memory only
+        '''
+        css_memory_key = rendition_cache_key(
+            url=css2_url(families=families, display=None, text=upstream_text),
+            font_format=font_format,
+            display=display,
+            text=local_text
+        )
+        css_memory_cache = get_css_memory_cache()
+        rewritten_css_sheet = css_memory_cache.get(css_memory_key)
+        if rewritten_css_sheet is not None:
+            for family in families:
+                get_access_recorder().record(
+                    css_cache_key(url=css2_url(families=[family], display=None, text=upstream_text), font_format=font_format)
+                )
+            log.debug(f'Rewritten {font_format} font CSS for "{url}" is available in memory [reqid={reqid}]')
+            return url, rewritten_css_sheet
+
+        fragments = await gather(
+            *[
+                self.__get_rewritten_css(
+                    url=css2_url(families=[family], display=None, text=upstream_text),
+                    reqid=reqid,
+                    font_format=font_format,
+                    text=local_text
+                )
+                for family in families
+            ]
+        )
+        raw_css = ''.join(fragment_css for fragment_css, _ in fragments)
+        if display is not None:
+            raw_css = parse_stylesheet(raw_css).set_font_display(display)
+        cached = all(expires_at is not None for _, expires_at in fragments)
+        rewritten_css_sheet = await to_thread(RewrittenStylesheet, css=raw_css, cached=cached)
+        if cached:
+            css_memory_cache.set(
+                key=css_memory_key,
+                value=rewritten_css_sheet,
+                size=rewritten_css_sheet.size,
+                expires_at=min(expires_at for _, expires_at in fragments)
+            )
+        return url, rewritten_css_sheet
 
 def get_google_fonts_downloader() -> GoogleFontsDownloader:
     global __GLOBAL_GOOGLE_FONTS_DOWNLOADER
@@ -0,0 +1,61 @@
+from typing import Iterable
+
+'''
+    The values of the display parameter, which is applied to the
+    stylesheets locally instead of being sent to Google
+'''
+FONT_DISPLAY_VALUES = ('auto', 'block', 'fallback', 'optional', 'swap')
+
+def axis_order(axis: str) -> tuple[bool, str]:
+    '''
+        Google expects lowercase (registered) axes first, each group in
+        alphabetical order (e.g. ital,wght,GRAD)
+    '''
+    return (axis != axis.lower(), axis)
+
+def value_order(value: str) -> tuple[float, str]:
+    try:
+        return (float(value.split('..')[0]), value)
+    except ValueError:
+        return (float('inf'), value)
+
+def normalize_css2_family(family: str) -> str:
+
+    '''
+        Brings a css2 family parameter (e.g. "Roboto:wght,ital@700,0;400,0")
+        into its canonical form ("Roboto:ital,wght@0,400;0,700"): single
+        spaces in the family name, axes in Google's order and the axis
+        value tuples sorted and deduplicated. Malformed parameters are
+        returned stripped only, so Google gets to reject them.
+    '''
+
+    name, separator, axis_spec = family.partition(':')
+    name = ' '.join(name.split())
+    if not separator:
+        return name
+    axes_as_string, separator, tuples_as_string = axis_spec.partition('@')
+    axes = [axis.strip() for axis in axes_as_string.split(',')]
+    if not separator or not all(axes) or len(set(axes)) != len(axes):
+        return family.strip()
+    tuples = set()
+    for tuple_as_string in tuples_as_string.split(';'):
+        values = [value.strip() for value in tuple_as_string.split(',')]
+        if len(values) != len(axes) or not all(values):
+            return family.strip()
+        tuples.add(tuple(values))
+    order = sorted(range(len(axes)), key=lambda index: axis_order(axes[index]))
+    tuples = sorted(
+        (tuple(values[index] for index in order) for values in tuples),
+        key=lambda values: tuple(value_order(value) for value in values)
+    )
+    return (
+        f'{name}:{",".join(axes[index] for index in order)}@'
+        f'{";".join(",".join(values) for values in tuples)}'
+    )
+
+def normalize_css2_families(families: Iterable[str]) -> list[str]:
+    '''
+        The canonical, sorted and deduplicated family parameters of a
+        css2 request
+    '''
+    return sorted(set(normalize_css2_family(family) for family in families))
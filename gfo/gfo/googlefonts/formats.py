@@ -0,0 +1,62 @@
+from re import compile as re_compile
+from typing import Union
+
+from gfo.config import from_config
+
+FONT_FORMAT_TTF = 'ttf'
+FONT_FORMAT_WOFF = 'woff'
+FONT_FORMAT_WOFF2 = 'woff2'
+
+'''
+    The user agents Google's API is asked with per font format. Google
+    serves TrueType to user agents it doesn't know, so none is sent for
+    the TTF bucket.
+'''
+FONT_FORMAT_USER_AGENTS = {
+    FONT_FORMAT_TTF: None,
+    FONT_FORMAT_WOFF: 'Mozilla/5.0 (Windows NT 6.1; Trident/7.0; rv:11.0) like Gecko',
+    FONT_FORMAT_WOFF2: (
+        'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 '
+        '(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+    )
+}
+
+'''
+    (pattern, first major version supporting WOFF2, first major version
+    supporting WOFF) - checked in this order, as e.g. Edge and Opera also
+    identify as Chrome and every Chrome identifies as Safari
+'''
+USER_AGENT_FONT_FORMAT_SUPPORT = tuple(
+    (re_compile(pattern), woff2_since, woff_since)
+    for pattern, woff2_since, woff_since in (
+        (r'Edge/(\d+)', 14, 12),
+        (r'(?:Chrome|Chromium|CriOS)/(\d+)', 36, 6),
+        (r'(?:Firefox|FxiOS)/(\d+)', 39, 4),
+        (r'Version/(\d+)[.\d]* (?:Mobile/\S+ )?Safari/', 12, 6),
+        (r'MSIE (\d+)', None, 9),
+        (r'Trident/\d+.*rv:(\d+)', None, 11),
+    )
+)
+
+def classify_user_agent(user_agent: Union[str, None]) -> str:
+
+    '''
+        Assigns a client to the most compact font format its browser
+        supports. Unknown clients (and all clients with
+        upstream.font_formats_by_user_agent disabled) get TrueType,
+        which every browser can render.
+    '''
+
+    if not user_agent or not from_config('upstream', 'font_formats_by_user_agent'):
+        return FONT_FORMAT_TTF
+    for pattern, woff2_since, woff_since in USER_AGENT_FONT_FORMAT_SUPPORT:
+        match = pattern.search(user_agent)
+        if match is None:
+            continue
+        version = int(match.group(1))
+        if woff2_since is not None and version >= woff2_since:
+            return FONT_FORMAT_WOFF2
+        if version >= woff_since:
+            return FONT_FORMAT_WOFF
+        return FONT_FORMAT_TTF
+    return FONT_FORMAT_TTF
@@ -0,0 +1,226 @@
+from asyncio import to_thread
+from collections import OrderedDict
+from os import stat
+from typing import Union
+
+from gfo.config import from_config
+from gfo.googlefonts.compression import ENCODINGS, sidecar_path
+from gfo.googlefonts.index import CacheIndexEntry
+
+'''
+    Halves every counter of a frequency sketch row
+'''
+HALVE_COUNTERS = bytes(counter >> 1 for counter in range(256))
+
+__GLOBAL_HOT_FONT_CACHE = None
+
+class FrequencySketch(object):
+
+    '''
+        Estimates how often every key was requested recently (a count-min
+        sketch of 4 rows of saturating counters, as used by TinyLFU). All
+        counters are halved every 10 * width increments, so keys that are
+        no longer requested lose their frequency.
+    '''
+
+    DEPTH = 4
+    MAX_COUNT = 15
+
+    def __init__(self, width: int) -> None:
+        self.width = 16
+        while self.width < width:
+            self.width *= 2
+        self.sample_size = 10 * self.width
+        self.additions = 0
+        self.__rows = [bytearray(self.width) for _ in range(self.DEPTH)]
+
+    def __indexes(self, key: str) -> list[int]:
+        return [hash((row, key)) & (self.width - 1) for row in range(self.DEPTH)]
+
+    def increment(self, key: str) -> None:
+        for row, index in zip(self.__rows, self.__indexes(key)):
+            if row[index] < self.MAX_COUNT:
+                row[index] += 1
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            for row in self.__rows:
+                row[:] = row.translate(HALVE_COUNTERS)
+            self.additions //= 2
+
+    def frequency(self, key: str) -> int:
+        return min(row[index] for row, index in zip(self.__rows, self.__indexes(key)))
+
+class HotFont(object):
+
+    '''
+        A font file held in memory with its precompressed variants and
+        the cache index entry it was read for
+    '''
+
+    def __init__(self, content: bytes, variants: dict[str, bytes], mtime: float, entry: CacheIndexEntry) -> None:
+        self.content = content
+        self.variants = variants
+        self.mtime = mtime
+        self.entry = entry
+        self.size = len(content) + sum(len(variant) for variant in variants.values())
+
+def load_hot_font(path: str, entry: CacheIndexEntry, with_variants: bool) -> HotFont:
+    with open(path, 'rb') as font_file:
+        content = font_file.read()
+    variants = {}
+    for encoding in ENCODINGS if with_variants else ():
+        try:
+            with open(sidecar_path(path, encoding), 'rb') as sidecar_file:
+                variants[encoding] = sidecar_file.read()
+        except FileNotFoundError:
+            pass
+    return HotFont(content=content, variants=variants, mtime=stat(path).st_mtime, entry=entry)
+
+def resident_size(path: str, with_variants: bool) -> int:
+    '''
+        The amount of bytes the font file at path takes in memory, with
+        its precompressed variants
+    '''
+    size = stat(path).st_size
+    for encoding in ENCODINGS if with_variants else ():
+        try:
+            size += stat(sidecar_path(path, encoding)).st_size
+        except FileNotFoundError:
+            pass
+    return size
+
+class HotFontCache(object):
+
+    '''
+        Keeps the most requested font files of this worker in memory,
+        bounded by cache.hot_fonts_max_bytes, so serving them needs no
+        system call and no cache index lookup. Fonts are kept by their
+        file name in font locations and served as long as the entry they
+        were read for is fresh, as font locations never change their
+        content. Every request counts towards the frequency of its font,
+        and a font is only admitted once it was requested more often
+        than the fonts it would evict (TinyLFU), so one-off requests
+        never push hot fonts out.
+    '''
+
+    def __init__(self, max_bytes: int, max_file_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.admissions = 0
+        self.rejections = 0
+        self.sketch = FrequencySketch(width=max(max_bytes // (16 * 1024), 1024))
+        self.__fonts: OrderedDict[str, HotFont] = OrderedDict()
+        self.__loading: set[str] = set()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def get(self, name: str) -> Union[HotFont, None]:
+        self.sketch.increment(name)
+        hot_font = self.__fonts.get(name)
+        if hot_font is not None and not hot_font.entry.is_fresh:
+            self.size -= self.__fonts.pop(name).size
+            hot_font = None
+        if hot_font is None:
+            self.misses += 1
+            return None
+        self.__fonts.move_to_end(name)
+        self.hits += 1
+        return hot_font
+
+    def __victims(self, size: int) -> Union[list[str], None]:
+        '''
+            The least recently used fonts to evict to make room for size
+            bytes, None if size does not fit at all
+        '''
+        if size > self.max_bytes:
+            return None
+        victims = []
+        free = self.max_bytes - self.size
+        for name, hot_font in self.__fonts.items():
+            if free >= size:
+                break
+            victims.append(name)
+            free += hot_font.size
+        return victims
+
+    def __outweighs(self, name: str, victims: list[str]) -> bool:
+        '''
+            Whether the font was requested more often than every font it
+            would evict
+        '''
+        frequency = self.sketch.frequency(name)
+        return frequency >= 2 and all(self.sketch.frequency(victim) < frequency for victim in victims)
+
+    def admits(self, name: str, path: str, with_variants: bool) -> bool:
+
+        '''
+            Whether the font file at path should be loaded into memory,
+            taking the size of its precompressed variants into account
+
+            :raises FileNotFoundError: if the font file does not exist
+        '''
+
+        if name in self.__fonts or name in self.__loading or self.sketch.frequency(name) < 2:
+            return False
+        size = resident_size(path, with_variants)
+        victims = self.__victims(size)
+        if size > self.max_file_bytes or victims is None:
+            return False
+        if not self.__outweighs(name, victims):
+            self.rejections += 1
+            return False
+        return True
+
+    async def load(self, name: str, path: str, entry: CacheIndexEntry, with_variants: bool) -> Union[HotFont, None]:
+
+        '''
+            Reads an admitted font into memory. The fonts to evict for it
+            are chosen again by its actual size and must still be
+            requested less often than it.
+
+            :raises FileNotFoundError: if the font file does not exist
+            :returns: The font (None if it is not admitted anymore)
+        '''
+
+        self.__loading.add(name)
+        try:
+            hot_font = await to_thread(load_hot_font, path, entry, with_variants)
+        finally:
+            self.__loading.discard(name)
+        victims = self.__victims(hot_font.size)
+        if hot_font.size > self.max_file_bytes or victims is None:
+            return None
+        if not self.__outweighs(name, victims):
+            self.rejections += 1
+            return None
+        for victim in victims:
+            self.size -= self.__fonts.pop(victim).size
+        self.__fonts[name] = hot_font
+        self.size += hot_font.size
+        self.admissions += 1
+        return hot_font
+
+    @property
+    def stats(self) -> dict:
+        return dict(
+            fonts=len(self.__fonts),
+            size=self.size,
+            hits=self.hits,
+            misses=self.misses,
+            admissions=self.admissions,
+            rejections=self.rejections
+        )
+
+def get_hot_font_cache() -> HotFontCache:
+    global __GLOBAL_HOT_FONT_CACHE
+    if __GLOBAL_HOT_FONT_CACHE is None:
+        __GLOBAL_HOT_FONT_CACHE = HotFontCache(
+            max_bytes=from_config('cache', 'hot_fonts_max_bytes'),
+            max_file_bytes=from_config('cache', 'hot_fonts_max_file_bytes')
+        )
+    return __GLOBAL_HOT_FONT_CACHE
@@ -0,0 +1,432 @@
+from os.path import join as join_path
+from sqlite3 import Connection, connect
+from threading import local
+from time import time
+from typing import Iterable, Iterator, Union
+
+from gfo.config import Constants, from_config
+
+INDEX_FILE_NAME = 'index.sqlite3'
+ENTRY_KIND_BUNDLE = 'bundle'
+ENTRY_KIND_CSS = 'css'
+ENTRY_KIND_FONT = 'font'
+ENTRY_KIND_SUBSET = 'subset'
+
+'''
+    The kinds of entries that are served as font files
+'''
+FONT_ENTRY_KINDS = (ENTRY_KIND_FONT, ENTRY_KIND_SUBSET)
+
+__GLOBAL_CACHE_INDEX = None
+
+'''
+    The index only holds metadata of the cache directory, so instead of
+    migrating it, an index with an outdated schema is recreated (and the
+    then unindexed files are removed by the startup validation)
+'''
+SCHEMA_VERSION = 4
+SCHEMA = (
+    'DROP TABLE IF EXISTS entries',
+    'DROP TABLE IF EXISTS edges',
+    'DROP TABLE IF EXISTS sequence',
+    'DROP TABLE IF EXISTS access',
+    'DROP TABLE IF EXISTS evicted',
+    'DROP TABLE IF EXISTS clock',
+    '''
+        CREATE TABLE entries (
+            key TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            url TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            checksum TEXT NOT NULL,
+            content_type TEXT,
+            etag TEXT,
+            last_modified TEXT,
+            fetched_at REAL NOT NULL,
+            expires_at REAL NOT NULL,
+            encodings TEXT NOT NULL,
+            seq INTEGER NOT NULL
+        )
+    ''',
+    'CREATE INDEX entries_expires_at ON entries (expires_at)',
+    'CREATE INDEX entries_seq ON entries (seq)',
+    'CREATE INDEX entries_checksum ON entries (checksum)',
+    '''
+        CREATE TABLE edges (
+            css_key TEXT NOT NULL,
+            font_key TEXT NOT NULL,
+            PRIMARY KEY (css_key, font_key)
+        ) WITHOUT ROWID
+    ''',
+    'CREATE INDEX edges_font_key ON edges (font_key)',
+    'CREATE TABLE sequence (value INTEGER NOT NULL)',
+    'INSERT INTO sequence (value) VALUES (0)',
+    '''
+        CREATE TABLE access (
+            key TEXT PRIMARY KEY,
+            hits INTEGER NOT NULL,
+            last_access REAL NOT NULL,
+            priority REAL NOT NULL
+        ) WITHOUT ROWID
+    ''',
+    '''
+        CREATE TABLE evicted (
+            key TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            url TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        ) WITHOUT ROWID
+    ''',
+    'CREATE TABLE clock (value REAL NOT NULL)',
+    'INSERT INTO clock (value) VALUES (0)',
+)
+
+'''
+    Orderings of the eviction candidates per eviction policy. GDSF uses the
+    priority clock + hits / size, where the clock is raised to the priority
+    of the last evicted entry. Entries without recorded access get the
+    priority of a single hit.
+'''
+EVICTION_POLICY_ORDERINGS = dict(
+    lru='COALESCE(a.last_access, e.fetched_at) ASC',
+    lfu='COALESCE(a.hits, 0) ASC, COALESCE(a.last_access, e.fetched_at) ASC',
+    gdsf='COALESCE(a.priority, (SELECT value FROM clock) + 1.0 / MAX(e.size, 1)) ASC',
+)
+
+'''
+    Entries of text= requests (stylesheets with a text parameter and the
+    kit fonts from fonts.gstatic.com/l/font) that were requested at most
+    once are the long tail and get evicted before anything else
+'''
+EVICTION_LONG_TAIL_CONDITION = (
+    "COALESCE(a.hits, 0) <= 1 AND (e.url LIKE '%text=%' OR e.url LIKE '%/l/font?%')"
+)
+
+class CacheIndexEntry(object):
+
+    '''
+        The metadata of a single cached file (stylesheet or font)
+    '''
+
+    COLUMNS = (
+        'key', 'kind', 'url', 'size', 'checksum', 'content_type',
+        'etag', 'last_modified', 'fetched_at', 'expires_at', 'encodings'
+    )
+
+    def __init__(
+        self,
+        key: str,
+        kind: str,
+        url: str,
+        size: int,
+        checksum: str,
+        content_type: Union[str, None] = None,
+        etag: Union[str, None] = None,
+        last_modified: Union[str, None] = None,
+        fetched_at: Union[float, None] = None,
+        expires_at: Union[float, None] = None,
+        encodings: str = ''
+    ) -> None:
+        self.key = key
+        self.kind = kind
+        self.url = url
+        self.size = size
+        self.checksum = checksum
+        self.content_type = content_type
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched_at = time() if fetched_at is None else fetched_at
+        self.expires_at = (
+            self.fetched_at + from_config('misc', 'cache_lifespan_seconds')
+            if expires_at is None else expires_at
+        )
+        self.encodings = encodings
+
+    @property
+    def sidecar_encodings(self) -> tuple[str, ...]:
+        '''
+            The codings its file has precompressed sidecar files in, as
+            recorded when it was committed to the font store
+        '''
+        return tuple(self.encodings.split())
+
+    @property
+    def is_fresh(self) -> bool:
+        return self.expires_at > time()
+
+    @property
+    def is_revalidatable(self) -> bool:
+        '''
+            Whether the expired entry may still be served while it is
+            refreshed in the background
+        '''
+        return self.expires_at + from_config('cache', 'stale_while_revalidate_seconds') > time()
+
+    @property
+    def is_usable_on_error(self) -> bool:
+        '''
+            Whether the expired entry may still be served when refreshing
+            it fails
+        '''
+        return self.expires_at + from_config('cache', 'stale_if_error_seconds') > time()
+
+    @property
+    def retained_until(self) -> float:
+        '''
+            The expired entry is kept on disk as long as it may be served
+            stale
+        '''
+        return self.expires_at + max(
+            from_config('cache', 'stale_while_revalidate_seconds'),
+            from_config('cache', 'stale_if_error_seconds')
+        )
+
+    def as_row(self) -> tuple:
+        return tuple(getattr(self, column) for column in self.COLUMNS)
+
+class CacheIndex(object):
+
+    '''
+        The on-disk metadata index of the font cache, shared by all
+        workers and the service manager through SQLite (WAL mode). It
+        maps every cached file (keyed by the md5 of its upstream URL) to
+        its URL, size, checksum, upstream validators and expiry, and
+        records which font files belong to which stylesheet. The checksum
+        addresses the file's content in the font store (see FontStore). Cache hit
+        checks, expiry and cleanup decisions go through this index
+        instead of stat calls on the cache directory.
+    '''
+
+    def __init__(self, index_path: str) -> None:
+        self.index_path = index_path
+        self.__local = local()
+        with self.__connection as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            if connection.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+                for statement in SCHEMA:
+                    connection.execute(statement)
+                connection.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+    def __connect(self, name: str, timeout: float) -> Connection:
+        '''
+            SQLite connections must not be shared between threads, so
+            every thread (event loop, executor threads, services) gets
+            its own ones.
+        '''
+        connection = getattr(self.__local, name, None)
+        if connection is None:
+            connection = connect(self.index_path, timeout=timeout)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            setattr(self.__local, name, connection)
+        return connection
+
+    @property
+    def __connection(self) -> Connection:
+        return self.__connect('connection', Constants.Internal.CACHE_INDEX_WRITE_TIMEOUT)
+
+    @property
+    def __reader(self) -> Connection:
+        '''
+            get(), get_many() and evicted_url() serve requests on the
+            event loop, so they never wait long for a lock (readers of the
+            WAL database hardly ever need one). Writes must happen off the
+            event loop.
+        '''
+        return self.__connect('reader', Constants.Internal.CACHE_INDEX_READ_TIMEOUT)
+
+    def get(self, key: str) -> Union[CacheIndexEntry, None]:
+        row = self.__reader.execute(
+            f'SELECT {",".join(CacheIndexEntry.COLUMNS)} FROM entries WHERE key = ?',
+            (key,)
+        ).fetchone()
+        return None if row is None else CacheIndexEntry(*row)
+
+    def get_many(self, keys: Iterable[str]) -> dict[str, CacheIndexEntry]:
+        keys = list(keys)
+        entries = {}
+        for offset in range(0, len(keys), 500):
+            chunk = keys[offset:offset + 500]
+            for row in self.__reader.execute(
+                f'SELECT {",".join(CacheIndexEntry.COLUMNS)} FROM entries '
+                f'WHERE key IN ({",".join("?" * len(chunk))})',
+                chunk
+            ):
+                entries[row[0]] = CacheIndexEntry(*row)
+        return entries
+
+    def put(self, entry: CacheIndexEntry) -> None:
+        '''
+            Inserts or replaces the entry. Every write gets the next value
+            of a global sequence, so other processes can follow all
+            changes via changes_since().
+        '''
+        with self.__connection as connection:
+            connection.execute('UPDATE sequence SET value = value + 1')
+            connection.execute(
+                f'INSERT OR REPLACE INTO entries ({",".join(CacheIndexEntry.COLUMNS)}, seq) '
+                f'VALUES ({",".join("?" * len(CacheIndexEntry.COLUMNS))}, (SELECT value FROM sequence))',
+                entry.as_row()
+            )
+
+    def sequence(self) -> int:
+        return self.__connection.execute('SELECT value FROM sequence').fetchone()[0]
+
+    def changes_since(self, seq: int) -> tuple[int, list[CacheIndexEntry]]:
+        '''
+            Returns all entries written after the given sequence value
+            together with the sequence value of the latest of them
+        '''
+        entries = []
+        for row in self.__connection.execute(
+            f'SELECT {",".join(CacheIndexEntry.COLUMNS)}, seq FROM entries WHERE seq > ? ORDER BY seq',
+            (seq,)
+        ):
+            entries.append(CacheIndexEntry(*row[:-1]))
+            seq = row[-1]
+        return seq, entries
+
+    def references(self, checksum: str) -> int:
+        '''
+            The amount of entries whose content is stored in the blob
+            with the given checksum
+        '''
+        return self.__connection.execute(
+            'SELECT COUNT(*) FROM entries WHERE checksum = ? AND kind != ?',
+            (checksum, ENTRY_KIND_CSS)
+        ).fetchone()[0]
+
+    def set_edges(self, css_key: str, font_keys: Iterable[str]) -> None:
+        with self.__connection as connection:
+            connection.execute('DELETE FROM edges WHERE css_key = ?', (css_key,))
+            connection.executemany(
+                'INSERT OR IGNORE INTO edges (css_key, font_key) VALUES (?, ?)',
+                [(css_key, font_key) for font_key in font_keys]
+            )
+
+    def font_keys_of(self, css_key: str) -> list[str]:
+        return [
+            row[0] for row in self.__connection.execute(
+                'SELECT font_key FROM edges WHERE css_key = ?',
+                (css_key,)
+            )
+        ]
+
+    def expired(self, now: Union[float, None] = None, limit: int = 1000) -> list[CacheIndexEntry]:
+        return [
+            CacheIndexEntry(*row) for row in self.__connection.execute(
+                f'SELECT {",".join(CacheIndexEntry.COLUMNS)} FROM entries '
+                f'WHERE expires_at <= ? ORDER BY expires_at LIMIT ?',
+                (time() if now is None else now, limit)
+            )
+        ]
+
+    def entries(self) -> Iterator[CacheIndexEntry]:
+        for row in self.__connection.execute(
+            f'SELECT {",".join(CacheIndexEntry.COLUMNS)} FROM entries'
+        ):
+            yield CacheIndexEntry(*row)
+
+    def remove_if_unchanged(self, entry: CacheIndexEntry, evicted: bool = False) -> bool:
+        '''
+            Removes the entry only if it was not refreshed in the meantime
+            and returns whether it was removed. Evicted entries leave a
+            tombstone with their URL until they would have expired, so the
+            file can be restored on demand (see evicted_url).
+        '''
+        with self.__connection as connection:
+            removed = connection.execute(
+                'DELETE FROM entries WHERE key = ? AND expires_at = ?',
+                (entry.key, entry.expires_at)
+            ).rowcount > 0
+            if removed:
+                connection.execute('DELETE FROM edges WHERE css_key = ?', (entry.key,))
+                connection.execute('DELETE FROM access WHERE key = ?', (entry.key,))
+                if evicted:
+                    connection.execute(
+                        'INSERT OR REPLACE INTO evicted (key, kind, url, expires_at) VALUES (?, ?, ?, ?)',
+                        (entry.key, entry.kind, entry.url, entry.expires_at)
+                    )
+        return removed
+
+    def remove(self, keys: Iterable[str]) -> None:
+        keys = [(key,) for key in keys]
+        with self.__connection as connection:
+            connection.executemany('DELETE FROM entries WHERE key = ?', keys)
+            connection.executemany('DELETE FROM edges WHERE css_key = ?', keys)
+            connection.executemany('DELETE FROM access WHERE key = ?', keys)
+
+    def evicted_url(self, key: str, kind: str) -> Union[str, None]:
+        row = self.__reader.execute(
+            'SELECT url FROM evicted WHERE key = ? AND kind = ? AND expires_at > ?',
+            (key, kind, time())
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def purge_tombstones(self, now: Union[float, None] = None) -> None:
+        with self.__connection as connection:
+            connection.execute('DELETE FROM evicted WHERE expires_at <= ?', (time() if now is None else now,))
+
+    def record_accesses(self, accesses: dict[str, tuple[int, float]]) -> None:
+        '''
+            Adds the given hits (key -> (hits, last access timestamp)) to
+            the access statistics used for eviction
+        '''
+        with self.__connection as connection:
+            connection.executemany(
+                '''
+                    INSERT INTO access (key, hits, last_access, priority) VALUES (?, ?, ?, 0)
+                    ON CONFLICT (key) DO UPDATE SET
+                        hits = hits + excluded.hits,
+                        last_access = MAX(last_access, excluded.last_access)
+                ''',
+                [(key, hits, last_access) for key, (hits, last_access) in accesses.items()]
+            )
+            connection.executemany(
+                '''
+                    UPDATE access SET priority = (SELECT value FROM clock) + hits * 1.0 / MAX(
+                        COALESCE((SELECT size FROM entries WHERE entries.key = access.key), 1), 1
+                    ) WHERE key = ?
+                ''',
+                [(key,) for key in accesses]
+            )
+
+    def usage(self, subsets: bool = False) -> tuple[int, int]:
+        '''
+            The amount and size of the subset fonts or of all other
+            entries, as both have their own quota
+        '''
+        entries, size = self.__connection.execute(
+            f'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries WHERE kind {"=" if subsets else "!="} ?',
+            (ENTRY_KIND_SUBSET,)
+        ).fetchone()
+        return entries, size
+
+    def eviction_candidates(self, policy: str, limit: int, subsets: bool = False) -> list[tuple[CacheIndexEntry, float]]:
+        '''
+            Returns the entries (subset fonts or all others) to evict first
+            according to the eviction policy (lru, lfu or gdsf) together
+            with their GDSF priority
+        '''
+        return [
+            (CacheIndexEntry(*row[:-1]), row[-1]) for row in self.__connection.execute(
+                f'SELECT {",".join("e." + column for column in CacheIndexEntry.COLUMNS)}, '
+                f'COALESCE(a.priority, (SELECT value FROM clock) + 1.0 / MAX(e.size, 1)) '
+                f'FROM entries e LEFT JOIN access a ON a.key = e.key '
+                f'WHERE e.kind {"=" if subsets else "!="} ? '
+                f'ORDER BY ({EVICTION_LONG_TAIL_CONDITION}) DESC, {EVICTION_POLICY_ORDERINGS[policy]} LIMIT ?',
+                (ENTRY_KIND_SUBSET, limit)
+            )
+        ]
+
+    def set_clock(self, value: float) -> None:
+        with self.__connection as connection:
+            connection.execute('UPDATE clock SET value = MAX(value, ?)', (value,))
+
+def get_cache_index() -> CacheIndex:
+    global __GLOBAL_CACHE_INDEX
+    if __GLOBAL_CACHE_INDEX is None:
+        __GLOBAL_CACHE_INDEX = CacheIndex(
+            index_path=join_path(from_config('misc', 'font_cache_dir'), INDEX_FILE_NAME)
+        )
+    return __GLOBAL_CACHE_INDEX
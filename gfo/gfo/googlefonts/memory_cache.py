@@ -0,0 +1,84 @@
+from collections import OrderedDict
+from threading import Lock
+from time import time
+from typing import Any, Union
+
+from gfo.config import from_config
+
+__GLOBAL_CSS_MEMORY_CACHE = None
+
+class LRUCache(object):
+
+    '''
+        A bounded in-process LRU cache. Entries are evicted in least
+        recently used order once either the summed size of all entries
+        exceeds max_bytes or their amount exceeds max_entries. Every
+        entry carries its own expiry timestamp, expired entries count
+        as misses and are dropped on access.
+    '''
+
+    def __init__(self, max_bytes: int, max_entries: int) -> None:
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__entries: OrderedDict[str, tuple[Any, int, float]] = OrderedDict()
+        self.__lock = Lock()
+
+    def __drop(self, key: str) -> None:
+        _, size, _ = self.__entries.pop(key)
+        self.size -= size
+
+    def get(self, key: str) -> Union[Any, None]:
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, _, expires_at = entry
+            if expires_at <= time():
+                self.__drop(key)
+                self.misses += 1
+                return None
+            self.__entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: str, value: Any, size: int, expires_at: float) -> None:
+        with self.__lock:
+            if key in self.__entries:
+                self.__drop(key)
+            if size > self.max_bytes or self.max_entries < 1:
+                return
+            self.__entries[key] = (value, size, expires_at)
+            self.size += size
+            while self.size > self.max_bytes or len(self.__entries) > self.max_entries:
+                self.__drop(next(iter(self.__entries)))
+                self.evictions += 1
+
+    def invalidate(self, key: str) -> None:
+        with self.__lock:
+            if key in self.__entries:
+                self.__drop(key)
+
+    @property
+    def stats(self) -> dict:
+        with self.__lock:
+            return dict(
+                entries=len(self.__entries),
+                size=self.size,
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions
+            )
+
+def get_css_memory_cache() -> LRUCache:
+    global __GLOBAL_CSS_MEMORY_CACHE
+    if __GLOBAL_CSS_MEMORY_CACHE is None:
+        __GLOBAL_CSS_MEMORY_CACHE = LRUCache(
+            max_bytes=from_config('cache', 'css_memory_cache_max_bytes'),
+            max_entries=from_config('cache', 'css_memory_cache_max_entries')
+        )
+    return __GLOBAL_CSS_MEMORY_CACHE
@@ -0,0 +1,94 @@
+from asyncio import to_thread
+from collections import OrderedDict
+from os import O_RDONLY, close, fstat, open as open_fd
+from typing import Union
+
+from gfo.config import from_config
+
+__GLOBAL_OPEN_FILE_CACHE = None
+
+class OpenFile(object):
+
+    '''
+        A file descriptor of the open file cache, closed once it was
+        evicted and no response uses it anymore
+    '''
+
+    def __init__(self, path: str, fd: int) -> None:
+        stat = fstat(fd)
+        self.path = path
+        self.fd = fd
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime
+        self.users = 0
+        self.evicted = False
+
+    def close_if_unused(self) -> None:
+        if self.evicted and self.users == 0:
+            close(self.fd)
+
+class OpenFileCache(object):
+
+    '''
+        Keeps the descriptors of the most recently served cache files open
+        (at most cache.open_files_max per worker), so hot fonts are served
+        without opening them again. Blobs are content-addressed and never
+        change in place, so a descriptor always reads the content its
+        path had when it was opened. Only used from the event loop.
+    '''
+
+    def __init__(self, max_files: int) -> None:
+        self.max_files = max_files
+        self.hits = 0
+        self.misses = 0
+        self.__files: OrderedDict[str, OpenFile] = OrderedDict()
+
+    async def acquire(self, path: str) -> Union[OpenFile, None]:
+
+        '''
+            The open file at path (None if it does not exist), which must
+            be released once the response is sent
+        '''
+
+        open_file = self.__files.get(path)
+        if open_file is not None:
+            self.__files.move_to_end(path)
+            self.hits += 1
+        else:
+            self.misses += 1
+            try:
+                fd = await to_thread(open_fd, path, O_RDONLY)
+            except FileNotFoundError:
+                return None
+            open_file = OpenFile(path=path, fd=fd)
+            if path in self.__files: # opened concurrently by another request
+                self.__evict(open_file)
+                open_file = self.__files[path]
+            elif self.max_files > 0:
+                self.__files[path] = open_file
+                while len(self.__files) > self.max_files:
+                    self.__evict(self.__files.popitem(last=False)[1])
+            else:
+                open_file.evicted = True
+        open_file.users += 1
+        return open_file
+
+    def release(self, open_file: OpenFile) -> None:
+        open_file.users -= 1
+        open_file.close_if_unused()
+
+    def __evict(self, open_file: OpenFile) -> None:
+        open_file.evicted = True
+        open_file.close_if_unused()
+
+    @property
+    def stats(self) -> dict:
+        return dict(files=len(self.__files), hits=self.hits, misses=self.misses)
+
+def get_open_file_cache() -> OpenFileCache:
+    global __GLOBAL_OPEN_FILE_CACHE
+    if __GLOBAL_OPEN_FILE_CACHE is None:
+        __GLOBAL_OPEN_FILE_CACHE = OpenFileCache(
+            max_files=from_config('cache', 'open_files_max')
+        )
+    return __GLOBAL_OPEN_FILE_CACHE
@@ -0,0 +1,118 @@
+from bisect import bisect
+from hashlib import md5 as hash_md5
+from hmac import compare_digest
+from httpx import AsyncClient, Timeout
+from typing import Iterable, Union
+
+from gfo.config import from_config
+from gfo.exceptions import excstr
+from gfo.googlefonts.backends import unpack_entry
+from gfo.googlefonts.index import CacheIndexEntry
+from gfo.logging import get_logger
+
+PEER_FILL_PATH = '/internal/fill'
+
+__GLOBAL_PEER_FILL = None
+
+def ring_point(value: str) -> int:
+    return int(hash_md5(value.encode('utf-8')).hexdigest()[:16], 16)
+
+class HashRing(object):
+
+    '''
+        A consistent hash ring over the nodes of a deployment. Every node
+        is placed on it virtual_nodes times, so adding or removing a node
+        only moves the keys of its own points to other nodes.
+    '''
+
+    def __init__(self, nodes: Iterable[str], virtual_nodes: int) -> None:
+        points = sorted(
+            (ring_point(f'{node}#{replica}'), node)
+            for node in set(nodes)
+            for replica in range(max(virtual_nodes, 1))
+        )
+        self.__points = [point for point, _ in points]
+        self.__nodes = [node for _, node in points]
+
+    def owner(self, key: str) -> Union[str, None]:
+        if not self.__points:
+            return None
+        return self.__nodes[bisect(self.__points, ring_point(key)) % len(self.__points)]
+
+class PeerFill(object):
+
+    '''
+        Fills cache misses from the node owning the key on the consistent
+        hash ring of peers.urls: only the owner asks Google, the other
+        nodes fetch the entry from its internal fill endpoint. The owner
+        fills entries for peers from Google directly, so requests never
+        travel further than one node. Peers that fail or take longer than
+        peers.timeout_seconds are skipped and Google is asked instead.
+    '''
+
+    def __init__(self) -> None:
+        self.self_url: str = from_config('peers', 'self_url').rstrip('/')
+        self.secret: str = from_config('peers', 'secret')
+        urls = [url.rstrip('/') for url in from_config('peers', 'urls')]
+        self.enabled = bool(self.secret and self.self_url and len(urls) > 1)
+        if self.enabled and self.self_url not in urls:
+            get_logger().warn('peers.self_url is not listed in peers.urls - peer fill is disabled')
+            self.enabled = False
+        self.ring = HashRing(nodes=urls, virtual_nodes=from_config('peers', 'virtual_nodes'))
+        self.__client: Union[AsyncClient, None] = None
+
+    def __get_client(self) -> AsyncClient:
+        if self.__client is None:
+            self.__client = AsyncClient(timeout=Timeout(from_config('peers', 'timeout_seconds')))
+        return self.__client
+
+    def owner(self, key: str) -> Union[str, None]:
+        '''
+            The peer owning key, None if this node owns it itself
+        '''
+        if not self.enabled:
+            return None
+        owner = self.ring.owner(key)
+        return None if owner == self.self_url else owner
+
+    def is_authorized(self, authorization: str) -> bool:
+        return self.enabled and compare_digest(authorization.encode('utf-8'), f'Bearer {self.secret}'.encode('utf-8'))
+
+    async def fetch(self, key: str, kind: str, url: str, font_format: Union[str, None], reqid: str) -> Union[tuple[CacheIndexEntry, bytes], None]:
+
+        '''
+            Asks the owner of key to fill the entry of url (a stylesheet in
+            font_format or a font file) and hand it over
+
+            :returns: The entry and its content, None if this node owns key
+                      or the owner failed
+        '''
+
+        owner = self.owner(key)
+        if owner is None:
+            return None
+        params = dict(kind=kind, url=url)
+        if font_format is not None:
+            params['format'] = font_format
+        try:
+            response = await self.__get_client().get(
+                f'{owner}{PEER_FILL_PATH}',
+                params=params,
+                headers={'Authorization': f'Bearer {self.secret}'}
+            )
+            response.raise_for_status()
+            return unpack_entry(response.content)
+        except Exception as exc:
+            get_logger().warn(f'Failed to fill cache entry "{url}" from peer "{owner}" - asking Google. {excstr(exc)} [reqid={reqid}]')
+            return None
+
+    async def close(self) -> None:
+        if self.__client is not None:
+            await self.__client.aclose()
+            self.__client = None
+
+def get_peer_fill() -> PeerFill:
+    global __GLOBAL_PEER_FILL
+    if __GLOBAL_PEER_FILL is None:
+        __GLOBAL_PEER_FILL = PeerFill()
+    return __GLOBAL_PEER_FILL
@@ -0,0 +1,167 @@
+from hashlib import md5 as hash_md5
+from os import DirEntry, remove, scandir
+from os.path import isdir, join as join_path
+from shutil import rmtree
+from time import time
+from typing import Iterator
+
+from gfo.config import from_config
+from gfo.exceptions import excstr
+from gfo.googlefonts.compression import SIDECAR_SUFFIXES
+from gfo.googlefonts.index import CacheIndexEntry, ENTRY_KIND_CSS, ENTRY_KIND_FONT, ENTRY_KIND_SUBSET, INDEX_FILE_NAME, get_cache_index
+from gfo.googlefonts.storage import NAMESPACE_BLOBS, NAMESPACE_CSS, NAMESPACE_STAGING
+from gfo.googlefonts.transcoding import WOFF2_SUFFIX
+from gfo.logging import get_logger
+
+FONT_FILE_SIGNATURES = (
+    b'\x00\x01\x00\x00', # TrueType
+    b'OTTO',             # OpenType (CFF)
+    b'true',             # TrueType (Apple)
+    b'wOFF',             # WOFF
+    b'wOF2',             # WOFF2
+)
+
+def is_valid_cache_entry(path: str, entry: CacheIndexEntry, verify_checksum: bool) -> bool:
+
+    '''
+        Checks a cached file against its index entry. Font files (and
+        subset fonts) must carry a known font signature, stylesheets must
+        be valid UTF-8. Without checksum verification only the first bytes
+        of font files and bundle archives are read.
+    '''
+
+    with open(path, 'rb') as cache_file:
+        head = cache_file.read(4)
+        if entry.kind in (ENTRY_KIND_FONT, ENTRY_KIND_SUBSET) and head not in FONT_FILE_SIGNATURES:
+            return False
+        if entry.kind == ENTRY_KIND_CSS or verify_checksum:
+            content = head + cache_file.read()
+            if entry.kind == ENTRY_KIND_CSS:
+                try:
+                    content.decode('utf-8')
+                except UnicodeDecodeError:
+                    return False
+            if verify_checksum and hash_md5(content).hexdigest() != entry.checksum:
+                return False
+    return True
+
+def iter_shards(namespace_path: str) -> Iterator[DirEntry]:
+    '''
+        The files in the two levels of shard directories of a font store
+        namespace
+    '''
+    if not isdir(namespace_path):
+        return
+    with scandir(namespace_path) as first_level:
+        for first_level_entry in first_level:
+            if not first_level_entry.is_dir(follow_symlinks=False):
+                continue
+            with scandir(first_level_entry.path) as second_level:
+                for second_level_entry in second_level:
+                    if not second_level_entry.is_dir(follow_symlinks=False):
+                        continue
+                    with scandir(second_level_entry.path) as shard_entries:
+                        yield from shard_entries
+
+def validate_font_cache(font_cache_dir: str) -> dict:
+
+    '''
+        Reconciles a persistent font cache with its index. Keeps the
+        valid entries and removes everything else: orphaned staging
+        directories of previous workers, files without index entry
+        (including those of the flat layout of previous versions),
+        expired entries, entries whose size (or, with
+        cache.verify_checksums_on_startup, checksum) does not match the
+        index, corrupt files and index entries without file. Expired
+        entries are kept as long as they may still be served stale, and
+        precompressed and transcoded sidecar files as long as their blob
+        is kept. A blob is kept as long as one valid entry references it.
+        Uses scandir passes so the stat results come with the listing.
+
+        :param font_cache_dir: The font cache directory to validate
+        :returns: Counters of the kept and removed entries and bytes
+    '''
+
+    log = get_logger()
+    verify_checksum = from_config('cache', 'verify_checksums_on_startup')
+    index = get_cache_index()
+    indexed = {entry.key: entry for entry in index.entries()}
+    retained_by_checksum = {}
+    for entry in indexed.values():
+        if entry.kind != ENTRY_KIND_CSS and entry.retained_until > time():
+            retained_by_checksum.setdefault(entry.checksum, []).append(entry)
+    valid_keys = set()
+    valid_blobs = set()
+    sidecars = []
+    stats = dict(kept=0, kept_bytes=0, removed=0, removed_bytes=0, removed_staging_dirs=0)
+
+    def remove_invalid(dir_entry: DirEntry, file_size: int) -> None:
+        log.debug(f'Removing invalid, expired or unindexed font cache entry "{dir_entry.path}"')
+        remove(dir_entry.path)
+        stats['removed'] += 1
+        stats['removed_bytes'] += file_size
+
+    with scandir(font_cache_dir) as cache_dir_entries:
+        for dir_entry in cache_dir_entries:
+            try:
+                if dir_entry.is_dir(follow_symlinks=False):
+                    if dir_entry.name == NAMESPACE_STAGING:
+                        with scandir(dir_entry.path) as staging_dir_entries:
+                            for staging_dir_entry in staging_dir_entries:
+                                rmtree(staging_dir_entry.path)
+                                stats['removed_staging_dirs'] += 1
+                    elif dir_entry.name.startswith('stage-'):
+                        rmtree(dir_entry.path)
+                        stats['removed_staging_dirs'] += 1
+                    continue
+                if dir_entry.name.startswith(INDEX_FILE_NAME):
+                    continue
+                remove_invalid(dir_entry, dir_entry.stat(follow_symlinks=False).st_size)
+            except Exception as exc:
+                log.warn(f'Failed to validate font cache entry "{dir_entry.path}". {excstr(exc)}')
+
+    for dir_entry in iter_shards(join_path(font_cache_dir, NAMESPACE_CSS)):
+        try:
+            file_size = dir_entry.stat(follow_symlinks=False).st_size
+            entry = indexed.get(dir_entry.name)
+            if (
+                entry is not None and
+                entry.kind == ENTRY_KIND_CSS and
+                entry.retained_until > time() and
+                entry.size == file_size and
+                is_valid_cache_entry(dir_entry.path, entry, verify_checksum)
+            ):
+                valid_keys.add(entry.key)
+                stats['kept'] += 1
+                stats['kept_bytes'] += file_size
+                continue
+            remove_invalid(dir_entry, file_size)
+        except Exception as exc:
+            log.warn(f'Failed to validate font cache entry "{dir_entry.path}". {excstr(exc)}')
+
+    for dir_entry in iter_shards(join_path(font_cache_dir, NAMESPACE_BLOBS)):
+        try:
+            if dir_entry.name.endswith((*SIDECAR_SUFFIXES.values(), WOFF2_SUFFIX)):
+                sidecars.append(dir_entry)
+                continue
+            file_size = dir_entry.stat(follow_symlinks=False).st_size
+            entries = [entry for entry in retained_by_checksum.get(dir_entry.name, ()) if entry.size == file_size]
+            if entries and is_valid_cache_entry(dir_entry.path, entries[0], verify_checksum):
+                valid_keys.update(entry.key for entry in entries)
+                valid_blobs.add(dir_entry.name)
+                stats['kept'] += len(entries)
+                stats['kept_bytes'] += file_size
+                continue
+            remove_invalid(dir_entry, file_size)
+        except Exception as exc:
+            log.warn(f'Failed to validate font cache entry "{dir_entry.path}". {excstr(exc)}')
+
+    for dir_entry in sidecars:
+        if dir_entry.name.rsplit('.', 1)[0] in valid_blobs:
+            continue
+        try:
+            remove(dir_entry.path)
+        except Exception as exc:
+            log.warn(f'Failed to remove orphaned font cache sidecar file "{dir_entry.path}". {excstr(exc)}')
+    index.remove(key for key in indexed if key not in valid_keys)
+    return stats
@@ -0,0 +1,302 @@
+from asyncio import to_thread
+from email.utils import formatdate
+from fastapi import Request, Response
+from fastapi.responses import StreamingResponse
+from os import pread
+from re import compile as re_compile
+from starlette.types import Receive, Scope, Send
+from typing import Iterator, Union
+
+from gfo.config import from_config
+from gfo.googlefonts.compression import negotiate_encodings, sidecar_path
+from gfo.googlefonts.downloader import RewrittenStylesheet
+from gfo.googlefonts.hot_fonts import HotFont, get_hot_font_cache
+from gfo.googlefonts.index import CacheIndexEntry
+from gfo.googlefonts.open_files import OpenFile, get_open_file_cache
+from gfo.googlefonts.transcoding import WOFF2_SUFFIX, transcoded_path
+
+FILE_CHUNK_SIZE = 64 * 1024
+
+'''
+    The names of font files in font locations: the key of the font (or
+    subset font), with the suffix of its transcoded variant
+'''
+FONT_FILE_NAME = re_compile(r'[0-9a-f]{32}(?:\.woff2)?')
+
+'''
+    A single byte range, multiple ranges are answered with the full file
+'''
+BYTE_RANGE = re_compile(r'bytes=(\d*)-(\d*)')
+
+def etag_matches(req: Request, etag: str) -> bool:
+
+    '''
+        Whether the If-None-Match header of the request matches the given
+        ETag (weak comparison as required for If-None-Match)
+    '''
+
+    if_none_match = req.headers.get('if-none-match')
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    etag = etag.removeprefix('W/')
+    return any(
+        candidate.strip().removeprefix('W/') == etag
+        for candidate in if_none_match.split(',')
+    )
+
+def not_modified_response(headers: dict) -> Response:
+    return Response(status_code=304, headers=headers)
+
+def encoded_etag(etag: str, encoding: Union[str, None]) -> str:
+    '''
+        Every content coding is a representation of its own and needs a
+        strong ETag of its own
+    '''
+    return etag if encoding is None else f'{etag[:-1]}-{encoding}"'
+
+def stylesheet_response(req: Request, rewritten_css_sheet: RewrittenStylesheet) -> Response:
+
+    '''
+        Serves a rewritten stylesheet with its ETag in the best
+        precompressed coding the client accepts, or just a 304 if the
+        client already has it. Its font format depends on the client's
+        user agent.
+    '''
+
+    encodings = negotiate_encodings(
+        accept_encoding=req.headers.get('accept-encoding'),
+        available=tuple(rewritten_css_sheet.variants)
+    )
+    encoding = encodings[0] if encodings else None
+    headers = {
+        'cache-control': f'public, max-age={from_config("cache", "client_css_max_age_seconds")}',
+        'etag': encoded_etag(rewritten_css_sheet.etag, encoding)
+    }
+    vary = []
+    if rewritten_css_sheet.variants:
+        vary.append('Accept-Encoding')
+    if from_config('upstream', 'font_formats_by_user_agent'):
+        vary.append('User-Agent')
+    if vary:
+        headers['vary'] = ', '.join(vary)
+    if encoding is not None:
+        headers['content-encoding'] = encoding
+    if etag_matches(req, headers['etag']):
+        return not_modified_response(headers)
+    return Response(
+        content=rewritten_css_sheet.content if encoding is None else rewritten_css_sheet.variants[encoding],
+        media_type='text/css',
+        headers=headers
+    )
+
+def parse_byte_range(range_header: Union[str, None], size: int) -> Union[tuple[int, int], None, bool]:
+
+    '''
+        The first and last byte of the single byte range requested by the
+        Range header
+
+        :returns: The range, None to serve the full file or False if the
+                  range is not satisfiable
+    '''
+
+    match = BYTE_RANGE.fullmatch((range_header or '').strip())
+    if match is None or match.group(1) == match.group(2) == '':
+        return None
+    first, last = match.groups()
+    if first == '':
+        if int(last) == 0:
+            return False
+        return max(size - int(last), 0), size - 1
+    if int(first) >= size:
+        return False
+    if last == '' or int(last) >= size:
+        return int(first), size - 1
+    if int(last) < int(first):
+        return None
+    return int(first), int(last)
+
+class RangeResponse(Response):
+
+    '''
+        A response of size bytes that answers a single byte range of
+        them (206, or 416 if it is not satisfiable) and HEAD requests
+    '''
+
+    def __init__(self, req: Request, size: int, mtime: float, headers: dict, media_type: str) -> None:
+        self.offset = 0
+        self.count = size
+        headers = dict(headers, **{'accept-ranges': 'bytes', 'last-modified': formatdate(mtime, usegmt=True)})
+        status_code = 200
+        if_range = req.headers.get('if-range')
+        byte_range = parse_byte_range(req.headers.get('range'), size)
+        if byte_range is not None and (if_range is None or if_range.strip() in (headers.get('etag'), headers['last-modified'])):
+            if byte_range is False:
+                status_code = 416
+                self.count = 0
+                headers['content-range'] = f'bytes */{size}'
+            else:
+                status_code = 206
+                self.offset, last = byte_range
+                self.count = last - self.offset + 1
+                headers['content-range'] = f'bytes {self.offset}-{last}/{size}'
+        super().__init__(status_code=status_code, headers=headers, media_type=media_type)
+        self.headers['content-length'] = str(self.count)
+
+class FontFileResponse(RangeResponse):
+
+    '''
+        Sends a cached file from a descriptor of the open file cache.
+        Servers supporting the ASGI zero-copy extension send it with
+        sendfile, servers supporting path sending send complete files
+        themselves, all others get it read with pread in chunks off the
+        event loop.
+    '''
+
+    def __init__(self, req: Request, open_file: OpenFile, headers: dict, media_type: str) -> None:
+        self.open_file = open_file
+        super().__init__(req=req, size=open_file.size, mtime=open_file.mtime, headers=headers, media_type=media_type)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        extensions = scope.get('extensions') or {}
+        try:
+            await send({'type': 'http.response.start', 'status': self.status_code, 'headers': self.raw_headers})
+            if scope['method'] == 'HEAD' or self.count == 0:
+                await send({'type': 'http.response.body', 'body': b''})
+            elif 'http.response.zerocopy' in extensions:
+                with open(self.open_file.fd, 'rb', closefd=False) as file:
+                    await send({'type': 'http.response.zerocopy', 'file': file, 'offset': self.offset, 'count': self.count})
+            elif 'http.response.pathsend' in extensions and self.count == self.open_file.size:
+                await send({'type': 'http.response.pathsend', 'path': self.open_file.path})
+            else:
+                offset = self.offset
+                end = self.offset + self.count
+                while offset < end:
+                    chunk = await to_thread(pread, self.open_file.fd, min(FILE_CHUNK_SIZE, end - offset), offset)
+                    if not chunk:
+                        raise RuntimeError(f'The file "{self.open_file.path}" is shorter than expected')
+                    offset += len(chunk)
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': offset < end})
+        finally:
+            get_open_file_cache().release(self.open_file)
+        if self.background is not None:
+            await self.background()
+
+class HotFontResponse(RangeResponse):
+
+    '''
+        Sends a font file (or one of its variants) held in memory
+    '''
+
+    def __init__(self, req: Request, content: bytes, mtime: float, headers: dict, media_type: str) -> None:
+        self.content = content
+        super().__init__(req=req, size=len(content), mtime=mtime, headers=headers, media_type=media_type)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await send({'type': 'http.response.start', 'status': self.status_code, 'headers': self.raw_headers})
+        if scope['method'] == 'HEAD' or self.count == 0:
+            body = b''
+        elif self.count == len(self.content):
+            body = self.content
+        else:
+            body = self.content[self.offset:self.offset + self.count]
+        await send({'type': 'http.response.body', 'body': body})
+        if self.background is not None:
+            await self.background()
+
+def bundle_response(req: Request, bundle: Union[OpenFile, Iterator[bytes]], archive_format: str) -> Response:
+    '''
+        Sends a cached bundle archive from its open file (with byte range
+        support) or streams a new one while it is cached
+    '''
+    headers = {'content-disposition': f'attachment; filename=gfo-bundle.{archive_format}'}
+    if isinstance(bundle, OpenFile):
+        return FontFileResponse(req=req, open_file=bundle, headers=headers, media_type='application/octet-stream')
+    return StreamingResponse(bundle, media_type='application/octet-stream', headers=headers)
+
+def font_headers() -> dict:
+    return {
+        'cache-control': f'public, max-age={from_config("cache", "client_font_max_age_seconds")}, immutable'
+    }
+
+async def font_response(
+    req: Request,
+    font_path: str,
+    entry: Union[CacheIndexEntry, None],
+    transcoded: bool = False
+) -> Response:
+
+    '''
+        Serves a cached font file. Font locations are derived from the
+        (versioned) upstream URL and never change their content, so they
+        are cacheable for cache.client_font_max_age_seconds and immutable.
+        The ETag is the checksum recorded in the cache index. Fonts whose
+        entry records precompressed sidecar files are served in the best
+        of their codings the client accepts. With transcoded, the locally
+        transcoded WOFF2 variant is served instead. Fonts that became
+        hot are loaded into memory (see HotFontCache) and served from
+        there by hot_font_response from then on.
+
+        :raises FileNotFoundError: if the font file vanished meanwhile
+    '''
+
+    hot_fonts = get_hot_font_cache()
+    if hot_fonts.enabled and entry is not None and entry.is_fresh:
+        name = f'{entry.key}{WOFF2_SUFFIX}' if transcoded else entry.key
+        path = transcoded_path(font_path) if transcoded else font_path
+        if hot_fonts.admits(name=name, path=path, with_variants=not transcoded):
+            hot_font = await hot_fonts.load(name=name, path=path, entry=entry, with_variants=not transcoded)
+            if hot_font is not None:
+                return hot_font_response(req=req, hot_font=hot_font, transcoded=transcoded)
+    headers = font_headers()
+    open_files = get_open_file_cache()
+    open_file = None
+    encoding = None
+    if not transcoded and entry is not None and entry.sidecar_encodings:
+        headers['vary'] = 'Accept-Encoding'
+        for candidate in negotiate_encodings(req.headers.get('accept-encoding'), available=entry.sidecar_encodings):
+            open_file = await open_files.acquire(sidecar_path(font_path, candidate))
+            if open_file is not None:
+                encoding = candidate
+                headers['content-encoding'] = encoding
+                break
+    if open_file is None:
+        open_file = await open_files.acquire(transcoded_path(font_path) if transcoded else font_path)
+    if open_file is None:
+        raise FileNotFoundError(font_path)
+    if entry is not None:
+        headers['etag'] = encoded_etag(f'"{entry.checksum}"', 'woff2' if transcoded else encoding)
+        if etag_matches(req, headers['etag']):
+            open_files.release(open_file)
+            return not_modified_response(headers)
+    return FontFileResponse(
+        req=req,
+        open_file=open_file,
+        headers=headers,
+        media_type='application/octet-stream'
+    )
+
+def hot_font_response(req: Request, hot_font: HotFont, transcoded: bool = False) -> Response:
+    '''
+        Serves a font from memory like font_response serves it from its
+        file
+    '''
+    headers = font_headers()
+    encoding = None
+    if hot_font.variants:
+        headers['vary'] = 'Accept-Encoding'
+        encodings = negotiate_encodings(req.headers.get('accept-encoding'), available=tuple(hot_font.variants))
+        if encodings:
+            encoding = encodings[0]
+            headers['content-encoding'] = encoding
+    headers['etag'] = encoded_etag(f'"{hot_font.entry.checksum}"', 'woff2' if transcoded else encoding)
+    if etag_matches(req, headers['etag']):
+        return not_modified_response(headers)
+    return HotFontResponse(
+        req=req,
+        content=hot_font.content if encoding is None else hot_font.variants[encoding],
+        mtime=hot_font.mtime,
+        headers=headers,
+        media_type='application/octet-stream'
+    )
@@ -0,0 +1,141 @@
+from asyncio import CancelledError, Future, get_running_loop, shield, sleep
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+from fcntl import flock, LOCK_EX, LOCK_NB, LOCK_UN
+from os import O_CREAT, O_RDWR, close, makedirs, open as open_fd
+from os.path import join as join_path
+from time import monotonic
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterator
+
+from gfo.config import from_config
+from gfo.googlefonts.backends import get_cache_backend
+from gfo.logging import get_logger
+
+__GLOBAL_SINGLE_FLIGHT = None
+
+class SingleFlight(object):
+
+    '''
+        Coalesces concurrent cache fills per key (the md5 of the upstream
+        URL). Within a worker only the first coroutine asking for a key
+        performs the fill, all others await its result. Across workers
+        the fill is serialized by an exclusive flock on a lock file, so a
+        worker that had to wait re-checks the cache and finds it filled.
+        The kernel drops the flock when its holder dies, and waiting for
+        it is bounded by upstream.single_flight_timeout_seconds. Across
+        nodes the fill is serialized by the lock of the cache backend,
+        except for fills on behalf of a peer (distributed=False): the
+        requesting peer holds that lock already while it waits for them,
+        so they never join a local fill that still waits for it either.
+    '''
+
+    def __init__(self, lock_dir: str) -> None:
+        self.lock_dir = lock_dir
+        self.timeout: float = from_config('upstream', 'single_flight_timeout_seconds')
+        self.__in_flight: dict[str, Future] = {}
+        self.__awaiting_backend: set[str] = set()
+        makedirs(self.lock_dir, exist_ok=True)
+
+    def __lock_path(self, key: str) -> str:
+        return join_path(self.lock_dir, f'{key[:2]}.lock')
+
+    @contextmanager
+    def try_lock(self, key: str) -> Iterator[bool]:
+        '''
+            Non-blocking variant of the cross-worker lock for synchronous
+            callers (e.g. services) that must not modify an entry while a
+            worker fills it. Yields whether the lock was acquired.
+        '''
+        fd = open_fd(self.__lock_path(key), O_CREAT | O_RDWR, 0o644)
+        try:
+            try:
+                flock(fd, LOCK_EX | LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                flock(fd, LOCK_UN)
+        finally:
+            close(fd)
+
+    @asynccontextmanager
+    async def __file_lock(self, key: str) -> AsyncIterator[None]:
+        '''
+            Lock files are striped by the first two hex digits of the key
+            to keep their number bounded (256). Acquisition polls with a
+            non-blocking flock so a cancelled request never leaves a lock
+            behind in some executor thread.
+        '''
+        fd = open_fd(self.__lock_path(key), O_CREAT | O_RDWR, 0o644)
+        locked = False
+        try:
+            deadline = monotonic() + self.timeout
+            delay = .005
+            while 1:
+                try:
+                    flock(fd, LOCK_EX | LOCK_NB)
+                    locked = True
+                    break
+                except BlockingIOError:
+                    if monotonic() > deadline:
+                        get_logger().warn(
+                            f'Waited more than {self.timeout}s for the cache fill lock '
+                            f'of key "{key}" - filling without it'
+                        )
+                        break
+                    await sleep(delay)
+                    delay = min(delay * 2, .05)
+            yield
+        finally:
+            if locked:
+                flock(fd, LOCK_UN)
+            close(fd)
+
+    @asynccontextmanager
+    async def __backend_lock(self, key: str) -> AsyncIterator[None]:
+        self.__awaiting_backend.add(key)
+        try:
+            async with get_cache_backend().lock(key):
+                self.__awaiting_backend.discard(key)
+                yield
+        finally:
+            self.__awaiting_backend.discard(key)
+
+    async def do(self, key: str, fill: Callable[[], Awaitable[Any]], distributed: bool = True) -> Any:
+        while (future := self.__in_flight.get(key)) is not None:
+            if not distributed and key in self.__awaiting_backend:
+                # the local fill may wait for the peer that asked us - fill beside it
+                async with self.__file_lock(key):
+                    return await fill()
+            try:
+                return await shield(future)
+            except CancelledError:
+                if not future.cancelled():
+                    raise
+                # the filling request got cancelled - take over its fill
+        future = get_running_loop().create_future()
+        self.__in_flight[key] = future
+        try:
+            async with self.__backend_lock(key) if distributed else nullcontext(), self.__file_lock(key):
+                result = await fill()
+        except CancelledError:
+            future.cancel()
+            raise
+        except BaseException as exc:
+            future.set_exception(exc)
+            future.exception() # mark as retrieved in case nobody was waiting
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self.__in_flight[key]
+
+def get_single_flight() -> SingleFlight:
+    global __GLOBAL_SINGLE_FLIGHT
+    if __GLOBAL_SINGLE_FLIGHT is None:
+        __GLOBAL_SINGLE_FLIGHT = SingleFlight(
+            lock_dir=join_path(from_config('misc', 'font_cache_dir'), 'locks')
+        )
+    return __GLOBAL_SINGLE_FLIGHT
@@ -0,0 +1,167 @@
+from contextlib import contextmanager
+from fcntl import flock, LOCK_EX, LOCK_UN
+from os import O_CREAT, O_RDWR, close, makedirs, open as open_fd, remove
+from os.path import dirname, isfile, join as join_path
+from shutil import move
+from typing import Iterator, Union
+
+from gfo.config import from_config
+from gfo.googlefonts.compression import ENCODINGS, remove_sidecars, sidecar_path
+from gfo.googlefonts.index import CacheIndexEntry, ENTRY_KIND_CSS, get_cache_index
+from gfo.googlefonts.transcoding import remove_transcoded
+
+NAMESPACE_BLOBS = 'blobs'
+NAMESPACE_CSS = 'css'
+NAMESPACE_STAGING = 'staging'
+BLOB_LOCK_FILE_NAME = 'blobs.lock'
+
+__GLOBAL_FONT_STORE = None
+
+def shard(name: str) -> str:
+    '''
+        Two levels of 256 subdirectories each, so no directory holds more
+        than a few entries even with millions of them
+    '''
+    return join_path(name[:2], name[2:4], name)
+
+class FontStore(object):
+
+    '''
+        The files of the font cache directory, laid out as
+
+            css/ab/cd/<key>          stylesheets by their key (md5 of their URL)
+            blobs/ab/cd/<checksum>   fonts, subset fonts and bundle archives by
+                                     the md5 of their content, next to their
+                                     precompressed and transcoded variants
+            staging/<worker>/        the staging directory of every worker
+
+        The cache index maps every key to the checksum of its content, so it
+        is the alias table from URLs to blobs: the same bytes reached
+        through different URLs are stored once, and a blob is only removed
+        with the last entry referencing it. Storing and releasing blobs is
+        serialized across workers by a lock file, so commit() and
+        release() block and are called off the event loop.
+    '''
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+        self.lock_path = join_path(root, 'locks', BLOB_LOCK_FILE_NAME)
+        makedirs(dirname(self.lock_path), exist_ok=True)
+
+    @contextmanager
+    def __blob_lock(self) -> Iterator[None]:
+        fd = open_fd(self.lock_path, O_CREAT | O_RDWR, 0o644)
+        try:
+            flock(fd, LOCK_EX)
+            try:
+                yield
+            finally:
+                flock(fd, LOCK_UN)
+        finally:
+            close(fd)
+
+    def css_path(self, key: str) -> str:
+        return join_path(self.root, NAMESPACE_CSS, shard(key))
+
+    def blob_path(self, checksum: str) -> str:
+        return join_path(self.root, NAMESPACE_BLOBS, shard(checksum))
+
+    def path(self, entry: CacheIndexEntry) -> str:
+        if entry.kind == ENTRY_KIND_CSS:
+            return self.css_path(entry.key)
+        return self.blob_path(entry.checksum)
+
+    def exists(self, entry: Union[CacheIndexEntry, None]) -> bool:
+        return entry is not None and isfile(self.path(entry))
+
+    def lookup(self, key: str) -> Union[tuple[CacheIndexEntry, str], None]:
+        '''
+            The entry of key and the path of its file, None if it is not
+            cached
+        '''
+        entry = get_cache_index().get(key)
+        if not self.exists(entry):
+            return None
+        return entry, self.path(entry)
+
+    def staging_path(self, worker_id: str) -> str:
+        path = join_path(self.root, NAMESPACE_STAGING, worker_id)
+        makedirs(path, exist_ok=True)
+        return path
+
+    def commit(
+        self,
+        entry: CacheIndexEntry,
+        staged_path: str,
+        variants: Union[dict[str, bytes], None] = None
+    ) -> None:
+
+        '''
+            Moves a completely written staging file into the cache and
+            records its entry in the cache index. Blobs that are stored
+            already are kept, so the staging file is dropped then.
+            Precompressed variants are written next to the blob unless it
+            has them already. The entry records the variants the blob has,
+            so requests don't look for them. The blob an entry referenced
+            before is released once the entry points to its new content.
+        '''
+
+        path = self.path(entry)
+        makedirs(dirname(path), exist_ok=True)
+        if entry.kind == ENTRY_KIND_CSS:
+            move(src=staged_path, dst=path)
+            get_cache_index().put(entry)
+            return
+        index = get_cache_index()
+        with self.__blob_lock():
+            previous = index.get(entry.key)
+            encodings = []
+            for encoding in ENCODINGS:
+                if not isfile(sidecar_path(path, encoding)):
+                    if encoding not in (variants or {}):
+                        continue
+                    with open(sidecar_path(staged_path, encoding), 'wb') as staging_file:
+                        staging_file.write(variants[encoding])
+                    move(src=sidecar_path(staged_path, encoding), dst=sidecar_path(path, encoding))
+                encodings.append(encoding)
+            entry.encodings = ' '.join(encodings)
+            if isfile(path):
+                remove(staged_path)
+            else:
+                move(src=staged_path, dst=path)
+            index.put(entry)
+            if previous is not None and previous.checksum != entry.checksum and index.references(previous.checksum) == 0:
+                self.__unlink(self.blob_path(previous.checksum))
+
+    def release(self, entry: CacheIndexEntry) -> None:
+
+        '''
+            Removes the file of an entry that was removed from the cache
+            index, unless it is a blob still referenced by another entry.
+            Files are only unlinked, so readers are not affected.
+        '''
+
+        path = self.path(entry)
+        if entry.kind == ENTRY_KIND_CSS:
+            self.__unlink(path)
+            return
+        with self.__blob_lock():
+            if get_cache_index().references(entry.checksum) > 0:
+                return
+            self.__unlink(path)
+
+    def __unlink(self, path: str) -> None:
+        try:
+            remove(path)
+        except FileNotFoundError:
+            pass
+        remove_sidecars(path)
+        remove_transcoded(path)
+
+def get_font_store() -> FontStore:
+    global __GLOBAL_FONT_STORE
+    if __GLOBAL_FONT_STORE is None:
+        __GLOBAL_FONT_STORE = FontStore(
+            root=from_config('misc', 'font_cache_dir')
+        )
+    return __GLOBAL_FONT_STORE
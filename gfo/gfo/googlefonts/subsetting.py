@@ -0,0 +1,84 @@
+from asyncio import get_running_loop
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import md5 as hash_md5
+from multiprocessing import get_context
+from os import getpid, remove, rename
+from os.path import isfile
+from typing import Union
+
+from gfo.config import from_config
+from gfo.logging import get_logger
+
+try:
+    from fontTools.subset import Options, Subsetter
+    from fontTools.ttLib import TTFont
+except ImportError: # fontTools is optional, text= requests are passed to Google without it
+    Options = Subsetter = TTFont = None
+
+__GLOBAL_FONT_SUBSETTER = None
+
+def subset_font(font_path: str, subset_path: str, text: str) -> tuple[int, str]:
+
+    '''
+        Reduces a cached font to the glyphs of text, keeping its format
+        (TrueType, WOFF or WOFF2). Runs in a pool process, the result is
+        written to a temporary file first so readers never see a partial
+        file.
+
+        :returns: The size and md5 checksum of the subset font
+    '''
+
+    font = TTFont(font_path)
+    options = Options()
+    options.flavor = font.flavor
+    subsetter = Subsetter(options=options)
+    subsetter.populate(text=text)
+    subsetter.subset(font)
+    temporary_path = f'{subset_path}.{getpid()}.tmp'
+    try:
+        font.save(temporary_path)
+        with open(temporary_path, 'rb') as subset_file:
+            content = subset_file.read()
+        rename(temporary_path, subset_path)
+    finally:
+        if isfile(temporary_path):
+            remove(temporary_path)
+    return len(content), hash_md5(content).hexdigest()
+
+class FontSubsetter(object):
+
+    '''
+        Subsets cached fonts for text= requests in a process pool of
+        cache.subset_text_workers processes per worker, so a single
+        cached font serves every text instead of Google being asked for
+        each unique text.
+    '''
+
+    def __init__(self) -> None:
+        self.enabled: bool = from_config('cache', 'subset_text_locally')
+        if self.enabled and TTFont is None:
+            get_logger().warn('cache.subset_text_locally is enabled, but fontTools is not installed - text= requests are passed to Google')
+            self.enabled = False
+        self.__executor: Union[ProcessPoolExecutor, None] = None
+
+    def __get_executor(self) -> ProcessPoolExecutor:
+        if self.__executor is None:
+            self.__executor = ProcessPoolExecutor(
+                max_workers=from_config('cache', 'subset_text_workers'),
+                mp_context=get_context('spawn')
+            )
+        return self.__executor
+
+    async def subset(self, font_path: str, subset_path: str, text: str) -> tuple[int, str]:
+        return await get_running_loop().run_in_executor(self.__get_executor(), subset_font, font_path, subset_path, text)
+
+    def close(self) -> None:
+        if self.__executor is not None:
+            self.__executor.shutdown(wait=False, cancel_futures=True)
+            self.__executor = None
+
+def get_font_subsetter() -> FontSubsetter:
+    global __GLOBAL_FONT_SUBSETTER
+    if __GLOBAL_FONT_SUBSETTER is None:
+        __GLOBAL_FONT_SUBSETTER = FontSubsetter()
+    return __GLOBAL_FONT_SUBSETTER
@@ -0,0 +1,111 @@
+from asyncio import get_running_loop
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from os import getpid, remove, rename
+from os.path import isfile
+from typing import Union
+
+from gfo.config import from_config
+from gfo.exceptions import excstr
+from gfo.logging import get_logger
+
+try:
+    from fontTools.ttLib import TTFont
+except ImportError: # fontTools is optional, transcoding is disabled without it
+    TTFont = None
+
+WOFF2_SUFFIX = '.woff2'
+
+__GLOBAL_WOFF2_TRANSCODER = None
+
+def transcoded_path(font_path: str) -> str:
+    return f'{font_path}{WOFF2_SUFFIX}'
+
+def remove_transcoded(font_path: str) -> None:
+    try:
+        remove(transcoded_path(font_path))
+    except FileNotFoundError:
+        pass
+
+def transcode_to_woff2(font_path: str) -> None:
+
+    '''
+        Converts a cached TrueType/OpenType font to WOFF2 next to it. Runs
+        in a pool process, the result is written to a temporary file first
+        so readers never see a partial file.
+    '''
+
+    woff2_path = transcoded_path(font_path)
+    if isfile(woff2_path):
+        return
+    font = TTFont(font_path)
+    font.flavor = 'woff2'
+    temporary_path = f'{woff2_path}.{getpid()}.tmp'
+    try:
+        font.save(temporary_path)
+        rename(temporary_path, woff2_path)
+    finally:
+        if isfile(temporary_path):
+            remove(temporary_path)
+
+class WOFF2Transcoder(object):
+
+    '''
+        Transcodes cached TTF fonts to WOFF2 in a background process pool
+        of cache.transcode_woff2_workers processes per worker. Requests
+        never wait for it: they serve TTF until the WOFF2 file exists.
+        Fonts that failed to transcode are not retried by this worker.
+    '''
+
+    def __init__(self) -> None:
+        self.enabled: bool = from_config('cache', 'transcode_woff2')
+        if self.enabled and TTFont is None:
+            get_logger().warn('cache.transcode_woff2 is enabled, but fontTools is not installed - transcoding is disabled')
+            self.enabled = False
+        self.__executor: Union[ProcessPoolExecutor, None] = None
+        self.__pending: set[str] = set()
+        self.__failed: set[str] = set()
+
+    def __get_executor(self) -> ProcessPoolExecutor:
+        if self.__executor is None:
+            self.__executor = ProcessPoolExecutor(
+                max_workers=from_config('cache', 'transcode_woff2_workers'),
+                mp_context=get_context('spawn')
+            )
+        return self.__executor
+
+    def is_available(self, font_path: str) -> bool:
+        return isfile(transcoded_path(font_path))
+
+    def is_settled(self, font_path: str) -> bool:
+        '''
+            Whether the font's WOFF2 variant exists or will never exist
+        '''
+        return not self.enabled or font_path in self.__failed or self.is_available(font_path)
+
+    def schedule(self, font_path: str) -> None:
+        if not self.enabled or font_path in self.__pending or font_path in self.__failed:
+            return
+        self.__pending.add(font_path)
+        future = get_running_loop().run_in_executor(self.__get_executor(), transcode_to_woff2, font_path)
+
+        def done(future) -> None:
+            self.__pending.discard(font_path)
+            if future.cancelled():
+                return
+            if future.exception() is not None:
+                self.__failed.add(font_path)
+                get_logger().warn(f'Failed to transcode font file "{font_path}" to WOFF2. {excstr(future.exception())}')
+
+        future.add_done_callback(done)
+
+    def close(self) -> None:
+        if self.__executor is not None:
+            self.__executor.shutdown(wait=False, cancel_futures=True)
+            self.__executor = None
+
+def get_woff2_transcoder() -> WOFF2Transcoder:
+    global __GLOBAL_WOFF2_TRANSCODER
+    if __GLOBAL_WOFF2_TRANSCODER is None:
+        __GLOBAL_WOFF2_TRANSCODER = WOFF2Transcoder()
+    return __GLOBAL_WOFF2_TRANSCODER
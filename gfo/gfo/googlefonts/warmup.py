@@ -0,0 +1,126 @@
+from asyncio import Semaphore, as_completed
+from html import unescape
+from httpx import AsyncClient, Timeout, URL
+from re import compile as re_compile
+from typing import AsyncIterator, Iterable
+from urllib.parse import urljoin
+
+from gfo.config import from_config
+from gfo.exceptions import excstr
+from gfo.exceptions.googlefonts import GGoogleFontsBadRequestException
+from gfo.googlefonts.downloader import get_google_fonts_downloader
+from gfo.libaccelerate.helpers import get_id
+from gfo.logging import get_logger
+
+'''
+    Links to css/css2 stylesheets in HTML pages, i.e. to Google's API or
+    to a GFO instance embedded in place of it
+'''
+STYLESHEET_LINK = re_compile(r'''(?:https?:)?//[^\s"'<>()]+/css2?\?[^\s"'<>()]*''')
+
+def load_manifest(manifest_path: str) -> list[str]:
+
+    '''
+        Reads a warmup manifest: one stylesheet URL per line, empty lines
+        and lines starting with # are ignored
+    '''
+
+    with open(manifest_path, 'r', encoding='utf-8') as manifest_file:
+        return [
+            line.strip() for line in manifest_file
+            if line.strip() and not line.strip().startswith('#')
+        ]
+
+def extract_stylesheet_urls(html: str, page_url: str) -> list[str]:
+    urls = []
+    for match in STYLESHEET_LINK.finditer(html):
+        url = urljoin(page_url, unescape(match.group(0)))
+        if 'family' in URL(url).params and url not in urls:
+            urls.append(url)
+    return urls
+
+async def crawl_pages(pages: Iterable[str]) -> list[str]:
+
+    '''
+        Collects the stylesheet URLs linked in the given site pages.
+        Pages that fail to load are logged and skipped.
+    '''
+
+    log = get_logger()
+    urls = []
+    timeout = Timeout(
+        connect=from_config('upstream', 'connect_timeout_seconds'),
+        read=from_config('upstream', 'read_timeout_seconds'),
+        write=from_config('upstream', 'read_timeout_seconds'),
+        pool=from_config('upstream', 'pool_timeout_seconds')
+    )
+    async with AsyncClient(timeout=timeout, follow_redirects=True) as client:
+        for page_url in pages:
+            try:
+                response = await client.get(page_url)
+                response.raise_for_status()
+            except Exception as exc:
+                log.warn(f'Failed to crawl page "{page_url}" for stylesheets to warm up. {excstr(exc)}')
+                continue
+            for url in extract_stylesheet_urls(response.text, page_url=str(response.url)):
+                if url not in urls:
+                    urls.append(url)
+    return urls
+
+async def warm_stylesheet(url: str, font_format: str, reqid: str) -> None:
+
+    '''
+        Fills the cache with the stylesheet at url (css or css2 API) and
+        all its font files, just like a request for it would
+
+        :raises GGoogleFontsBadRequestException: if url is no stylesheet URL
+    '''
+
+    parsed_url = URL(url)
+    families = parsed_url.params.get_list('family')
+    api = parsed_url.path.rstrip('/').rsplit('/', 1)[-1]
+    if not families or api not in ('css', 'css2'):
+        raise GGoogleFontsBadRequestException(f'"{url}" is no css or css2 stylesheet URL')
+    g = get_google_fonts_downloader()
+    if api == 'css2':
+        await g.download_via_css2_api(
+            families=families,
+            display=parsed_url.params.get('display'),
+            text=parsed_url.params.get('text'),
+            reqid=reqid,
+            font_format=font_format
+        )
+        return
+    await g.download_via_css_api(
+        families_as_string=families[0],
+        display=parsed_url.params.get('display'),
+        text=parsed_url.params.get('text'),
+        subset=parsed_url.params.get('subset'),
+        reqid=reqid,
+        font_format=font_format
+    )
+
+async def warm_up(urls: Iterable[str], font_formats: Iterable[str], concurrency: int) -> AsyncIterator[dict]:
+
+    '''
+        Warms up every stylesheet in every font format, at most
+        concurrency of them at once. Yields the outcome of each of them
+        as soon as it is done (url, format, error, done, total), a
+        failed stylesheet does not stop the others.
+    '''
+
+    slots = Semaphore(max(concurrency, 1))
+    jobs = [(url, font_format) for url in dict.fromkeys(urls) for font_format in font_formats]
+
+    async def warm(url: str, font_format: str) -> dict:
+        async with slots:
+            try:
+                await warm_stylesheet(url=url, font_format=font_format, reqid=get_id(6))
+            except Exception as exc:
+                return dict(url=url, format=font_format, error=excstr(exc))
+        return dict(url=url, format=font_format, error=None)
+
+    for done, result in enumerate(as_completed([warm(url, font_format) for url, font_format in jobs]), 1):
+        outcome = await result
+        outcome.update(done=done, total=len(jobs))
+        yield outcome
@@ -2,6 +2,7 @@ from typing import Any, Callable, Union
 
 from gfo.exceptions import excstr
 from gfo.exceptions.sanity import GSanitizerInvalidException
+from gfo.sanity.cache import sanitize_cache_backend, sanitize_eviction_policy
 from gfo.sanity.datatypes import (
     sanitize_bool,
     sanitize_dict,
@@ -16,6 +17,7 @@ from gfo.sanity.filesystem import (
     sanitize_path_readable_file,
     sanitize_path_writable_file
 )
+from gfo.sanity.formats import sanitize_font_formats
 from gfo.sanity.timezone import sanitize_timezone
 
 class Sanitizers(object):
@@ -26,6 +28,9 @@ class Sanitizers(object):
     list = sanitize_list
     str = sanitize_str
     tuple = sanitize_tuple
+    cache_backend = sanitize_cache_backend
+    eviction_policy = sanitize_eviction_policy
+    font_formats = sanitize_font_formats
     path_readable_dir = sanitize_path_readable_dir
     path_readable_file = sanitize_path_readable_file
     path_writable_file = sanitize_path_writable_file
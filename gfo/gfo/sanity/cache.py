@@ -0,0 +1,22 @@
+from typing import Any, Union
+
+from gfo.sanity.datatypes import sanitize_str
+
+CACHE_BACKENDS = ('filesystem', 'memory', 'redis')
+EVICTION_POLICIES = ('gdsf', 'lfu', 'lru')
+
+def sanitize_cache_backend(value: Any, **kwargs) -> tuple[Union[str, None], bool, Union[str, None]]:
+    value, valid, errmsg = sanitize_str(value)
+    if not valid:
+        return value, valid, errmsg
+    if value.lower() not in CACHE_BACKENDS:
+        return None, False, f'Unknown cache backend "{value}" (valid backends: {", ".join(CACHE_BACKENDS)})'
+    return value.lower(), True, None
+
+def sanitize_eviction_policy(value: Any, **kwargs) -> tuple[Union[str, None], bool, Union[str, None]]:
+    value, valid, errmsg = sanitize_str(value)
+    if not valid:
+        return value, valid, errmsg
+    if value.lower() not in EVICTION_POLICIES:
+        return None, False, f'Unknown eviction policy "{value}" (valid policies: {", ".join(EVICTION_POLICIES)})'
+    return value.lower(), True, None
@@ -0,0 +1,14 @@
+from typing import Any, Union
+
+from gfo.sanity.datatypes import sanitize_list
+
+FONT_FORMATS = ('ttf', 'woff', 'woff2')
+
+def sanitize_font_formats(value: Any, **kwargs) -> tuple[Union[list, None], bool, Union[str, None]]:
+    value, valid, errmsg = sanitize_list(value)
+    if not valid:
+        return value, valid, errmsg
+    for font_format in value:
+        if not isinstance(font_format, str) or font_format.lower() not in FONT_FORMATS:
+            return None, False, f'Unknown font format "{font_format}" (valid formats: {", ".join(FONT_FORMATS)})'
+    return [font_format.lower() for font_format in value], True, None
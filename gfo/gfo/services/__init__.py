@@ -1,11 +1,13 @@
 from gfo.services.cache_cleanup import CacheCleanupService
 from gfo.services.service_manager import ServiceManager
+from gfo.services.warmup import WarmupService
 
 __GLOBAL_SERVICE_MANAGER = None
 
 def get_all_service_classes() -> tuple:
     return (
         CacheCleanupService,
+        WarmupService,
     )
 
 def get_service_manager() -> ServiceManager:
@@ -1,39 +1,142 @@
-from os import listdir, remove
-from os.path import getmtime, isfile, join as join_path
+from heapq import heapify, heappop, heappush
 from time import time
+from typing import Union
 
 from gfo.config import Constants, from_config
+from gfo.googlefonts.index import CacheIndexEntry, get_cache_index
+from gfo.googlefonts.singleflight import get_single_flight
+from gfo.googlefonts.storage import get_font_store
 from gfo.services.interface import Service
 from gfo.services.service_manager import ServiceManager
 
 class CacheCleanupService(Service):
 
+    '''
+        Removes expired cache entries and keeps the cache within its
+        quota. Instead of listing the whole cache directory, the service
+        keeps a min-heap of (retained_until, key) that is built from the cache
+        index once and then follows the index' change sequence, so each
+        tick only touches the entries that are due. Those are removed in
+        batches of CACHE_CLEANUP_BATCH_SIZE. Expired entries are retained
+        as long as they may be served stale (cache.stale_while_revalidate_seconds
+        and cache.stale_if_error_seconds).
+    '''
+
     service_interval = Constants.Internal.SERVICE_INTERVAL_CACHE_CLEANUP
     service_name = 'CacheCleanup'
 
     def __init__(self, service_manager: ServiceManager):
         self.service_manager = service_manager
+        self.expiry_heap: list[tuple[float, str]] = []
+        self.index_sequence: Union[int, None] = None
+        self.total_removed = 0
+        self.total_removed_bytes = 0
         if hasattr(super(), 'service_name'):
             super().__init__(service_manager=service_manager)
 
+    def schedule(self, entries: list[CacheIndexEntry]) -> None:
+        for entry in entries:
+            heappush(self.expiry_heap, (entry.retained_until, entry.key))
+
+    def update_schedule(self) -> None:
+        index = get_cache_index()
+        if self.index_sequence is None:
+            self.index_sequence = index.sequence()
+            self.expiry_heap = [(entry.retained_until, entry.key) for entry in index.entries()]
+            heapify(self.expiry_heap)
+            self.log_info(f'Scheduled the expiry of {len(self.expiry_heap)} cache entries')
+            return
+        self.index_sequence, changed_entries = index.changes_since(self.index_sequence)
+        self.schedule(changed_entries)
+
+    def remove_entry(self, entry: CacheIndexEntry, evicted: bool = False) -> bool:
+        with get_single_flight().try_lock(entry.key) as locked:
+            if not locked or not get_cache_index().remove_if_unchanged(entry, evicted=evicted):
+                return False
+            get_font_store().release(entry)
+        return True
+
+    def enforce_quota(self, subsets: bool = False) -> None:
+        '''
+            Evicts entries according to cache.eviction_policy once the cache
+            exceeds cache.max_bytes or cache.max_entries, until it is back at
+            CACHE_QUOTA_LOW_WATERMARK of the quota. Evicted files are only
+            unlinked, so workers still reading them are not affected, and
+            fonts evicted while still referenced by a stylesheet are
+            restored on their next request. The locally subset fonts of
+            text= requests have their own quota (cache.subset_max_bytes and
+            cache.subset_max_entries) and are evicted least recently used
+            first.
+        '''
+        max_bytes = from_config('cache', 'subset_max_bytes' if subsets else 'max_bytes')
+        max_entries = from_config('cache', 'subset_max_entries' if subsets else 'max_entries')
+        policy = 'lru' if subsets else from_config('cache', 'eviction_policy')
+        index = get_cache_index()
+        entries, size = index.usage(subsets=subsets)
+        if not ((max_bytes and size > max_bytes) or (max_entries and entries > max_entries)):
+            return
+        target_bytes = max_bytes * Constants.Internal.CACHE_QUOTA_LOW_WATERMARK
+        target_entries = max_entries * Constants.Internal.CACHE_QUOTA_LOW_WATERMARK
+        exceeded = lambda: (max_bytes and size > target_bytes) or (max_entries and entries > target_entries)
+        evicted = 0
+        evicted_bytes = 0
+        while exceeded():
+            candidates = index.eviction_candidates(
+                policy=policy,
+                limit=Constants.Internal.CACHE_CLEANUP_BATCH_SIZE,
+                subsets=subsets
+            )
+            clock = None
+            for entry, priority in candidates:
+                if not exceeded():
+                    break
+                if self.remove_entry(entry, evicted=True):
+                    entries -= 1
+                    size -= entry.size
+                    evicted += 1
+                    evicted_bytes += entry.size
+                    clock = priority
+            if clock is None:
+                break # nothing left to evict (or all candidates are being filled right now)
+            if policy == 'gdsf':
+                index.set_clock(clock)
+        self.log_info(
+            f'The font cache exceeded its {"subset font " if subsets else ""}quota - evicted {evicted} entries '
+            f'({evicted_bytes} bytes) using the {policy} policy [entries={entries};bytes={size}]'
+        )
+
     def run(self) -> None:
-        cache_lifespan_seconds = from_config('misc', 'cache_lifespan_seconds')
-        font_cache_dir = from_config('misc', 'font_cache_dir')
-        for file in listdir(font_cache_dir):
-            file_path = join_path(font_cache_dir, file)
-            if not isfile(file_path):
-                continue
-            file_lifespan = int(time() - getmtime(file_path))
-            if file_lifespan > cache_lifespan_seconds:
-                self.log_debug(
-                    f'Removing file "{file_path}" due to its lifespan '
-                    f'exceeding the max cache lifespan ({file_lifespan} > '
-                    f'{cache_lifespan_seconds})'
-                )
-                remove(file_path)
-                self.log_debug(f'Removed file "{file_path}"')
-            else:
-                self.log_debug(
-                    f'File "{file_path}" is still valid in cache. '
-                    f'({file_lifespan}s <= {cache_lifespan_seconds}s)'
-                )
+        self.enforce_quota()
+        self.enforce_quota(subsets=True)
+        get_cache_index().purge_tombstones()
+        self.update_schedule()
+        index = get_cache_index()
+        now = time()
+        scanned = 0
+        removed = 0
+        removed_bytes = 0
+        retry_later = []
+        while self.expiry_heap and self.expiry_heap[0][0] <= now:
+            batch = []
+            while self.expiry_heap and self.expiry_heap[0][0] <= now and len(batch) < Constants.Internal.CACHE_CLEANUP_BATCH_SIZE:
+                batch.append(heappop(self.expiry_heap))
+            scanned += len(batch)
+            entries = index.get_many(key for _, key in batch)
+            for retained_until, key in batch:
+                entry = entries.get(key)
+                if entry is None or entry.retained_until != retained_until:
+                    continue # already removed or refreshed (and rescheduled)
+                if self.remove_entry(entry):
+                    removed += 1
+                    removed_bytes += entry.size
+                else:
+                    retry_later.append(entry)
+        self.schedule(retry_later)
+        self.total_removed += removed
+        self.total_removed_bytes += removed_bytes
+        if scanned:
+            self.log_debug(
+                f'Scanned {scanned} due cache entries, removed {removed} entries '
+                f'({removed_bytes} bytes), {len(self.expiry_heap)} entries scheduled '
+                f'[total_removed={self.total_removed};total_removed_bytes={self.total_removed_bytes}]'
+            )
@@ -0,0 +1,59 @@
+from asyncio import AbstractEventLoop, new_event_loop
+
+from gfo.config import Constants, from_config
+from gfo.googlefonts.warmup import crawl_pages, load_manifest, warm_up
+from gfo.services.interface import Service
+from gfo.services.service_manager import ServiceManager
+
+class WarmupService(Service):
+
+    '''
+        Prefills the cache with the stylesheets of warmup.manifest_path and
+        those linked in warmup.crawl_pages at startup and then every
+        warmup.interval_seconds (only at startup with 0), so the first
+        visitors after a deployment don't pay for the cold cache. Does
+        nothing while neither is configured. All runs share one event
+        loop, as the upstream connection pools are bound to it.
+    '''
+
+    service_interval = Constants.Internal.SERVICE_INTERVAL_DEFAULT
+    service_name = 'Warmup'
+
+    def __init__(self, service_manager: ServiceManager):
+        self.service_manager = service_manager
+        self.service_interval = from_config('warmup', 'interval_seconds') or self.service_interval
+        self.loop: AbstractEventLoop = new_event_loop()
+        self.runs = 0
+        if hasattr(super(), 'service_name'):
+            super().__init__(service_manager=service_manager)
+
+    async def warm_up(self) -> None:
+        urls = []
+        manifest_path = from_config('warmup', 'manifest_path')
+        if manifest_path:
+            urls.extend(load_manifest(manifest_path))
+        urls.extend(await crawl_pages(from_config('warmup', 'crawl_pages')))
+        if not urls:
+            self.log_debug('Nothing to warm up')
+            return
+        failed = 0
+        total = 0
+        async for outcome in warm_up(
+            urls=urls,
+            font_formats=from_config('warmup', 'font_formats'),
+            concurrency=from_config('warmup', 'concurrency')
+        ):
+            if outcome['error'] is not None:
+                failed += 1
+                self.log_warn(f'Failed to warm up {outcome["format"]} stylesheet "{outcome["url"]}". {outcome["error"]}')
+            total = outcome['total']
+            self.log_debug(f'Warmed up {outcome["done"]} of {total} stylesheets')
+        self.log_info(f'Warmed up {total - failed} of {total} stylesheets (all font formats) [failed={failed}]')
+
+    def run(self) -> None:
+        if self.runs and not from_config('warmup', 'interval_seconds'):
+            return
+        self.runs += 1
+        if not from_config('warmup', 'manifest_path') and not from_config('warmup', 'crawl_pages'):
+            return
+        self.loop.run_until_complete(self.warm_up())
@@ -1,11 +1,12 @@
-from fastapi import FastAPI, Request, Response, Query
-from fastapi.responses import FileResponse, StreamingResponse
+from contextlib import asynccontextmanager
+from fastapi import Body, FastAPI, Request, Response, Query
+from fastapi.responses import StreamingResponse
 from fastapi.routing import Mount
 from fastapi.middleware import Middleware
 from fastapi.middleware.cors import CORSMiddleware
-from io import BytesIO
+from hmac import compare_digest
+from json import dumps as json_dumps
 from logging import getLogger
-from os.path import isfile
 from starlette.templating import _TemplateResponse
 from sys import argv
 from time import sleep
@@ -17,7 +18,20 @@ from gfo.config import Constants, from_config
 from gfo.exceptions import excstr
 from gfo.exceptions.catcher import get_unhandled_exception_handler
 from gfo.exceptions.googlefonts import GGoogleFontsBadRequestException, GGoogleFontsException
+from gfo.googlefonts.access import get_access_recorder
+from gfo.googlefonts.backends import get_cache_backend, pack_entry
+from gfo.googlefonts.bundle import BUNDLE_FORMAT_ZIP, get_bundle_formats
+from gfo.googlefonts.client import get_upstream_client
 from gfo.googlefonts.downloader import GoogleFontsDownloader, get_google_fonts_downloader
+from gfo.googlefonts.formats import FONT_FORMAT_USER_AGENTS, classify_user_agent
+from gfo.googlefonts.index import CacheIndexEntry, FONT_ENTRY_KINDS, get_cache_index
+from gfo.googlefonts.peers import PEER_FILL_PATH, get_peer_fill
+from gfo.googlefonts.hot_fonts import get_hot_font_cache
+from gfo.googlefonts.responses import FONT_FILE_NAME, bundle_response, font_response, hot_font_response, stylesheet_response
+from gfo.googlefonts.storage import get_font_store
+from gfo.googlefonts.subsetting import get_font_subsetter
+from gfo.googlefonts.transcoding import WOFF2_SUFFIX, get_woff2_transcoder
+from gfo.googlefonts.warmup import crawl_pages, warm_up
 from gfo.i18n import i18n, get_i18n_language_from_string
 from gfo.libaccelerate.helpers import get_id, current_function_name
 from gfo.logging import get_logger
@@ -74,12 +88,26 @@ middlewares = [
     ),
 ]
 
+'''
+    Close the upstream connection pools and the transcoding and subsetting
+    processes when the worker shuts down
+'''
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    await get_upstream_client().close()
+    await get_cache_backend().close()
+    await get_peer_fill().close()
+    get_woff2_transcoder().close()
+    get_font_subsetter().close()
+
 '''
     Instantiate FastAPI
 '''
 app = FastAPI(
     routes=routes,
-    middleware=middlewares
+    middleware=middlewares,
+    lifespan=lifespan
 )
 
 @app.get(
@@ -129,7 +157,8 @@ def index(
         )
     }
 )
-def get_font_via_gfonts_css_api(
+async def get_font_via_gfonts_css_api(
+    req: Request,
     family: str = Query(),
     display: Optional[Union[str, None]] = Query(default=None),
     text: Optional[Union[str, None]] = Query(default=None),
@@ -138,15 +167,16 @@ def get_font_via_gfonts_css_api(
     reqid = get_id(6)
     g : GoogleFontsDownloader = get_google_fonts_downloader()
     try:
-        return Response(
-            content=g.download_via_css_api(
+        return stylesheet_response(
+            req=req,
+            rewritten_css_sheet=await g.download_via_css_api(
                 families_as_string=family,
                 display=display,
                 text=text,
                 subset=subset,
-                reqid=reqid
-            ),
-            media_type='text/css'
+                reqid=reqid,
+                font_format=classify_user_agent(req.headers.get('user-agent'))
+            )
         )
     except GGoogleFontsBadRequestException as exc:
         log.warn(
@@ -187,7 +217,8 @@ def get_font_via_gfonts_css_api(
         )
     }
 )
-def get_font_via_gfonts_css2_api(
+async def get_font_via_gfonts_css2_api(
+    req: Request,
     family: list[str] = Query(),
     display: Optional[Union[str, None]] = Query(default=None),
     text: Optional[Union[str, None]] = Query(default=None),
@@ -195,14 +226,15 @@ def get_font_via_gfonts_css2_api(
     reqid = get_id(6)
     g : GoogleFontsDownloader = get_google_fonts_downloader()
     try:
-        return Response(
-            content=g.download_via_css2_api(
+        return stylesheet_response(
+            req=req,
+            rewritten_css_sheet=await g.download_via_css2_api(
                 families=family,
                 display=display,
                 text=text,
-                reqid=reqid
-            ),
-            media_type='text/css'
+                reqid=reqid,
+                font_format=classify_user_agent(req.headers.get('user-agent'))
+            )
         )
     except GGoogleFontsBadRequestException as exc:
         log.warn(
@@ -233,42 +265,40 @@ def get_font_via_gfonts_css2_api(
                 ),
                 'application/json': None
             },
-            description='The archive (currently only zip) containing the rewritten CSS and font files (as application/octet-stream)',
+            description='The archive (zip, tar.gz or tar.zst) containing the rewritten CSS and font files (as application/octet-stream)',
         ),
         400: dict(
-            description='Google\'s API responded with HTTP 400. Check your params.',
+            description='Google\'s API responded with HTTP 400 or the archive format is not supported. Check your params.',
         ),
         500: dict(
             description='An internal server error happened',
         )
     }
 )
-def download_font_bundle_via_gfonts_css_api(
+async def download_font_bundle_via_gfonts_css_api(
+    req: Request,
     family: str = Query(),
     display: Optional[Union[str, None]] = Query(default=None),
     text: Optional[Union[str, None]] = Query(default=None),
-    subset: Optional[Union[str, None]] = Query(default=None)
+    subset: Optional[Union[str, None]] = Query(default=None),
+    bundle_archive_format: str = Query(default=BUNDLE_FORMAT_ZIP, alias='format')
 ) -> Response:
     reqid = get_id(6)
-    bundle_archive_format = 'zip' # make this variable?
+    if bundle_archive_format not in get_bundle_formats():
+        raise Constants.HTTPErrors.BAD_ARCHIVE_FORMAT
     g : GoogleFontsDownloader = get_google_fonts_downloader()
     try:
-        bundle_bytes_io : BytesIO = g.download_via_css_api(
+        bundle = await g.download_via_css_api(
             families_as_string=family,
             display=display,
             text=text,
             subset=subset,
             reqid=reqid,
+            font_format=classify_user_agent(req.headers.get('user-agent')),
             download_as_bundle=True,
             bundle_archive_format=bundle_archive_format
         )
-        return StreamingResponse(
-            content=bundle_bytes_io,
-            media_type='application/octet-stream',
-            headers={
-                'content-disposition': f'attachment; filename=gfo-bundle.{bundle_archive_format}'
-            }
-        )
+        return bundle_response(req=req, bundle=bundle, archive_format=bundle_archive_format)
     except GGoogleFontsBadRequestException as exc:
         log.warn(
             f'Google\'s API responded with a status of 400 to our font request. '
@@ -298,40 +328,38 @@ def download_font_bundle_via_gfonts_css_api(
                 ),
                 'application/json': None
             },
-            description='The archive (currently only zip) containing the rewritten CSS and font files (as application/octet-stream)',
+            description='The archive (zip, tar.gz or tar.zst) containing the rewritten CSS and font files (as application/octet-stream)',
         ),
         400: dict(
-            description='Google\'s API responded with HTTP 400. Check your params.',
+            description='Google\'s API responded with HTTP 400 or the archive format is not supported. Check your params.',
         ),
         500: dict(
             description='An internal server error happened',
         )
     }
 )
-def download_font_bundle_via_gfonts_css2_api(
+async def download_font_bundle_via_gfonts_css2_api(
+    req: Request,
     family: list[str] = Query(),
     display: Optional[Union[str, None]] = Query(default=None),
     text: Optional[Union[str, None]] = Query(default=None),
+    bundle_archive_format: str = Query(default=BUNDLE_FORMAT_ZIP, alias='format')
 ) -> Response:
     reqid = get_id(6)
-    bundle_archive_format = 'zip' # make this variable?
+    if bundle_archive_format not in get_bundle_formats():
+        raise Constants.HTTPErrors.BAD_ARCHIVE_FORMAT
     g : GoogleFontsDownloader = get_google_fonts_downloader()
     try:
-        bundle_bytes_io : BytesIO = g.download_via_css2_api(
+        bundle = await g.download_via_css2_api(
             families=family,
             display=display,
             text=text,
             reqid=reqid,
+            font_format=classify_user_agent(req.headers.get('user-agent')),
             download_as_bundle=True,
             bundle_archive_format=bundle_archive_format
         )
-        return StreamingResponse(
-            content=bundle_bytes_io,
-            media_type='application/octet-stream',
-            headers={
-                'content-disposition': f'attachment; filename=gfo-bundle.{bundle_archive_format}'
-            }
-        )
+        return bundle_response(req=req, bundle=bundle, archive_format=bundle_archive_format)
     except GGoogleFontsBadRequestException as exc:
         log.warn(
             f'Google\'s API responded with a status of 400 to our font request. '
@@ -351,8 +379,9 @@ def download_font_bundle_via_gfonts_css2_api(
         )
         raise Constants.HTTPErrors.INTERNAL_SERVER_ERROR
 
-@app.get(
+@app.api_route(
     path='/font/{font_url_md5}',
+    methods=['GET', 'HEAD'],
     responses={
         200: dict(
             content={
@@ -361,7 +390,10 @@ def download_font_bundle_via_gfonts_css2_api(
                 ),
                 'application/json': None
             },
-            description='The archive containing the rewritten CSS and font files',
+            description='The font file',
+        ),
+        206: dict(
+            description='The requested byte range of the font file',
         ),
         404: dict(
             description='The requested font file does not exist'
@@ -371,20 +403,180 @@ def download_font_bundle_via_gfonts_css2_api(
         )
     }
 )
-def get_font_from_local_storage(req: Request, font_url_md5: str) -> Response:
-    g = GoogleFontsDownloader()
-    font_path = g.get_font_path_from_md5(font_url_md5)
-    if not isfile(font_path):
+async def get_font_from_local_storage(req: Request, font_url_md5: str) -> Response:
+    if FONT_FILE_NAME.fullmatch(font_url_md5) is None:
+        raise Constants.HTTPErrors.NOT_FOUND
+    transcoded = font_url_md5.endswith(WOFF2_SUFFIX)
+
+    '''
+        Hot fonts are served from memory without looking at the cache
+        index or the file
+    '''
+    hot_fonts = get_hot_font_cache()
+    if hot_fonts.enabled:
+        hot_font = hot_fonts.get(font_url_md5)
+        if hot_font is not None:
+            get_access_recorder().record(hot_font.entry.key)
+            return hot_font_response(req=req, hot_font=hot_font, transcoded=transcoded)
+    font_url_md5 = font_url_md5.removesuffix(WOFF2_SUFFIX)
+
+    async def serve(entry: CacheIndexEntry) -> Response:
+        get_access_recorder().record(font_url_md5)
+        try:
+            return await font_response(
+                req=req,
+                font_path=get_font_store().path(entry),
+                entry=entry,
+                transcoded=transcoded
+            )
+        except FileNotFoundError:
+            raise
+        except Exception as exc:
+            log.error(
+                f'An unexpected exception occured while processing request. '
+                f'[endpoint={current_function_name()}] {excstr(exc)}'
+            )
+            raise Constants.HTTPErrors.INTERNAL_SERVER_ERROR
+
+    '''
+        The file is only looked for once the cache index knows the font,
+        fonts that vanished from the cache are restored
+    '''
+    entry = get_cache_index().get(font_url_md5)
+    if entry is not None and entry.kind in FONT_ENTRY_KINDS:
+        try:
+            return await serve(entry)
+        except FileNotFoundError:
+            if transcoded:
+                raise Constants.HTTPErrors.NOT_FOUND # not transcoded yet, the stylesheet lists the TrueType font as fallback
+    font = get_font_store().lookup(font_url_md5)
+    if font is None:
+        g : GoogleFontsDownloader = get_google_fonts_downloader()
+        try:
+            restored = await g.restore_evicted_font(font_url_md5=font_url_md5, reqid=get_id(6))
+        except GGoogleFontsException as exc:
+            log.error(
+                f'An unexpected exception occured while restoring an evicted font. '
+                f'[endpoint={current_function_name()}] {excstr(exc)}'
+            )
+            raise Constants.HTTPErrors.INTERNAL_SERVER_ERROR
+        font = get_font_store().lookup(font_url_md5) if restored else None
+    if font is None or font[0].kind not in FONT_ENTRY_KINDS: # stylesheets and bundles are no fonts
+        raise Constants.HTTPErrors.NOT_FOUND
+    try:
+        return await serve(font[0])
+    except FileNotFoundError:
+        raise Constants.HTTPErrors.NOT_FOUND # evicted again meanwhile
+
+@app.post(
+    path='/admin/warmup',
+    responses={
+        200: dict(
+            content={
+                'application/x-ndjson': dict(
+                    example='{"url": "https://fonts.googleapis.com/css2?family=Roboto", "format": "woff2", "error": null, "done": 1, "total": 3}'
+                ),
+                'application/json': None
+            },
+            description='The outcome of every warmed up stylesheet and font format as a JSON line, as soon as it is done',
+        ),
+        400: dict(
+            description='A requested font format is not supported',
+        ),
+        401: dict(
+            description='The request lacks a valid admin token (Authorization: Bearer <admin.token>)',
+        ),
+        404: dict(
+            description='The admin endpoints are disabled (admin.token is empty)',
+        )
+    }
+)
+async def warm_up_font_cache(
+    req: Request,
+    urls: list[str] = Body(default=[]),
+    pages: list[str] = Body(default=[]),
+    font_formats: Optional[list[str]] = Body(default=None)
+) -> Response:
+    token = from_config('admin', 'token')
+    if not token:
+        raise Constants.HTTPErrors.NOT_FOUND
+    if not compare_digest(req.headers.get('authorization', '').encode('utf-8'), f'Bearer {token}'.encode('utf-8')):
+        raise Constants.HTTPErrors.UNAUTHORIZED
+    font_formats = font_formats or from_config('warmup', 'font_formats')
+    if any(font_format not in FONT_FORMAT_USER_AGENTS for font_format in font_formats):
+        raise Constants.HTTPErrors.BAD_FONT_FORMAT
+    try:
+        urls = urls + await crawl_pages(pages)
+    except Exception as exc:
+        log.error(
+            f'An unexpected exception occured while processing request. '
+            f'[endpoint={current_function_name()}] {excstr(exc)}'
+        )
+        raise Constants.HTTPErrors.INTERNAL_SERVER_ERROR
+    log.info(f'Warming up {len(urls)} stylesheets on behalf of an admin request')
+
+    async def progress():
+        async for outcome in warm_up(
+            urls=urls,
+            font_formats=font_formats,
+            concurrency=from_config('warmup', 'concurrency')
+        ):
+            yield json_dumps(outcome) + '\n'
+
+    return StreamingResponse(progress(), media_type='application/x-ndjson')
+
+@app.get(
+    path=PEER_FILL_PATH,
+    response_class=Response,
+    responses={
+        200: dict(
+            content={
+                'application/octet-stream': dict(
+                    example='The cache index entry as a JSON line, followed by the cached file'
+                ),
+                'application/json': None
+            },
+            description='The filled cache entry',
+        ),
+        400: dict(
+            description='The URL is no Google Fonts stylesheet or font, or Google rejected it',
+        ),
+        401: dict(
+            description='The request lacks the shared secret of the peers (Authorization: Bearer <peers.secret>)',
+        ),
+        404: dict(
+            description='Peer fill is disabled',
+        ),
+        500: dict(
+            description='An internal server error happened',
+        )
+    }
+)
+async def fill_cache_entry_for_peer(
+    req: Request,
+    kind: str = Query(),
+    url: str = Query(),
+    font_format: Optional[str] = Query(default=None, alias='format')
+) -> Response:
+    peer_fill = get_peer_fill()
+    if not peer_fill.enabled:
         raise Constants.HTTPErrors.NOT_FOUND
+    if not peer_fill.is_authorized(req.headers.get('authorization', '')):
+        raise Constants.HTTPErrors.UNAUTHORIZED
     try:
-        return FileResponse(
-            path=font_path,
-            media_type='application/octet-stream',
-            content_disposition_type='attachment'
+        entry, content = await get_google_fonts_downloader().fill_for_peer(
+            kind=kind,
+            url=url,
+            font_format=font_format,
+            reqid=get_id(6)
         )
+    except GGoogleFontsBadRequestException as exc:
+        log.warn(f'Rejected a peer fill request. [endpoint={current_function_name()}] {excstr(exc)}')
+        raise Constants.HTTPErrors.BAD_REQUEST
     except Exception as exc:
         log.error(
             f'An unexpected exception occured while processing request. '
             f'[endpoint={current_function_name()}] {excstr(exc)}'
         )
-        raise Constants.HTTPErrors.INTERNAL_SERVER_ERROR
\ No newline at end of file
+        raise Constants.HTTPErrors.INTERNAL_SERVER_ERROR
+    return Response(content=pack_entry(entry, content), media_type='application/octet-stream')
@@ -3,6 +3,7 @@ from os.path import isdir, join as join_path
 from shutil import rmtree
 
 from gfo.config import from_config, Constants
+from gfo.googlefonts.persistence import validate_font_cache
 from gfo.logging import get_logger
 
 log = get_logger()
@@ -12,13 +13,22 @@ log.info(f'Running GFO version {Constants.Versioning.VERSION} - a software by {C
 log.info('Executing prestart actions now...')
 
 font_cache_dir = from_config('misc', 'font_cache_dir')
-if isdir(font_cache_dir):
-    log.info(f'The font cache directory "{font_cache_dir}" already exists. Removing it now...')
-    rmtree(font_cache_dir)
+if isdir(font_cache_dir) and from_config('cache', 'persistent'):
+    log.info(f'The font cache directory "{font_cache_dir}" already exists and is persistent. Validating it now...')
+    stats = validate_font_cache(font_cache_dir)
+    log.info(
+        f'Font cache directory "{font_cache_dir}" validated! Kept {stats["kept"]} entries '
+        f'({stats["kept_bytes"]} bytes), removed {stats["removed"]} entries ({stats["removed_bytes"]} bytes) '
+        f'and {stats["removed_staging_dirs"]} orphaned staging directories'
+    )
+else:
+    if isdir(font_cache_dir):
+        log.info(f'The font cache directory "{font_cache_dir}" already exists. Removing it now...')
+        rmtree(font_cache_dir)
 
-log.info(f'Creating font cache directory "{font_cache_dir}"...')
-mkdir(font_cache_dir)
-log.info(f'Font cache directory "{font_cache_dir}" created!')
+    log.info(f'Creating font cache directory "{font_cache_dir}"...')
+    mkdir(font_cache_dir)
+    log.info(f'Font cache directory "{font_cache_dir}" created!')
 
 font_cache_test_path = join_path(font_cache_dir, '.test')
 with open(font_cache_test_path, 'wb') as test:
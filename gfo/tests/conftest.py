@@ -0,0 +1,38 @@
+from os.path import dirname, join as join_path
+from pytest import fixture
+from shutil import rmtree
+from sys import path as sys_path
+from tempfile import mkdtemp
+
+sys_path.insert(0, dirname(dirname(__file__)))
+
+import gfo.config.dynamic as dynamic_config
+
+'''
+    Tests never write to the log file or the font cache of the repo
+'''
+TEST_DIR = mkdtemp(prefix='gfo-tests-')
+reader = dynamic_config._ConfigurationReader()
+user_config = reader.read_as_yaml_from_file()
+user_config.setdefault('log', {})['file_path'] = join_path(TEST_DIR, 'gfo.log')
+user_config.setdefault('misc', {})['font_cache_dir'] = join_path(TEST_DIR, 'fonts')
+CONFIGURATION = reader.validate_and_complete_configuration(user_config_dict=user_config)
+dynamic_config.__dict__['__GLOBAL_CONFIGURATION'] = CONFIGURATION
+
+def pytest_unconfigure(config) -> None:
+    rmtree(TEST_DIR, ignore_errors=True)
+
+@fixture
+def config():
+    '''
+        Overrides configuration settings for a test: config('cache', 'backend', 'redis')
+    '''
+    overridden = []
+
+    def override(key: str, subkey: str, value) -> None:
+        overridden.append((key, subkey, CONFIGURATION[key][subkey]))
+        CONFIGURATION[key][subkey] = value
+
+    yield override
+    for key, subkey, value in reversed(overridden):
+        CONFIGURATION[key][subkey] = value
@@ -0,0 +1,44 @@
+'''
+    Runs one node of the two-node peer fill tests: python peer_node.py
+    <config file> <port> <upstream log>. Google is replaced by a mock
+    that logs every URL it is asked for to the upstream log.
+'''
+
+from httpx import AsyncClient, MockTransport, Response
+from os.path import dirname
+from sys import argv, path as sys_path
+from uvicorn import run
+
+sys_path.insert(0, dirname(dirname(__file__)))
+
+import gfo.config.dynamic as dynamic_config
+
+config_path, port, upstream_log_path = argv[1], int(argv[2]), argv[3]
+dynamic_config.__dict__['__GLOBAL_CONFIGURATION'] = dynamic_config._ConfigurationReader(config_path).get_config()
+
+def google(request) -> Response:
+    url = str(request.url)
+    with open(upstream_log_path, 'a') as upstream_log:
+        upstream_log.write(f'{url}\n')
+    if url.startswith('https://fonts.googleapis.com/'):
+        family = request.url.params['family'].split(':')[0]
+        css = ''.join(
+            f"@font-face {{\n  font-family: '{family}';\n"
+            f"  src: url(https://fonts.gstatic.com/s/{family.lower()}/v1/{subset}.ttf) format('truetype');\n}}\n"
+            for subset in ('latin', 'latin-ext')
+        )
+        return Response(200, text=css, headers={'content-type': 'text/css', 'cache-control': 'private, max-age=86400'})
+    return Response(200, content=b'\x00\x01\x00\x00' + url.encode('utf-8') * 50, headers={'content-type': 'font/ttf', 'cache-control': 'public, max-age=86400'})
+
+class GoogleClient(AsyncClient):
+
+    def __init__(self, *args, **kwargs) -> None:
+        kwargs['transport'] = MockTransport(google)
+        super().__init__(*args, **kwargs)
+
+import gfo.googlefonts.client
+gfo.googlefonts.client.AsyncClient = GoogleClient
+
+from main import app
+
+run(app, host='127.0.0.1', port=port, log_level='warning')
@@ -0,0 +1,156 @@
+from asyncio import gather, run, sleep
+from fakeredis import FakeAsyncRedis, FakeServer
+from pytest import fixture
+from redis.exceptions import ResponseError
+from time import time
+
+import gfo.googlefonts.backends as backends
+from gfo.googlefonts.backends import REDIS_KEY_PREFIX, RedisCacheBackend
+from gfo.googlefonts.index import CacheIndexEntry, ENTRY_KIND_FONT
+
+LOCK_TIMEOUT = .2
+
+class LuaRedis(FakeAsyncRedis):
+
+    '''
+        fakeredis without lupa has no EVAL, so the release script is
+        emulated for the tests of servers with Lua
+    '''
+
+    async def eval(self, script, numkeys, key, token):
+        if await self.get(key) == token.encode('utf-8'):
+            return await self.delete(key)
+        return 0
+
+class NoLuaRedis(FakeAsyncRedis):
+
+    async def eval(self, *args):
+        raise ResponseError('unknown command \'eval\'')
+
+@fixture
+def server():
+    return FakeServer()
+
+def make_backend(monkeypatch, server: FakeServer, redis_class: type = LuaRedis) -> RedisCacheBackend:
+    class Redis(object):
+        @staticmethod
+        def from_url(url: str, **kwargs):
+            return redis_class(server=server)
+    monkeypatch.setattr(backends, 'Redis', Redis)
+    backend = RedisCacheBackend(url='redis://localhost:6379/0')
+    backend.timeout = LOCK_TIMEOUT
+    return backend
+
+def make_entry(key: str, content: bytes, lifespan: float) -> CacheIndexEntry:
+    now = time()
+    return CacheIndexEntry(
+        key=key,
+        kind=ENTRY_KIND_FONT,
+        url=f'https://fonts.gstatic.com/s/{key}.ttf',
+        checksum='0' * 32,
+        size=len(content),
+        fetched_at=now,
+        expires_at=now + lifespan
+    )
+
+async def lock_token(server: FakeServer, key: str) -> bytes:
+    return await FakeAsyncRedis(server=server).get(f'{REDIS_KEY_PREFIX}lock:{key}')
+
+def test_put_and_get_expire_with_their_entry(monkeypatch, server):
+    backend = make_backend(monkeypatch, server)
+    redis = FakeAsyncRedis(server=server)
+
+    async def scenario():
+        await backend.put(entry=make_entry('a', b'font', lifespan=100), content=b'font')
+        entry, content = await backend.get('a')
+        assert (entry.key, content) == ('a', b'font')
+        assert 95 <= await redis.ttl(f'{REDIS_KEY_PREFIX}entry:a') <= 100
+        await backend.put(entry=make_entry('b', b'font', lifespan=.5), content=b'font')
+        assert await backend.get('b') is None
+        assert await backend.get('c') is None
+
+    run(scenario())
+
+def test_lock_is_released_by_its_holder(monkeypatch, server):
+    backend = make_backend(monkeypatch, server)
+
+    async def scenario():
+        async with backend.lock('a'):
+            assert await lock_token(server, 'a') is not None
+        assert await lock_token(server, 'a') is None
+
+    run(scenario())
+
+def test_lock_serializes_holders(monkeypatch, server):
+    backend = make_backend(monkeypatch, server)
+    backend.timeout = 5
+    order = []
+
+    async def hold(name: str) -> None:
+        async with backend.lock('a'):
+            order.append(f'{name} in')
+            await sleep(.05)
+            order.append(f'{name} out')
+
+    async def scenario():
+        await gather(hold('first'), hold('second'))
+
+    run(scenario())
+    assert order == ['first in', 'first out', 'second in', 'second out']
+
+def test_lock_expires_after_timeout(monkeypatch, server):
+    backend = make_backend(monkeypatch, server)
+
+    async def scenario():
+        await FakeAsyncRedis(server=server).set(f'{REDIS_KEY_PREFIX}lock:a', 'crashed', px=int(LOCK_TIMEOUT * 1000) // 2)
+        started = time()
+        async with backend.lock('a'):
+            assert await lock_token(server, 'a') not in (None, b'crashed')
+        assert time() - started < LOCK_TIMEOUT
+
+    run(scenario())
+
+def test_stale_holder_does_not_release_lock_of_another(monkeypatch, server):
+    for redis_class in (LuaRedis, NoLuaRedis):
+        backend = make_backend(monkeypatch, server, redis_class)
+
+        async def scenario():
+            async with backend.lock('a'):
+                await sleep(LOCK_TIMEOUT * 1.5) # expired meanwhile
+                successor = backend.lock('a')
+                await successor.__aenter__()
+                token = await lock_token(server, 'a')
+            assert await lock_token(server, 'a') == token
+            await successor.__aexit__(None, None, None)
+            assert await lock_token(server, 'a') is None
+
+        run(scenario())
+
+def test_lock_is_released_without_lua(monkeypatch, server):
+    backend = make_backend(monkeypatch, server, NoLuaRedis)
+    backend.timeout = 30
+
+    async def scenario():
+        async with backend.lock('a'):
+            pass
+        assert await lock_token(server, 'a') is None
+        started = time()
+        async with backend.lock('a'):
+            pass
+        assert time() - started < 1
+
+    run(scenario())
+
+def test_redis_failures_degrade_to_local_fills(monkeypatch, server):
+    backend = make_backend(monkeypatch, server)
+    server.connected = False
+
+    async def scenario():
+        await backend.put(entry=make_entry('a', b'font', lifespan=100), content=b'font')
+        assert await backend.get('a') is None
+        filled = False
+        async with backend.lock('a'):
+            filled = True
+        assert filled
+
+    run(scenario())
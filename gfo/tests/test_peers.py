@@ -0,0 +1,112 @@
+from fakeredis import TcpFakeServer
+from httpx import get as http_get
+from os.path import dirname, join as join_path
+from pytest import fixture
+from socket import socket
+from subprocess import Popen
+from sys import executable
+from threading import Thread
+from time import monotonic, sleep
+from yaml import safe_dump
+
+from gfo.googlefonts.downloader import css2_url, css_cache_key, md5
+from gfo.googlefonts.formats import FONT_FORMAT_TTF
+from gfo.googlefonts.peers import HashRing
+
+PEER_TIMEOUT = 3.0
+VIRTUAL_NODES = 16
+
+def free_port() -> int:
+    with socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+@fixture
+def redis_url():
+    server = TcpFakeServer(('127.0.0.1', free_port()))
+    Thread(target=server.serve_forever, daemon=True).start()
+    yield f'redis://127.0.0.1:{server.server_address[1]}/0'
+    server.shutdown()
+    server.server_close()
+
+@fixture
+def nodes(tmp_path, redis_url):
+    '''
+        Two nodes sharing Redis as their cache backend and filling their
+        cache misses from each other
+    '''
+    urls = {name: f'http://127.0.0.1:{free_port()}' for name in ('a', 'b')}
+    processes = []
+    for name, url in urls.items():
+        config_path = tmp_path / f'{name}.yaml'
+        config_path.write_text(safe_dump(dict(
+            cache=dict(backend='redis', redis_url=redis_url),
+            log=dict(file_path=str(tmp_path / f'{name}.log')),
+            misc=dict(font_cache_dir=str(tmp_path / f'{name}-fonts')),
+            peers=dict(urls=list(urls.values()), self_url=url, secret='secret', timeout_seconds=PEER_TIMEOUT, virtual_nodes=VIRTUAL_NODES),
+            upstream=dict(font_formats_by_user_agent=False)
+        )))
+        processes.append(Popen([
+            executable,
+            join_path(dirname(__file__), 'peer_node.py'),
+            str(config_path),
+            url.rsplit(':', 1)[1],
+            str(tmp_path / f'{name}-upstream.log')
+        ]))
+    try:
+        for url in urls.values():
+            deadline = monotonic() + 30
+            while 1:
+                try:
+                    http_get(f'{url}/font/0.ttf')
+                    break
+                except Exception:
+                    if monotonic() > deadline:
+                        raise
+                    sleep(.1)
+        yield urls
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+def upstream_urls(tmp_path, name: str) -> list[str]:
+    upstream_log = tmp_path / f'{name}-upstream.log'
+    return upstream_log.read_text().split() if upstream_log.exists() else []
+
+def test_peer_fill_with_redis_backend_does_not_wait_for_the_timeout(tmp_path, nodes):
+    ring = HashRing(nodes=nodes.values(), virtual_nodes=VIRTUAL_NODES)
+    family = next(
+        family for family in (f'Family{number}' for number in range(1000))
+        if ring.owner(css_cache_key(url=css2_url(families=[family], display=None, text=None), font_format=FONT_FORMAT_TTF)) == nodes['b']
+    )
+    started = monotonic()
+    response = http_get(f'{nodes["a"]}/css2', params=dict(family=family), timeout=30)
+    assert response.status_code == 200
+    assert monotonic() - started < PEER_TIMEOUT
+    assert css2_url(families=[family], display=None, text=None) in upstream_urls(tmp_path, 'b')
+    for url in upstream_urls(tmp_path, 'a'):
+        key = md5(url) if url.startswith('https://fonts.gstatic.com/') else css_cache_key(url=url, font_format=FONT_FORMAT_TTF)
+        assert ring.owner(key) == nodes['a']
+
+def test_same_key_at_both_nodes_is_fetched_once(tmp_path, nodes):
+    ring = HashRing(nodes=nodes.values(), virtual_nodes=VIRTUAL_NODES)
+    families = [
+        family for family in (f'Family{number}' for number in range(1000))
+        if ring.owner(css_cache_key(url=css2_url(families=[family], display=None, text=None), font_format=FONT_FORMAT_TTF)) == nodes['b']
+    ][:5]
+    responses = []
+    def request(url: str, family: str) -> None:
+        responses.append(http_get(f'{url}/css2', params=dict(family=family), timeout=30))
+    started = monotonic()
+    threads = [Thread(target=request, args=(url, family)) for family in families for url in nodes.values()]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert monotonic() - started < PEER_TIMEOUT
+    assert [response.status_code for response in responses] == [200] * len(threads)
+    fetched = upstream_urls(tmp_path, 'a') + upstream_urls(tmp_path, 'b')
+    assert sorted(fetched) == sorted(set(fetched))
+    for family in families:
+        assert css2_url(families=[family], display=None, text=None) in fetched
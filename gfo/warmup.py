@@ -0,0 +1,58 @@
+from argparse import ArgumentParser, Namespace
+from asyncio import run
+
+from gfo.config import from_config
+from gfo.googlefonts.backends import get_cache_backend
+from gfo.googlefonts.client import get_upstream_client
+from gfo.googlefonts.peers import get_peer_fill
+from gfo.googlefonts.subsetting import get_font_subsetter
+from gfo.googlefonts.transcoding import get_woff2_transcoder
+from gfo.googlefonts.warmup import crawl_pages, load_manifest, warm_up
+from gfo.logging import get_logger
+
+'''
+    Prefills the font cache with the stylesheets of a manifest (one css or
+    css2 URL per line) and/or those linked in the given site pages, e.g.
+    right after a deployment:
+
+        python3 warmup.py --manifest fonts.txt --crawl https://example.com/
+'''
+
+async def main(args: Namespace) -> int:
+    log = get_logger()
+    urls = []
+    for manifest_path in args.manifest:
+        urls.extend(load_manifest(manifest_path))
+    urls.extend(await crawl_pages(args.crawl))
+    log.info(f'Warming up {len(urls)} stylesheets...')
+    failed = 0
+    try:
+        async for outcome in warm_up(
+            urls=urls,
+            font_formats=args.font_formats or from_config('warmup', 'font_formats'),
+            concurrency=args.concurrency
+        ):
+            if outcome['error'] is None:
+                log.info(f'[{outcome["done"]}/{outcome["total"]}] Warmed up {outcome["format"]} stylesheet "{outcome["url"]}"')
+            else:
+                failed += 1
+                log.warn(f'[{outcome["done"]}/{outcome["total"]}] Failed to warm up {outcome["format"]} stylesheet "{outcome["url"]}". {outcome["error"]}')
+    finally:
+        await get_upstream_client().close()
+        await get_cache_backend().close()
+        await get_peer_fill().close()
+        get_woff2_transcoder().close()
+        get_font_subsetter().close()
+    log.info(f'Warmup finished [failed={failed}]')
+    return 1 if failed else 0
+
+'''
+    Guarded, as the transcoding and subsetting processes import this module
+'''
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Prefills the GFO font cache')
+    parser.add_argument('--manifest', action='append', default=[], help='a file with one stylesheet URL per line')
+    parser.add_argument('--crawl', action='append', default=[], help='a site page whose stylesheet links are warmed up')
+    parser.add_argument('--format', action='append', dest='font_formats', choices=('ttf', 'woff', 'woff2'), help='the font formats to warm up')
+    parser.add_argument('--concurrency', type=int, default=from_config('warmup', 'concurrency'), help='the amount of stylesheets warmed up concurrently')
+    exit(run(main(parser.parse_args())))